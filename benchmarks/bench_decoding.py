@@ -0,0 +1,70 @@
+"""Compare memory and throughput of decoders of a large page
+
+Run from the root of the package:
+    python benchmarks/bench_decoding.py [rows]
+"""
+import sys
+import json
+import time
+import tracemalloc
+
+from edynam.decoding import StreamingDecoder, orjson
+from edynam.dynamics import FORMATTED_VALUE_SUF, CHUNK_SIZE
+
+
+def make_page(rows):
+    """A page of salesorderdetails alike rows with formatted values"""
+    value = []
+    for i in range(rows):
+        value.append({
+            '@odata.etag': 'W/"%d"' % (1000000 + i),
+            'salesorderdetailid': '%08x-6b96-e611-80e9-c4346bc516e8' % i,
+            'quantity': i % 50,
+            'quantity@' + FORMATTED_VALUE_SUF: '%d.00' % (i % 50),
+            'priceperunit': 12.5,
+            'priceperunit@' + FORMATTED_VALUE_SUF: '$12.50',
+            'createdon': '2017-10-20T02:19:54Z',
+            'createdon@' + FORMATTED_VALUE_SUF: '20/10/2017 11:49 AM',
+            '_productid_value': 'c3724cbc-b183-e611-80e7-c4346bc4beac',
+            '_productid_value@' + FORMATTED_VALUE_SUF: 'TANGO Cloud VM',
+            '_salesorderid_value': 'ac120dfb-1a91-e611-80e5-%012x' % i,
+            '_salesorderid_value@' + FORMATTED_VALUE_SUF: 'Order %d' % i,
+        })
+    return json.dumps({'@odata.context': 'https://mocked/api/data/v8.2/$metadata#salesorderdetails', 'value': value}).encode()
+
+
+def measure(name, func, body):
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = func(body)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-22s %8d rows %10.0f rows/s %10.1f MiB peak' % (name, rows, rows / elapsed, peak / 2 ** 20))
+
+
+def whole_json(body):
+    # what response.json() does: text first then the whole tree
+    return len(json.loads(body.decode('utf-8'))['value'])
+
+
+def whole_orjson(body):
+    return len(orjson.loads(body)['value'])
+
+
+def streaming(body):
+    chunks = (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+    count = 0
+    for _ in StreamingDecoder(chunks):
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    page = make_page(size)
+    print('Page of %d rows, %.1f MiB' % (size, len(page) / 2 ** 20))
+    measure('json (whole body)', whole_json, page)
+    if orjson is not None:
+        measure('orjson (whole body)', whole_orjson, page)
+    measure('streaming', streaming, page)
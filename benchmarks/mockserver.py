@@ -0,0 +1,302 @@
+"""A local stand-in of Dynamics Web API serving synthetic data
+
+It serves entity sets (salesorders, contacts, dynamicpropertyinstances, ...)
+with $select, $top and paging by odata.maxpagesize and @odata.nextLink,
+FetchXML queries with paging cookies, connections of orders in roles,
+RetrieveProductProperties of order lines and optionset items. Rows are generated from the selected fields or
+the aliases of a FetchXML query, so any Handler can query it.
+
+Size of entity sets, page size, latency and throttling are configurable.
+/_stats returns counters of requests, /_reset resets them.
+
+Run it alone:
+    python benchmarks/mockserver.py --port 8080 --rows 20000 --latency 0.05
+and use http://127.0.0.1:8080 as resource in conf.json with any tokens.
+"""
+import re
+import sys
+import json
+import time
+import threading
+import argparse
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse, parse_qs, quote, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_ROOT = '/api/data/v8.2/'
+FORMATTED = '@OData.Community.Display.V1.FormattedValue'
+ENTITY_PATH = re.compile(r'^([A-Za-z_]+)(\(([^)]*)\))?(/Microsoft\.Dynamics\.CRM\.(\w+)\(\))?$')
+# datatype of properties of an order line: optionset, decimal, double, string, integer
+PROPERTY_TYPES = (0, 1, 2, 3, 4)
+VALUE_NAMES = {0: 'valueinteger', 1: 'valuedecimal', 2: 'valuedouble', 3: 'valuestring', 4: 'valueinteger'}
+
+
+def guid(kind, i):
+    """A deterministic GUID of the ith entity of a kind"""
+    return '%08x-0000-4000-8000-%012x' % (sum(map(ord, kind)) & 0xffffffff, i)
+
+
+class Config(object):
+    def __init__(self, rows=10000, page_size=5000, latency=0.0, throttle_every=0, retry_after=0):
+        """
+        :param int rows: number of entities of every entity set
+        :param int page_size: default maximum rows of a page
+        :param float latency: seconds to wait before responding
+        :param int throttle_every: respond 429 to every nth request, 0 is never
+        :param int retry_after: value of Retry-After header of throttled responses
+        """
+        self.rows = rows
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.by_end_point = {}
+
+    def count(self, end_point, size, throttled=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.by_end_point[end_point] = self.by_end_point.get(end_point, 0) + 1
+            if throttled:
+                self.throttled += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'throttled': self.throttled,
+                    'bytes': self.bytes, 'by_end_point': dict(self.by_end_point)}
+
+
+def make_value(field, kind, i):
+    """Synthetic value of a field with its formatted value if it has one"""
+    if field.endswith('id') and not field.startswith('_'):
+        return guid(field[:-2], i), None
+    if field.startswith('_') and field.endswith('_value'):
+        name = field[1:-6]
+        return guid(name, i % 97), '%s %d' % (name, i % 97)
+    if field in ('quantity', 'valueinteger', 'statecode', 'statuscode', 'datatype', 'dynamicpropertyoptionvalue'):
+        return i % 5, str(i % 5)
+    if field in ('priceperunit', 'amount', 'valuedecimal', 'valuedouble', 'manualdiscountamount', 'volumediscountamount'):
+        return 12.5 + i % 10, '$%.2f' % (12.5 + i % 10)
+    if field.startswith('createdon') or field.startswith('modifiedon') or field.endswith('date'):
+        return '2017-10-%02dT02:19:54Z' % (i % 28 + 1), '%02d/10/2017 11:49 AM' % (i % 28 + 1)
+    return '%s %s %d' % (kind, field, i), None
+
+
+def make_row(kind, fields, i):
+    row = {'@odata.etag': 'W/"%d"' % (1000000 + i), kind + 'id': guid(kind, i)}
+    for field in fields:
+        value, formatted = make_value(field, kind, i)
+        row[field] = value
+        if formatted is not None:
+            row[field + FORMATTED] = formatted
+    return row
+
+
+class Handler(BaseHTTPRequestHandler):
+    config = None
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, end_point, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        if not end_point.startswith('_'):
+            self.stats.count(end_point, len(data), status == 429)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; odata.metadata=minimal')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/_stats':
+            return self._send(200, self.stats.to_dict(), '_stats')
+        if parsed.path == '/_reset':
+            self.stats.reset()
+            return self._send(200, {}, '_reset')
+        if not parsed.path.startswith(API_ROOT):
+            return self._send(404, {'error': {'message': 'Not found'}}, 'unknown')
+        end_point = parsed.path[len(API_ROOT):]
+        match = ENTITY_PATH.match(end_point)
+        if not match:
+            return self._send(404, {'error': {'message': 'Not found'}}, 'unknown')
+        entity_set, _, key, _, function = match.groups()
+
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        if self.config.throttle_every and (self.stats.requests + 1) % self.config.throttle_every == 0:
+            return self._send(429, {'error': {'message': 'Throttled'}}, entity_set,
+                              {'Retry-After': str(self.config.retry_after)})
+        if not self.headers.get('Authorization'):
+            return self._send(401, {'error': {'message': 'Unauthorized'}}, entity_set)
+
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        if function == 'RetrieveProductProperties':
+            body = self.product_properties(key)
+        elif key is not None:
+            body = self.single(entity_set, key, params)
+        elif 'fetchXml' in params:
+            body = self.fetch(entity_set, params)
+        else:
+            body = self.collection(entity_set, params)
+        self._send(200, body, entity_set)
+
+    def _page_size(self):
+        preferred = re.search(r'odata\.maxpagesize=(\d+)', self.headers.get('Prefer', ''))
+        return int(preferred.group(1)) if preferred else self.config.page_size
+
+    @staticmethod
+    def _kind(entity_set):
+        if entity_set.endswith('ies'):
+            return entity_set[:-3] + 'y'
+        return entity_set[:-1]
+
+    def single(self, entity_set, key, params):
+        kind = self._kind(entity_set)
+        fields = params.get('$select', 'name').split(',')
+        row = make_row(kind, fields, int(key.split('-')[-1], 16) if '-' in key else 0)
+        row['@odata.context'] = 'http://mocked/$metadata#%s/$entity' % entity_set
+        return row
+
+    def product_properties(self, key):
+        return {'value': [{'dynamicpropertyid': guid('dynamicproperty', datatype),
+                           'name': 'Property%d' % datatype,
+                           'datatype': datatype} for datatype in PROPERTY_TYPES]}
+
+    def collection(self, entity_set, params):
+        kind = self._kind(entity_set)
+        fields = params['$select'].split(',') if '$select' in params else ['name']
+        filters = params.get('$filter', '')
+        if entity_set == 'dynamicpropertyinstances' and '_regardingobjectid_value' in filters:
+            # properties of an order line
+            rows = []
+            for datatype in PROPERTY_TYPES:
+                row = make_row(kind, fields, datatype)
+                row['_dynamicpropertyid_value'] = guid('dynamicproperty', datatype)
+                row[VALUE_NAMES[datatype]] = datatype if datatype in (0, 4) else row.get(VALUE_NAMES[datatype])
+                rows.append(row)
+            return {'value': rows}
+        if entity_set == 'dynamicpropertyoptionsetitems' and 'dynamicpropertyoptionvalue eq' in filters:
+            return {'value': [{'dynamicpropertyoptionname': 'Option %s' % filters.rsplit(' ', 1)[-1]}]}
+
+        total = self.config.rows
+        if '$top' in params:
+            total = min(total, int(params['$top']))
+        start = int(params.get('$skiptoken', 0))
+        end = min(total, start + self._page_size())
+        body = {'@odata.context': 'http://mocked/$metadata#%s' % entity_set,
+                'value': [make_row(kind, fields, i) for i in range(start, end)]}
+        if end < total:
+            next_params = dict(params, **{'$skiptoken': str(end)})
+            body['@odata.nextLink'] = 'http://%s:%d%s%s?%s' % (
+                self.server.server_address[0], self.server.server_address[1], API_ROOT, entity_set, urlencode(next_params))
+        return body
+
+    def fetch(self, entity_set, params):
+        fetch = ET.fromstring(params['fetchXml'])
+        entity = fetch.find('entity')
+        kind = entity.get('name')
+        fields = [attr.get('alias') or attr.get('name') for attr in fetch.iter('attribute')]
+        if kind == 'connection':
+            return self.connections(entity_set, fetch, fields)
+        page = int(fetch.get('page', '1'))
+        page_size = min(int(fetch.get('count', '5000')), self._page_size())
+        start = (page - 1) * page_size
+        end = min(self.config.rows, start + page_size)
+        body = {'@odata.context': 'http://mocked/$metadata#%s' % entity_set,
+                'value': [make_row(kind, fields, i) for i in range(start, end)]}
+        if end < self.config.rows:
+            cookie = '<cookie page="%d"><%sid last="{%s}" first="{%s}" /></cookie>' % (
+                page, kind, guid(kind, end - 1), guid(kind, start))
+            body['@Microsoft.Dynamics.CRM.fetchxmlpagingcookie'] = '<cookie pagenumber="%d" pagingcookie="%s" istracking="False" />' % (
+                page + 1, quote(quote(cookie)))
+            body['@Microsoft.Dynamics.CRM.morerecords'] = True
+        return body
+
+    def connections(self, entity_set, fetch, fields):
+        """A Contact of every role of every Order in the in conditions of a query"""
+        values = {cond.get('attribute'): [value.text for value in cond.iter('value')]
+                  for cond in fetch.iter('condition') if cond.get('operator') == 'in'}
+        rows = []
+        for order_id in values.get('record1id', []):
+            for role_id in values.get('record2roleid', []):
+                row = make_row('connection', fields, len(rows))
+                row.update({'orderid': order_id, 'roleid': role_id})
+                rows.append(row)
+        return {'@odata.context': 'http://mocked/$metadata#%s' % entity_set, 'value': rows}
+
+
+class MockDynamicsServer(object):
+    """Serve synthetic Web API responses in a background thread
+
+    Usage:
+        with MockDynamicsServer(Config(rows=20000)) as server:
+            resource = server.url
+    """
+    def __init__(self, config=None, port=0):
+        self.config = config if config else Config()
+        self.stats = Stats()
+        handler = type('BoundHandler', (Handler, ), {'config': self.config, 'stats': self.stats})
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve synthetic Dynamics Web API responses')
+    parser.add_argument('--port', type=int, default=0, help='default 0: any free port')
+    parser.add_argument('--rows', type=int, default=10000, help='entities of every entity set')
+    parser.add_argument('--page-size', type=int, default=5000, help='default maximum rows of a page')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before responding')
+    parser.add_argument('--throttle-every', type=int, default=0, help='respond 429 to every nth request')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After of throttled responses')
+    args = parser.parse_args(argv)
+
+    config = Config(args.rows, args.page_size, args.latency, args.throttle_every, args.retry_after)
+    server = MockDynamicsServer(config, args.port)
+    # the first line of output is read by benchmarks/run.py
+    print(server.url, flush=True)
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
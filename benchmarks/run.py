@@ -0,0 +1,167 @@
+"""Offline benchmarks of Handler queries against a local mock Web API server
+
+Each scenario runs a few times against benchmarks/mockserver.py started in
+another process. Measured are rows/sec, requests and bytes per run, latency
+percentiles of runs and peak memory of the client (from a separate run
+traced by tracemalloc).
+
+Run from the root of the package:
+    PYTHONPATH=. python benchmarks/run.py                         # print results
+    PYTHONPATH=. python benchmarks/run.py --save benchmarks/baseline.json
+    PYTHONPATH=. python benchmarks/run.py --compare benchmarks/baseline.json
+
+--compare exits with 1 when a scenario is slower than the baseline by more
+than --tolerance or makes more requests.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+
+import requests
+
+from edynam.connection import ADALConnection
+from edynam.dynamics import Dynamics
+from edynam.models import Contact, Order, OrderDetail, PropertyInstance
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mockserver.py')
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def connect(url, retries=0):
+    conn = ADALConnection({'resource': url, 'tenant': 'mocked', 'authorityHostUrl': url,
+                           'clientId': 'mocked', 'clientSecret': 'mocked'})
+    conn.tokens = {'access_token': 'mocked', 'refresh_token': 'mocked'}
+    return Dynamics(conn, retries=retries)
+
+
+def scenarios(backend, args):
+    """Name and a function returning number of rows of each scenario"""
+    roles = [{'id': '99acba33-f3f7-e611-8112-70106fa3d971', 'name': 'leader'},
+             {'id': '8355863e-85fc-e611-810b-e0071b6685b1', 'name': 'admin'}]
+    props = [{'id': 'bfa8c910-e7e8-e611-80f4-c4346bc5b2d4', 'type': 'valuestring', 'alias': 'openstackId'},
+             {'id': 'ac47befd-05e9-e611-80f4-c4346bc5b2d4', 'type': 'valueinteger', 'alias': 'instances'},
+             {'id': 'd0f2df56-06e9-e611-80f4-c4346bc5b2d4', 'type': 'optionset', 'alias': 'os', 'required': False}]
+    lines = ['00000000-0000-4000-8000-%012x' % i for i in range(args.lines)]
+
+    def handler_list():
+        return len(Contact(backend).list())
+
+    def handler_scan():
+        return sum(1 for _ in PropertyInstance(backend).scan(page_size=args.page_size))
+
+    def handler_scan_prefetch():
+        return sum(1 for _ in PropertyInstance(backend).scan(page_size=args.page_size, prefetch=2))
+
+    def order_get_product():
+        return len(Order(backend).get_product('4923623f-47fd-e611-810b-e0071b6685b1', roles=roles, prod_props=props))
+
+    def property_values():
+        detail_handler = OrderDetail(backend)
+        return sum(len(detail_handler.get_property_values(line)) for line in lines)
+
+    return [('Handler.list', handler_list), ('Handler.scan', handler_scan), ('Handler.scan prefetch', handler_scan_prefetch),
+            ('Order.get_product', order_get_product), ('OrderDetail.get_property_values', property_values)]
+
+
+def measure(url, name, func, repeat):
+    def stats():
+        return requests.get(url + '/_stats').json()
+
+    requests.get(url + '/_reset')
+    timings, rows = [], 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows += func()
+        timings.append(time.perf_counter() - start)
+    served = stats()
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'rows_per_sec': rows / sum(timings),
+            'rows': rows // repeat,
+            'requests': served['requests'] / repeat,
+            'throttled': served['throttled'] / repeat,
+            'bytes': served['bytes'] / repeat,
+            'peak_memory': peak,
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99)}
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """Print results and return names of scenarios which regressed from baseline"""
+    regressed = []
+    print('%-32s %10s %8s %8s %10s %8s %8s %8s' % ('scenario', 'rows/s', 'rows', 'requests', 'peak KiB', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, result in results.items():
+        print('%-32s %10.0f %8d %8.1f %10.0f %8.1f %8.1f %8.1f' % (
+            name, result['rows_per_sec'], result['rows'], result['requests'], result['peak_memory'] / 1024.0,
+            result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000))
+        if baseline and name in baseline:
+            base = baseline[name]
+            speed = result['rows_per_sec'] / base['rows_per_sec']
+            print('%-32s %9.0f%% %8s %+8.1f %+9.0f%%' % (
+                '  vs baseline', speed * 100, '', result['requests'] - base['requests'],
+                (result['peak_memory'] / float(base['peak_memory']) - 1) * 100))
+            if speed < 1 - tolerance or result['requests'] > base['requests']:
+                regressed.append(name)
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Handler queries against a mock Web API server')
+    parser.add_argument('--rows', type=int, default=20000, help='entities of every entity set of the server')
+    parser.add_argument('--page-size', type=int, default=5000, help='maximum rows of a page')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server waits before responding')
+    parser.add_argument('--throttle-every', type=int, default=0, help='server responds 429 to every nth request')
+    parser.add_argument('--lines', type=int, default=20, help='order lines of OrderDetail.get_property_values')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each scenario')
+    parser.add_argument('--only', help='run scenarios whose names contain this')
+    parser.add_argument('--save', help='save results as a baseline to this file')
+    parser.add_argument('--compare', help='compare results with a baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down from baseline, default 0.2')
+    args = parser.parse_args(argv)
+
+    server = subprocess.Popen([sys.executable, SERVER, '--rows', str(args.rows), '--page-size', str(args.page_size),
+                               '--latency', str(args.latency), '--throttle-every', str(args.throttle_every)],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        url = server.stdout.readline().strip()
+        # a throttled request fails unless it is retried
+        backend = connect(url, retries=3 if args.throttle_every else 0)
+        results = {}
+        for name, func in scenarios(backend, args):
+            if args.only and args.only not in name:
+                continue
+            results[name] = measure(url, name, func, args.repeat)
+    finally:
+        server.terminate()
+        server.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as bf:
+            baseline = json.load(bf)
+    regressed = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as bf:
+            json.dump(results, bf, indent=2, sort_keys=True)
+    if regressed:
+        print('Regressed: %s' % ', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
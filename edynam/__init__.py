@@ -1,19 +1,33 @@
 import json
 import logging
 
-from edynam.connection import ADALConnection
-from edynam.dynamics import Dynamics
-
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 web_api_client = None
 
+# names imported when they are first used: adal and requests are slow to import
+_LAZY = {'ADALConnection': 'edynam.connection', 'Dynamics': 'edynam.dynamics'}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+        value = getattr(importlib.import_module(_LAZY[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
 def connect(parameter_json, saved_tokens_json):
     """Connect to Dynamics and returns a HTTP request handler for Web API calls"""
     # returned web_api_client is only useful when no model has been defined for
     # a Dynamics entity, you want to do raw http request but don't want to deal
     # with authentication.
+    # adal and requests are slow to import, only import them when connecting
+    from edynam.connection import ADALConnection
+    from edynam.dynamics import Dynamics
+
     global web_api_client
     with open(parameter_json, 'r') as jf:
         parameters = json.load(jf)
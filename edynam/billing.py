@@ -0,0 +1,154 @@
+"""Vectorised charges of order lines of reports
+
+Rows of reports, e.g. of Order.get_product, are turned into columns: numpy
+arrays of quantities, prices and discounts and arrays of keys to group by.
+Charges of all lines and totals of groups are then computed by array
+operations instead of loops over rows:
+
+    rows = Order(backend).get_product(product_id, discounts=True)
+    engine = BillingEngine.from_rows(rows, keys=('biller', 'orderID'))
+    engine.charges()                      # charge of every line
+    engine.totals(by=('biller', ))        # gross, discount and charge of every biller
+
+The charge of a line is (unit price - volume discount) x quantity - manual
+discount, as Dynamics computes extendedamount of an order line. Rows of
+get_product with roles repeat a line for every Contact of a role, bill rows
+retrieved without roles or every line is charged once per Contact.
+
+numpy is required: pip install numpy
+"""
+import array
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# names of fields in rows of Order.get_product
+QUANTITY = 'allocated'
+PRICE = 'unitPrice'
+MANUAL_DISCOUNT = 'manualdiscountamount'
+VOLUME_DISCOUNT = 'volumediscountamount'
+
+
+def _require_numpy():
+    if numpy is None:
+        raise RuntimeError('numpy is required by billing, install it by pip install numpy')
+
+
+def to_columns(rows, keys=(), values=(QUANTITY, PRICE, MANUAL_DISCOUNT, VOLUME_DISCOUNT)):
+    """Convert rows into columns
+
+    rows can be any iterable, e.g. a generator of Handler.scan, only
+    columns are kept in memory. Missing or None values are 0, missing keys
+    are empty strings.
+
+    :param iterable rows: dicts of rows
+    :param tuple keys: names of fields to group by
+    :param tuple values: names of numeric fields
+    :return dict: names to numpy arrays, float64 for values, str for keys
+    """
+    _require_numpy()
+    numbers = {name: array.array('d') for name in values}
+    labels = {name: [] for name in keys}
+    for row in rows:
+        get = row.get
+        for name, column in numbers.items():
+            column.append(get(name) or 0.0)
+        for name, column in labels.items():
+            label = get(name)
+            column.append('' if label is None else str(label))
+    columns = {name: numpy.frombuffer(column, dtype=numpy.float64) if len(column) else numpy.zeros(0)
+               for name, column in numbers.items()}
+    columns.update((name, numpy.array(column, dtype=str)) for name, column in labels.items())
+    return columns
+
+
+class BillingEngine(object):
+    """Charges of order lines and totals of groups of them"""
+
+    def __init__(self, columns, quantity=QUANTITY, price=PRICE,
+                 manual_discount=MANUAL_DISCOUNT, volume_discount=VOLUME_DISCOUNT):
+        """
+        :param dict columns: names to numpy arrays of the same length, see to_columns
+        :param str quantity: name of the column of quantities
+        :param str price: name of the column of unit prices
+        :param str manual_discount: name of the column of manual discounts of lines, optional column
+        :param str volume_discount: name of the column of volume discounts per unit, optional column
+        """
+        _require_numpy()
+        self.columns = columns
+        self.size = len(columns[quantity])
+        zeros = numpy.zeros(self.size)
+        self.quantity = numpy.asarray(columns[quantity], dtype=numpy.float64)
+        self.price = numpy.asarray(columns[price], dtype=numpy.float64)
+        self.manual_discount = numpy.asarray(columns.get(manual_discount, zeros), dtype=numpy.float64)
+        self.volume_discount = numpy.asarray(columns.get(volume_discount, zeros), dtype=numpy.float64)
+        self._charges = None
+
+    @classmethod
+    def from_rows(cls, rows, keys=(), **names):
+        """Create an engine from rows of a report
+
+        :param iterable rows: dicts of rows, e.g. returned by Order.get_product
+        :param tuple keys: names of fields to group by later
+        :param names: names of columns, see __init__
+        """
+        values = (names.get('quantity', QUANTITY), names.get('price', PRICE),
+                  names.get('manual_discount', MANUAL_DISCOUNT), names.get('volume_discount', VOLUME_DISCOUNT))
+        return cls(to_columns(rows, keys, values), **names)
+
+    def gross(self):
+        """Unit price x quantity of every line"""
+        return self.price * self.quantity
+
+    def charges(self):
+        """Charge of every line: (unit price - volume discount) x quantity - manual discount"""
+        if self._charges is None:
+            self._charges = (self.price - self.volume_discount) * self.quantity - self.manual_discount
+        return self._charges
+
+    def discounts(self):
+        """Discount of every line"""
+        return self.gross() - self.charges()
+
+    def _group(self, by):
+        """Index of group of every line and keys of groups"""
+        if not by:
+            return numpy.zeros(self.size, dtype=numpy.intp), [()]
+        uniques, inverses = [], []
+        for name in by:
+            unique, inverse = numpy.unique(self.columns[name], return_inverse=True)
+            uniques.append(unique)
+            inverses.append(inverse.reshape(-1))
+        codes = numpy.ravel_multi_index(inverses, tuple(len(unique) for unique in uniques))
+        group_codes, groups = numpy.unique(codes, return_inverse=True)
+        positions = numpy.unravel_index(group_codes, tuple(len(unique) for unique in uniques))
+        keys = list(zip(*(unique[position].tolist() for unique, position in zip(uniques, positions))))
+        return groups.reshape(-1), keys
+
+    def totals(self, by=()):
+        """Totals of lines grouped by key columns
+
+        :param tuple by: names of key columns, default (): total of all lines
+        :return list: a dict of every group in order of keys: values of keys,
+                      lines, quantity, gross, discount and charge
+        """
+        if self.size == 0:
+            return []
+        groups, keys = self._group(by)
+        count = len(keys)
+        quantity = numpy.bincount(groups, weights=self.quantity, minlength=count)
+        gross = numpy.bincount(groups, weights=self.gross(), minlength=count)
+        charge = numpy.bincount(groups, weights=self.charges(), minlength=count)
+        lines = numpy.bincount(groups, minlength=count)
+        totals = []
+        for i, key in enumerate(keys):
+            total = dict(zip(by, key))
+            total.update({'lines': int(lines[i]), 'quantity': float(quantity[i]), 'gross': float(gross[i]),
+                          'discount': float(gross[i] - charge[i]), 'charge': float(charge[i])})
+            totals.append(total)
+        return totals
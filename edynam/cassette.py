@@ -0,0 +1,147 @@
+"""Record responses of Dynamics and replay them offline
+
+A cassette is a gzip compressed JSON lines file, each line is one
+interaction: url, params, status, a few headers and body. Authorization
+headers are never recorded.
+
+Record while running a report against the live instance:
+    backend = Dynamics(conn, transport=RecordingTransport('report.jsonl.gz'))
+
+Replay it later without network or tokens, optionally with latency:
+    backend = replay('report.jsonl.gz', latency=0.2)
+"""
+import gzip
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# headers worth keeping in a cassette
+KEPT_HEADERS = ('Content-Type', 'Retry-After', 'ETag', 'OData-Version')
+
+
+def _key(url, params):
+    """Identity of a request: url and params in a stable order"""
+    return url, tuple(sorted((params or {}).items()))
+
+
+class CassetteResponse(object):
+    """A recorded response with the parts of requests.Response used by Dynamics"""
+
+    def __init__(self, url, status_code, content, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers else {}
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordingTransport(object):
+    """Make real requests and append every response to a cassette"""
+
+    def __init__(self, path, transport=None):
+        """
+        :param str path: path of the cassette, responses are appended to it
+        :param object transport: what makes real requests, default None: requests module
+        """
+        self.path = path
+        self._transport = transport
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, params=None, stream=False):
+        if self._transport is None:
+            import requests
+            self._transport = requests
+        r = self._transport.get(url, headers=headers, params=params, stream=stream)
+        try:
+            content = r.content
+        finally:
+            r.close()
+        kept = {name: r.headers[name] for name in KEPT_HEADERS if name in r.headers}
+        interaction = {'url': url, 'params': params or {}, 'status': r.status_code,
+                       'headers': kept, 'body': content.decode('utf-8')}
+        with self._lock:
+            # every line is a gzip member, a cassette is readable even if recording stops halfway
+            with gzip.open(self.path, 'at', encoding='utf-8') as cf:
+                cf.write(json.dumps(interaction) + '\n')
+        return CassetteResponse(url, r.status_code, content, kept)
+
+
+class ReplayTransport(object):
+    """Replay responses of a cassette in the order they were recorded
+
+    Responses of the same request (url and params) are replayed in turn,
+    the last one is repeated once all have been replayed.
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        :param str path: path of the cassette
+        :param float latency: seconds to wait before returning each response, default 0
+        """
+        self.latency = latency
+        self.resource = None
+        self._responses = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        with gzip.open(path, 'rt', encoding='utf-8') as cf:
+            for line in cf:
+                interaction = json.loads(line)
+                if self.resource is None:
+                    parsed = urlparse(interaction['url'])
+                    self.resource = '%s://%s' % (parsed.scheme, parsed.netloc)
+                response = CassetteResponse(interaction['url'], interaction['status'],
+                                            interaction['body'].encode('utf-8'), interaction['headers'])
+                self._responses.setdefault(_key(interaction['url'], interaction['params']), []).append(response)
+
+    def get(self, url, headers=None, params=None, stream=False):
+        key = _key(url, params)
+        if key not in self._responses:
+            raise LookupError('No recorded response of %s with %s' % (url, params))
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        responses = self._responses[key]
+        if self.latency:
+            time.sleep(self.latency)
+        return responses[min(served, len(responses) - 1)]
+
+
+class OfflineConnection(object):
+    """Stands in for ADALConnection when responses are replayed"""
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def generate_auth_header(self, refresh=False):
+        return {}
+
+
+def replay(path, latency=0.0):
+    """Create a Dynamics instance which replays a cassette without network or tokens
+
+    :param str path: path of the cassette
+    :param float latency: seconds to wait before returning each response, default 0
+    """
+    from .dynamics import Dynamics
+
+    transport = ReplayTransport(path, latency)
+    return Dynamics(OfflineConnection(transport.resource), transport=transport)
@@ -0,0 +1,190 @@
+"""In-memory graph of Products, their families and accessories
+
+Pricing a complex Product follows Accessory relationships of Substitute
+(productsubstitutes), and families follow parentproductid. Instead of a query
+per Product, a catalogue loads all Products and Substitutes in two paged
+queries and precomputes the transitive accessory closure and hierarchy:
+
+    catalogue = ProductCatalogue(backend).load()
+    catalogue.accessories(product_id)   # all accessories, directly or not
+    catalogue.ancestors(product_id)     # parent, grandparent, ...
+    catalogue.prices_as(product_id)     # Products whose prices make its price
+"""
+import logging
+
+from .models import Product, Substitute
+
+logger = logging.getLogger(__name__)
+
+
+class ProductCatalogue(object):
+    """Products with accessory and family relationships, looked up from memory"""
+
+    ACCESSORY = 'Accessory'
+    # Products of this type are pseudo products: priced by their accessories only
+    PSEUDO_TYPE = 'Miscellaneous Charges'
+    # directioncode of Substitute
+    BIDIRECTIONAL = 1
+
+    def __init__(self, backend, page_size=None):
+        """
+        :param Dynamics backend: instance of Dynamics
+        :param int page_size: maximum rows of a page, default None: server decides
+        """
+        self._backend = backend
+        self.page_size = page_size
+        self._products = {}
+        self._by_name = {}
+        self._accessories = {}
+        self._closure = {}
+        self._children = {}
+        self._prices_as = {}
+
+    @staticmethod
+    def _key(product_id):
+        return product_id.lower() if product_id else None
+
+    def load(self):
+        """Load all Products and active Accessory relationships, precompute closures
+
+        :return ProductCatalogue: self
+        """
+        products = {}
+        for product in Product(self._backend).scan(page_size=self.page_size):
+            products[self._key(product['productid'])] = product
+
+        accessories = {}
+        for link in Substitute(self._backend).scan(page_size=self.page_size):
+            if link.get('salesrelationshiptype') != self.ACCESSORY or link.get('statecode') != 0:
+                continue
+            source, target = self._key(link['productid']), self._key(link['substitutedproductid'])
+            accessories.setdefault(source, []).append(target)
+            if link.get('directioncode') == self.BIDIRECTIONAL:
+                accessories.setdefault(target, []).append(source)
+
+        children = {}
+        for key, product in products.items():
+            parent = self._key(product.get('parentproductid'))
+            if parent:
+                children.setdefault(parent, []).append(key)
+
+        self._products, self._accessories, self._children = products, accessories, children
+        self._by_name = {product['name']: key for key, product in products.items() if product.get('name')}
+        self._closure = {key: self._reach(key) for key in accessories}
+        self._prices_as = {}
+        for key in products:
+            self._prices_as[key] = self._components(key, set())
+        logger.debug('Loaded %d products with %d accessory relationships', len(products),
+                     sum(len(targets) for targets in accessories.values()))
+        return self
+
+    def _reach(self, key):
+        """Accessories reachable from a Product in breadth first order, cycles are cut"""
+        seen, order, queue = {key}, [], list(self._accessories.get(key, ()))
+        while queue:
+            current = queue.pop(0)
+            if current in seen:
+                continue
+            seen.add(current)
+            order.append(current)
+            queue.extend(self._accessories.get(current, ()))
+        return order
+
+    def _is_pseudo(self, key):
+        product = self._products.get(key)
+        return product is not None and product.get('producttype') == self.PSEUDO_TYPE
+
+    def _components(self, key, visiting):
+        """Products which make the price of a Product
+
+        A pseudo Product is priced by its accessories only, other Products
+        by themselves and their accessories. Accessories which are pseudo
+        Products are expanded in the same way.
+        """
+        if key in self._prices_as:
+            return self._prices_as[key]
+        visiting.add(key)
+        components = [] if self._is_pseudo(key) else [key]
+        for accessory in self._accessories.get(key, ()):
+            if accessory in visiting:
+                continue
+            for component in self._components(accessory, visiting):
+                if component not in components:
+                    components.append(component)
+        visiting.discard(key)
+        return components
+
+    def __len__(self):
+        return len(self._products)
+
+    def __contains__(self, product_id):
+        return self._key(product_id) in self._products
+
+    def get(self, product_id):
+        """Get a Product by its id, None if it is not in the catalogue"""
+        return self._products.get(self._key(product_id))
+
+    def find(self, name):
+        """Get a Product by its name, None if no Product has it"""
+        key = self._by_name.get(name)
+        return self._products[key] if key else None
+
+    def _to_products(self, keys):
+        return [self._products[key] for key in keys if key in self._products]
+
+    def accessories(self, product_id, transitive=True):
+        """Accessories of a Product
+
+        :param bool transitive: include accessories of accessories, default True
+        """
+        key = self._key(product_id)
+        if transitive:
+            return self._to_products(self._closure.get(key, ()))
+        return self._to_products(self._accessories.get(key, ()))
+
+    def parent(self, product_id):
+        """Parent (family or bundle) of a Product, None if it is at the top"""
+        product = self.get(product_id)
+        return self.get(product.get('parentproductid')) if product else None
+
+    def ancestors(self, product_id):
+        """Parent, grandparent and so on of a Product, the nearest first"""
+        found, key = [], self._key(product_id)
+        seen = {key}
+        while key in self._products:
+            key = self._key(self._products[key].get('parentproductid'))
+            if not key or key in seen or key not in self._products:
+                break
+            seen.add(key)
+            found.append(self._products[key])
+        return found
+
+    def children(self, product_id):
+        """Products whose parent is a Product"""
+        return self._to_products(self._children.get(self._key(product_id), ()))
+
+    def descendants(self, product_id):
+        """Children, grandchildren and so on of a Product"""
+        found, queue, seen = [], list(self._children.get(self._key(product_id), ())), set()
+        while queue:
+            key = queue.pop(0)
+            if key in seen:
+                continue
+            seen.add(key)
+            found.append(key)
+            queue.extend(self._children.get(key, ()))
+        return self._to_products(found)
+
+    def family(self, product_id):
+        """The top ancestor of a Product, the Product itself if it has no parent"""
+        ancestors = self.ancestors(product_id)
+        return ancestors[-1] if ancestors else self.get(product_id)
+
+    def prices_as(self, product_id):
+        """Products whose prices make the price of a Product
+
+        A Product of Miscellaneous Charges type is a pseudo Product priced by
+        its accessories only, any other Product is priced as itself and all
+        its accessories, see Substitute.
+        """
+        return self._to_products(self._prices_as.get(self._key(product_id), ()))
@@ -0,0 +1,164 @@
+"""Command line reporting tool of edynam
+
+Usage examples:
+    edynam list contact --select fullname,emailaddress1 --filter "statecode eq 0"
+    edynam get account e929372b-5063-e611-80e3-c4346bc4de3c
+    edynam report product "TANGO Cloud VM" --props OpenstackProjectID,OperatingSystem
+    edynam report account a779d575-c162-e611-80e3-c4346bc43f98 --role 99acba33-f3f7-e611-8112-70106fa3d971:leader
+    edynam report for-codes --product 4923623f-47fd-e611-810b-e0071b6685b1
+    edynam export contact contacts.jsonl.gz
+    edynam report account a779d575-c162-e611-80e3-c4346bc43f98 --output products.csv
+
+Only argparse and json are imported at start, modules which talk to Dynamics
+(requests, adal) are imported when a command needs them, so --help and
+argument errors return at once.
+"""
+import sys
+import json
+import argparse
+
+
+def _role(value):
+    """Parse a connection role argument in the form of id:name"""
+    role_id, sep, name = value.partition(':')
+    if not (role_id and sep and name):
+        raise argparse.ArgumentTypeError("Role has to be in the form of id:name, got '%s'" % value)
+    return {'id': role_id, 'name': name}
+
+
+def _csv_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='edynam', description='Query and report MS Dynamics entities')
+    parser.add_argument('--conf', default='conf.json', help='connection parameters, default conf.json')
+    parser.add_argument('--tokens', default='saved_tokens.json', help='saved tokens, default saved_tokens.json')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log debug messages to stderr')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    list_parser = commands.add_parser('list', help='list entities')
+    list_parser.add_argument('entity', help='entity name, e.g. contact or contacts')
+    list_parser.add_argument('--select', type=_csv_list, help='comma separated fields, default FIELDS of the entity')
+    list_parser.add_argument('--filter', help='OData $filter expression')
+    list_parser.add_argument('--top', type=int, help='return at most this number of entities')
+
+    get_parser = commands.add_parser('get', help='get an entity by its id')
+    get_parser.add_argument('entity', help='entity name, e.g. contact or contacts')
+    get_parser.add_argument('id', help='id of the entity')
+
+    report_parser = commands.add_parser('report', help='run a report')
+    reports = report_parser.add_subparsers(dest='report', metavar='report')
+    reports.required = True
+    product_parser = reports.add_parser('product', help='orders of a product')
+    product_parser.add_argument('product', help='name of the product')
+    product_parser.add_argument('--props', type=_csv_list, help='comma separated names of product properties to return')
+    product_parser.add_argument('--account', help='id of the customer account')
+    product_parser.add_argument('--role', type=_role, action='append', help='connection role as id:name, can be repeated')
+    account_parser = reports.add_parser('account', help='products sold to an account')
+    account_parser.add_argument('account', help='id of the customer account')
+    account_parser.add_argument('--role', type=_role, help='connection role as id:name')
+    for_parser = reports.add_parser('for-codes', help='ANZSRC FOR codes of orders')
+    for_parser.add_argument('--product', help='id of a product')
+    for_parser.add_argument('--account', help='id of a customer account')
+    for_parser.add_argument('--order', help='id of an order')
+    for sub_parser in (product_parser, account_parser, for_parser):
+        sub_parser.add_argument('--output', help='write rows to this file instead of stdout, format by its extension')
+
+    export_parser = commands.add_parser('export', help='export entities to a file')
+    export_parser.add_argument('entity', help='entity name, e.g. contact or contacts')
+    export_parser.add_argument('path', help='path of the output file')
+    export_parser.add_argument('--format', choices=('jsonl', 'csv', 'parquet'),
+                               help='default by extension of path or jsonl, parquet needs pyarrow')
+    export_parser.add_argument('--gzip', action='store_true', help='compress the file, default when path ends with .gz')
+    export_parser.add_argument('--filter', help='OData $filter expression')
+    return parser
+
+
+def find_handler(name):
+    """Find a Handler class by its class name or its end point, case insensitive"""
+    from . import models
+
+    name = name.lower()
+    for attr in dir(models):
+        handler = getattr(models, attr)
+        if isinstance(handler, type) and issubclass(handler, models.Handler) and handler is not models.Handler:
+            if name in (handler.__name__.lower(), handler.END_POINT.lower(), handler.ENTITY.lower()):
+                return handler
+    raise KeyError("Unknown entity '%s'" % name)
+
+
+def _list_params(handler, args):
+    selects = handler.create_select(args.select) if getattr(args, 'select', None) else None
+    extra = {}
+    if args.filter:
+        extra.update(handler.create_filter(args.filter))
+    if getattr(args, 'top', None):
+        extra['$top'] = str(args.top)
+    return selects, extra
+
+
+def run(args, out):
+    """Run a parsed command and write results as JSON to out"""
+    from . import connect
+    from .models import Product, Order
+
+    backend = connect(args.conf, args.tokens)
+    if args.command in ('list', 'get', 'export'):
+        handler = find_handler(args.entity)(backend)
+
+    if args.command == 'list':
+        selects, extra = _list_params(handler, args)
+        result = list(handler.scan(selects=selects, extra=extra))
+    elif args.command == 'get':
+        result = handler.get(args.id)
+    elif args.command == 'export':
+        return export(handler, args)
+    elif args.report == 'product':
+        product_handler = Product(backend)
+        product_id = product_handler.get_id_of(args.product)
+        props = product_handler.get_property_definitions(args.product, args.props) if args.props else None
+        result = Order(backend).get_product(product_id, roles=args.role, prod_props=props, account_id=args.account)
+    elif args.report == 'account':
+        result = Order(backend).get_account_products(args.account, args.role)
+    else:
+        result = Order(backend).get_for_codes(args.product, args.account, args.order)
+    if getattr(args, 'output', None):
+        from .export import export_rows
+        if isinstance(result, dict):
+            # codes of orders: {salesorderid: ['code: label', ...]}, a row of each code
+            result = [{'salesorderid': order_id, 'code': code} for order_id, codes in result.items() for code in codes]
+        # rows of reports have role fields only when their Orders have Contacts of roles
+        fields = list(dict.fromkeys(key for row in result for key in row))
+        count = export_rows(result, args.output, fields=fields)
+        print('Exported %d rows to %s' % (count, args.output), file=sys.stderr)
+        return 0
+    json.dump(result, out, indent=2)
+    out.write('\n')
+    return 0
+
+
+def export(handler, args):
+    """Write entities of a handler to a file page by page"""
+    _, extra = _list_params(handler, args)
+    count = handler.export(args.path, args.format, True if args.gzip else None, extra=extra)
+    print('Exported %d rows to %s' % (count, args.path), file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        import logging
+        logging.basicConfig(level=logging.DEBUG, stream=sys.stderr,
+                            format='%(levelname)s %(asctime)s %(filename)s %(module)s.%(funcName)s +%(lineno)d: %(message)s')
+    try:
+        return run(args, sys.stdout)
+    except (KeyError, LookupError, ConnectionError, AssertionError) as err:
+        print('Failed: %s' % err, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
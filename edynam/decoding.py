@@ -0,0 +1,119 @@
+import re
+import json
+import codecs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default_loads():
+    """The fastest function available for decoding a whole response body
+
+    orjson is used when it is installed, otherwise json from standard library.
+    """
+    if orjson is not None:
+        return orjson.loads
+    return json.loads
+
+
+class StreamingDecoder(object):
+    """Incrementally decode rows of the value array of a Web API response
+
+    Chunks of bytes are decoded as they arrive, each row of the value array
+    is yielded as soon as it is complete, so neither the whole body nor the
+    whole list of rows is kept in memory. Other top level keys, e.g.
+    @odata.nextLink, are collected in annotations. Rows are decoded by the
+    C scanner of json module.
+
+    Usage:
+        decoder = StreamingDecoder(response.iter_content(65536))
+        for row in decoder:
+            ...
+        next_link = decoder.annotations.get('@odata.nextLink')
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks):
+        """
+        :param iterable chunks: bytes of a response body
+        """
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._scanner = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.annotations = {}
+        self.has_value = False
+
+    def _fill(self):
+        """Read text of next chunk into buffer, returns False at the end of body"""
+        if self._eof:
+            return False
+        # drop decoded part
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._decoder.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """Get next non-whitespace character without consuming it"""
+        while True:
+            self._pos = self.WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON document')
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expecting one of %s but got %s at %d' % (chars, char, self._pos))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode next complete JSON value"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._scanner.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number can be cut by the end of a chunk
+            if end == len(self._buffer) and isinstance(value, (int, float)) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'value':
+                self.has_value = True
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.annotations[key] = self._value()
+            if self._expect(',}') == '}':
+                break
@@ -0,0 +1,123 @@
+"""Find queries repeated in loops and limit requests of a workflow
+
+A query made once for every item of a loop, e.g. get_option_value of every
+option or get_id_of of every name, multiplies requests quietly. Within a
+diagnostic scope requests are grouped by their shape, the end point shape
+(see metrics.end_point_shape) and the measured Handler call which made them,
+and a RepeatedQueryWarning is issued when a shape repeats threshold times:
+
+    with backend.diagnose(threshold=10) as trace:
+        Account(backend).get_usernames(account_id)
+    print(trace.report())
+
+Only the first page of a query is counted as a query, following pages are
+requests of the same query. request_budget fails a scope, e.g. a test replaying
+a cassette, which sends more requests than expected:
+
+    with backend.request_budget(3):
+        Order(backend).get_all_account_products(role=role)
+
+A scope is a listener of a Dynamics instance, requests of all threads using
+the instance are counted.
+"""
+import logging
+import threading
+import warnings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 10
+
+
+class RepeatedQueryWarning(UserWarning):
+    """A query of the same shape is made many times in a scope, likely once per item of a loop"""
+
+
+class RequestBudgetExceeded(AssertionError):
+    """A scope sends more requests than its budget"""
+
+
+class RequestTrace(object):
+    """Listener which counts requests and queries of a scope by shape
+
+    Keys of counts are tuples of end point shape and operation, operation is
+    '' for requests made outside measured Handler calls.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        """
+        :param int threshold: number of queries of a shape which issues a warning, None to never warn
+        """
+        self.threshold = threshold
+        self.requests = 0
+        self.queries = {}
+        self.warned = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if event['type'] != 'request':
+            return
+        with self._lock:
+            self.requests += 1
+            if event.get('page', 1) > 1:
+                return
+            shape = (event['end_point'], event.get('operation') or '')
+            count = self.queries[shape] = self.queries.get(shape, 0) + 1
+            warn = self.threshold is not None and count == self.threshold
+            if warn:
+                self.warned.append(shape)
+        if warn:
+            message = 'Query of %s repeated %d times in %s, is it made in a loop?' % (shape[0], count, shape[1] or 'no operation')
+            logger.warning(message)
+            warnings.warn(message, RepeatedQueryWarning, stacklevel=2)
+
+    def repeated(self, times=2):
+        """Shapes queried at least times, the most queried first
+
+        :return list: tuples of (end point shape, operation) and number of queries
+        """
+        with self._lock:
+            counts = [(shape, count) for shape, count in self.queries.items() if count >= times]
+        return sorted(counts, key=lambda item: (-item[1], item[0]))
+
+    def report(self):
+        """Text of numbers of requests and queries by shape"""
+        lines = ['%d requests, %d queries' % (self.requests, sum(self.queries.values()))]
+        for (end_point, operation), count in self.repeated(times=1):
+            lines.append('%6d  %s  %s' % (count, end_point, operation))
+        return '\n'.join(lines)
+
+
+class _Scope(object):
+    """Context of a RequestTrace added to a backend, checks the budget of requests when it ends"""
+
+    def __init__(self, backend, trace, budget=None):
+        self._backend = backend
+        self.trace = trace
+        self.budget = budget
+
+    def __enter__(self):
+        self._backend.add_listener(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._backend.remove_listener(self.trace)
+        # an error raised in the scope is more relevant than its number of requests
+        if exc_type is None and self.budget is not None and self.trace.requests > self.budget:
+            raise RequestBudgetExceeded('%d requests exceed the budget of %d\n%s'
+                                        % (self.trace.requests, self.budget, self.trace.report()))
+        return False
+
+
+def diagnose(backend, threshold=DEFAULT_THRESHOLD):
+    """Scope which warns of queries repeated threshold times, see Dynamics.diagnose"""
+    return _Scope(backend, RequestTrace(threshold))
+
+
+def request_budget(backend, budget, threshold=None):
+    """Scope which raises RequestBudgetExceeded when it ends after more than budget requests
+
+    :param int budget: maximum number of requests, pages of a query count one each
+    :param int threshold: also warn of queries repeated threshold times, default None: never warn
+    """
+    return _Scope(backend, RequestTrace(threshold), budget)
@@ -0,0 +1,203 @@
+"""In-memory directory of Contacts which have usernames
+
+Contact.get_usernames and get_usernames_of join contact, unit (account) and
+biller (parent account of unit) on the server for every call. A directory
+loads them once and indexes them by username, email, contact id and account,
+lookups after that are dictionary hits:
+
+    directory = ContactDirectory(backend).load()
+    directory.usernames_of(account_id)
+    directory.get_by_username('someone')
+
+refresh() only retrieves Contacts modified since the last load or refresh.
+Contacts deleted from Dynamics and changes of Accounts, e.g. a renamed unit,
+are only picked up by a full load.
+"""
+import logging
+import threading
+
+from .fetchxml import FetchXML, FetchXMLTemplate
+from .profiler import record_query
+
+logger = logging.getLogger(__name__)
+
+# keys of rows returned by Contact.get_usernames_of and Contact.get_usernames
+USERNAME_KEYS = ('contactid', 'username', 'manager', 'email', 'unit')
+BILLER_KEYS = USERNAME_KEYS + ('biller', )
+
+
+class ContactDirectory(object):
+    """Contacts which have username with their units and billers, indexed for lookups"""
+
+    END_POINT = 'contacts'
+
+    def __init__(self, backend, page_size=None):
+        """
+        :param Dynamics backend: instance of Dynamics
+        :param int page_size: maximum rows of a page, default None: server decides
+        """
+        self._backend = backend
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._contacts = {}
+        self._by_username = {}
+        self._by_email = {}
+        self._by_account = {}
+        # the latest modifiedon seen, the start of the next refresh
+        self.modified_since = None
+
+    @staticmethod
+    def _build(incremental):
+        # <fetch distinct="false" mapping="logical">
+        #     <entity name="contact">
+        #         <attribute name="new_username" alias='username'/>
+        #         <attribute name="fullname" alias='manager'/>
+        #         <attribute name="emailaddress1" alias='email'/>
+        #         <attribute name="modifiedon" />
+        #         <filter type="and">
+        #             <condition attribute="new_username" operator="not-null" />
+        #             <condition attribute="new_username" operator="ne" value="NULL" />
+        #         </filter>
+        #         <link-entity from="accountid" link-type="outer" name="account" to="parentcustomerid">
+        #             <attribute alias="unit" name="name" />
+        #             <attribute alias="unitid" name="accountid" />
+        #             <attribute alias="billerid" name="parentaccountid" />
+        #             <link-entity from="accountid" link-type="outer" name="account" to="parentaccountid">
+        #                 <attribute alias="biller" name="name" />
+        #             </link-entity>
+        #         </link-entity>
+        #     </entity>
+        # </fetch>
+        fetch = FetchXML.create_fetch(False)
+        entity = FetchXML.create_entity(fetch, 'contact')
+        FetchXML.create_alias(entity, 'new_username', 'username')
+        FetchXML.create_alias(entity, 'fullname', 'manager')
+        FetchXML.create_alias(entity, 'emailaddress1', 'email')
+        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'modifiedon'})
+
+        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+        if incremental:
+            # Contacts whose usernames have been removed are needed too: they leave the directory
+            FetchXML.create_condition(filter_op, 'modifiedon', 'ge', FetchXML.param('since'))
+        else:
+            FetchXML.create_condition(filter_op, 'new_username', 'not-null')
+            FetchXML.create_condition(filter_op, 'new_username', 'ne', 'NULL')
+
+        unit_link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid', 'outer')
+        FetchXML.create_alias(unit_link, 'name', 'unit')
+        FetchXML.create_alias(unit_link, 'accountid', 'unitid')
+        FetchXML.create_alias(unit_link, 'parentaccountid', 'billerid')
+        biller_link = FetchXML.create_link(unit_link, 'account', 'accountid', 'parentaccountid', 'outer')
+        FetchXML.create_alias(biller_link, 'name', 'biller')
+        return fetch
+
+    def _query(self, since=None):
+        incremental = since is not None
+        template = FetchXMLTemplate.get(('ContactDirectory', incremental), lambda: self._build(incremental))
+        fetch_xml = template.render(since=since)
+        logger.debug(fetch_xml)
+        record_query(fetch_xml)
+        return self._backend.iter_rows(self.END_POINT, {'fetchXml': fetch_xml}, self.page_size)
+
+    @staticmethod
+    def _listed(row):
+        """If a Contact belongs to the directory: has a username and a unit"""
+        username = row.get('username')
+        return bool(username) and username != 'NULL' and bool(row.get('unitid'))
+
+    def _index(self, contact_id, row):
+        self._contacts[contact_id] = row
+        self._by_username[row['username']] = contact_id
+        if row.get('email'):
+            self._by_email[row['email'].lower()] = contact_id
+        for account_id in (row.get('unitid'), row.get('billerid')):
+            if account_id:
+                self._by_account.setdefault(account_id.lower(), set()).add(contact_id)
+
+    def _unindex(self, contact_id):
+        row = self._contacts.pop(contact_id, None)
+        if row is None:
+            return
+        if self._by_username.get(row['username']) == contact_id:
+            del self._by_username[row['username']]
+        if row.get('email') and self._by_email.get(row['email'].lower()) == contact_id:
+            del self._by_email[row['email'].lower()]
+        for account_id in (row.get('unitid'), row.get('billerid')):
+            if account_id:
+                members = self._by_account.get(account_id.lower())
+                if members is not None:
+                    members.discard(contact_id)
+                    if not members:
+                        del self._by_account[account_id.lower()]
+
+    def _update(self, rows, latest=None):
+        """Update indexes by rows, return the latest modifiedon of them and latest"""
+        for row in rows:
+            contact_id = row['contactid'].lower()
+            self._unindex(contact_id)
+            if self._listed(row):
+                self._index(contact_id, row)
+            modified = row.get('modifiedon')
+            if modified and (latest is None or modified > latest):
+                latest = modified
+        return latest
+
+    def load(self):
+        """Load all Contacts which have usernames, replacing what has been loaded
+
+        :return ContactDirectory: self
+        """
+        rows = list(self._query())
+        with self._lock:
+            self._contacts, self._by_username, self._by_email, self._by_account = {}, {}, {}, {}
+            self.modified_since = self._update(rows)
+        logger.debug('Loaded %d contacts which have usernames', len(self._contacts))
+        return self
+
+    def refresh(self):
+        """Update Contacts modified since the last load or refresh
+
+        It loads all if nothing has been loaded.
+
+        :return int: number of Contacts retrieved
+        """
+        if self.modified_since is None:
+            self.load()
+            return len(self._contacts)
+        rows = list(self._query(self.modified_since))
+        with self._lock:
+            self.modified_since = self._update(rows, self.modified_since)
+        logger.debug('Refreshed %d contacts modified since %s', len(rows), self.modified_since)
+        return len(rows)
+
+    def __len__(self):
+        return len(self._contacts)
+
+    @staticmethod
+    def _pick(row, keys):
+        return {key: row[key] for key in keys if key in row}
+
+    def get(self, contact_id):
+        """Get a Contact by its id, None if it is not in the directory"""
+        row = self._contacts.get(contact_id.lower())
+        return self._pick(row, BILLER_KEYS) if row else None
+
+    def get_by_username(self, username):
+        """Get a Contact by username, None if no Contact has it"""
+        contact_id = self._by_username.get(username)
+        return self.get(contact_id) if contact_id else None
+
+    def get_by_email(self, email):
+        """Get a Contact by email address (case insensitive), None if no Contact has it"""
+        contact_id = self._by_email.get(email.lower())
+        return self.get(contact_id) if contact_id else None
+
+    def usernames_of(self, account_id):
+        """Contacts of an Account or of its child Accounts, as Contact.get_usernames_of returns"""
+        contacts = self._contacts
+        return [self._pick(contacts[contact_id], USERNAME_KEYS)
+                for contact_id in sorted(self._by_account.get(account_id.lower(), ())) if contact_id in contacts]
+
+    def usernames(self):
+        """Contacts whose units have parent Accounts, as Contact.get_usernames returns"""
+        return [self._pick(row, BILLER_KEYS) for row in self._contacts.values() if row.get('billerid')]
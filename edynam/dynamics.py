@@ -1,9 +1,17 @@
+import copy
 import json
+import time
 import logging
-import requests
+import threading
+from collections import OrderedDict
 
-
-from .connection import ADALConnection
+# requests is imported when the first request is made: it is slow to import
+from .decoding import StreamingDecoder, default_loads
+from .fetchxml import FetchXML
+from . import diagnostics
+from .metrics import current_operation, end_point_shape, bind
+from .pipeline import Pipe
+from .profiler import phase, timed
 
 
 def parse_www_authenticate(raw_string):
@@ -11,9 +19,33 @@ def parse_www_authenticate(raw_string):
 
 DYNAMICS_VER = '8.2'
 FORMATTED_VALUE_SUF = 'OData.Community.Display.V1.FormattedValue'
+NEXT_LINK = '@odata.nextLink'
+MORE_RECORDS = '@Microsoft.Dynamics.CRM.morerecords'
+PAGING_COOKIE = '@Microsoft.Dynamics.CRM.fetchxmlpagingcookie'
+CHUNK_SIZE = 64 * 1024
+# status code of requests throttled by service protection limits
+THROTTLED = 429
+# 503 Service Unavailable is only retried when it says when to retry by Retry-After
+UNAVAILABLE = 503
+ETAG = '@odata.etag'
+# returned by _get when a conditional request is answered by 304 Not Modified
+NOT_MODIFIED = object()
+# marker of the end of a page yielded by _stream to a prefetching thread
+_PAGE_END = object()
 logger = logging.getLogger(__name__)
 
 
+class _Flight(object):
+    """A request in flight which concurrent identical requests wait for"""
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
 class Dynamics(object):
     """RESTful methods for communicating with MS Dynamics
 
@@ -21,17 +53,93 @@ class Dynamics(object):
     Most methods just need to know end point and query stings, some
     need to set headers.
     """
-    def __init__(self, connection):
+    def __init__(self, connection, json_loads=None, transport=None, coalesce=True, entity_cache_size=1024,
+                 annotations=True, prefetch=0, retries=0, max_retry_wait=60.0):
         """
         :param ADALConnection connection: ADAL connection instance
+        :param callable json_loads: function to decode a whole response body in bytes.
+                                    Default None: orjson.loads if it is installed or json.loads
+        :param object transport: what makes requests, it has a get method as requests.get.
+                                 Default None: requests module. See cassette module for
+                                 recording and replaying responses.
+        :param bool coalesce: concurrent get calls with the same end point and params share
+                              one request, default True
+        :param int entity_cache_size: number of entities kept by get_entity for revalidation, default 1024
+        :param bool annotations: ask the server for formatted values, default True. When it is False
+                                 (lean mode), Handler resolves formatted values locally from
+                                 cached metadata, see metadata module
+        :param int prefetch: pages iter_rows fetches ahead on a background thread while rows of
+                             the current page are processed, default 0: pages are fetched in the calling thread
+        :param int retries: times a throttled request is retried, default 0: a throttled request fails.
+                            429 and 503 with Retry-After are retried after the wait Retry-After asks for
+        :param float max_retry_wait: longest wait in seconds before a retry, a request which asks
+                                     for a longer wait fails, default 60
         """
         self._conn = connection
+        self._loads = json_loads if json_loads else default_loads()
+        self._transport = transport
+        self._listeners = []
+        self._coalesce = coalesce
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.entity_cache_size = entity_cache_size
+        self._entities = OrderedDict()
+        self._entities_lock = threading.Lock()
+        self.annotations = annotations
+        # MetadataCache of lean mode, created at its first use
+        self.metadata = None
+        self.prefetch = prefetch
+        self.retries = retries
+        self.max_retry_wait = max_retry_wait
+
+    def add_listener(self, listener):
+        """Add a callable which receives an event dict of every request, see metrics module"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def diagnose(self, threshold=diagnostics.DEFAULT_THRESHOLD):
+        """Context in which queries of the same shape repeated threshold times issue a warning
+
+        It returns a RequestTrace which counts requests by shape, see diagnostics module.
+        """
+        return diagnostics.diagnose(self, threshold)
+
+    def request_budget(self, budget, threshold=None):
+        """Context which raises RequestBudgetExceeded, an AssertionError, if it sends more than budget requests"""
+        return diagnostics.request_budget(self, budget, threshold)
+
+    def emit(self, event):
+        """Send an event to listeners, errors of listeners are logged but never raised"""
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as err:
+                logger.error('Listener %s failed: %s', listener, err)
+
+    def _start_event(self, end_point, url, params):
+        """Create an event of a request when there are listeners, otherwise None"""
+        if not self._listeners:
+            return None
+        return {'type': 'request', 'end_point': end_point_shape(end_point), 'operation': current_operation(),
+                'url': url, 'params': params, 'status': None, 'latency': 0.0, 'bytes': 0, 'rows': 0,
+                'pages': 1, 'page': 1, 'retries': 0, 'throttle_wait': 0.0, 'refreshes': 0, 'error': None,
+                'start': time.perf_counter()}
+
+    def _finish_event(self, event, error=None):
+        if event is None:
+            return
+        if error is not None:
+            event['error'] = type(error).__name__
+        event['elapsed'] = time.perf_counter() - event.pop('start')
+        self.emit(event)
 
     def _get_url_of(self, end_point):
         return '%s/api/data/v%s/%s' % (self._conn.resource, DYNAMICS_VER, end_point)
 
     @staticmethod
-    def construct_headers(other={}):
+    def construct_headers(other={}, page_size=None, annotations=True):
         # for POST, which has JSON data in request body, should include:
         # 'Content-Type': 'application/json'
         # Prefer header with key odata.include-annotations with one of the choices, to include:
@@ -54,22 +162,89 @@ class Dynamics(object):
         headers = {
             'OData-MaxVersion': '4.0',
             'OData-Version': '4.0',
-            'Accept': 'application/json',
-            'Prefer': 'odata.include-annotations=' + FORMATTED_VALUE_SUF
+            'Accept': 'application/json'
         }
+        prefers = []
+        if annotations:
+            prefers.append('odata.include-annotations=' + FORMATTED_VALUE_SUF)
+        if page_size:
+            prefers.append('odata.maxpagesize=%d' % page_size)
+        if prefers:
+            headers['Prefer'] = ','.join(prefers)
         headers.update(other)
         return headers
 
-    @staticmethod
-    def _get_content(url, headers, params={}):
+    def _get_content(self, url, headers, params={}, event=None):
         """Makes request at url and turn string to a JSON object
 
         Raises ConnectionError with status code.
         """
-        r = requests.get(url, headers=headers, params=params)
+        r = self._send(url, headers, params, event=event)
         if r.status_code == 200:
-            return r.json()
-        elif r.status_code == 401:
+            if event is not None:
+                event['bytes'] += len(r.content)
+            with phase('decode'):
+                return self._loads(r.content)
+        if r.status_code == 304:
+            return NOT_MODIFIED
+        self._handle_error(r)
+
+    def _send(self, url, headers, params, stream=False, event=None):
+        """Make a GET request, wait and retry when the server throttles and retries are enabled
+
+        Waits as long as Retry-After header asks or doubles the wait of
+        each retry of a 429 without the header. Gives up after retries
+        times or when the wait would be longer than max_retry_wait.
+        Latency, retries and waits are added to event if it is given.
+        """
+        if self._transport is None:
+            import requests
+            transport = requests
+        else:
+            transport = self._transport
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            with phase('network'):
+                r = transport.get(url, headers=headers, params=params, stream=stream)
+            if event is not None:
+                event['latency'] += time.perf_counter() - start
+                event['status'] = r.status_code
+            wait = self._retry_wait(r, attempt)
+            if wait is None:
+                return r
+            r.close()
+            attempt += 1
+            logger.warning('Request throttled with %d, retry %d in %.1f seconds', r.status_code, attempt, wait)
+            if event is not None:
+                event['retries'] += 1
+                event['throttle_wait'] += wait
+            time.sleep(wait)
+
+    def _retry_wait(self, r, attempt):
+        """Seconds to wait before retrying a response, None if it is not retried"""
+        if attempt >= self.retries or r.status_code not in (THROTTLED, UNAVAILABLE):
+            return None
+        try:
+            wait = float(r.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            if r.status_code == UNAVAILABLE:
+                # not throttling: the service is down
+                return None
+            wait = 2.0 ** attempt
+        if wait > self.max_retry_wait:
+            logger.warning('Request throttled with %d asks to wait %.1f seconds, longer than %.1f',
+                           r.status_code, wait, self.max_retry_wait)
+            return None
+        return wait
+
+    @staticmethod
+    def _handle_error(r):
+        """Log and raise errors of a failed request
+
+        Raises ConnectionError with status code when it is 401.
+        """
+        if r.status_code == 401:
             raise ConnectionError(r.status_code)
         else:
             # TODO: what error to raise? Is status code only enough?
@@ -87,17 +262,57 @@ class Dynamics(object):
             else:
                 raise LookupError(r.status_code)
 
-    def get(self, end_point, params={}):
+    def get(self, end_point, params={}, headers=None):
+        """Get content of an end point, identical concurrent calls share one request
+
+        When another thread is already getting the same end point with the
+        same params, wait for its result instead of sending a request. Every
+        caller receives its own copy of the result, or the error raised.
+
+        :param dict headers: extra headers, e.g. If-None-Match. NOT_MODIFIED is
+                             returned when the server responds 304
+        """
+        if not self._coalesce:
+            return self._get(end_point, params, headers)
+        key = (end_point, tuple(sorted(params.items())))
+        if headers:
+            key += (tuple(sorted(headers.items())), )
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+        if not leading:
+            logger.debug('Wait for the request in flight of %s', end_point)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+
+        try:
+            flight.result = self._get(end_point, params, headers)
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+        # followers copy the result, the leader's caller may change its own
+        return copy.deepcopy(flight.result) if flight.followers else flight.result
+
+    def _get(self, end_point, params={}, extra_headers=None):
         """Get method which tries twice
 
         First to use access_token. If access_token fails, it uses refresh
         token to get a new access_token, try again. If still fails, raise
         exception.
         """
-        # TODO: better to allow extra headers
-        # use case: formatted (most likely be useful)
-        #           lookup and navigation (so far only customer in Contact)
         def extract_value(raw_content):
+            if raw_content is NOT_MODIFIED:
+                return raw_content
             if 'value' in raw_content:
                 content = raw_content['value']
             elif '@odata.context' in raw_content:
@@ -110,18 +325,178 @@ class Dynamics(object):
 
         url = self._get_url_of(end_point)
         content = None
+        event = self._start_event(end_point, url, params)
         try:
-            headers = self.construct_headers(self._conn.generate_auth_header())
-            content = extract_value(self._get_content(url, headers, params))
-        except ConnectionError as err:
-            logger.debug("Debugging %s", str(err))
-            # refresh can fail
-            headers = self.construct_headers(self._conn.generate_auth_header(True))
-            # content = self._get_content(url, headers, params)
-            content = extract_value(self._get_content(url, headers, params))
-            # if still fails let caller know
+            try:
+                headers = self.construct_headers(dict(self._conn.generate_auth_header(), **(extra_headers or {})),
+                                                annotations=self.annotations)
+                content = extract_value(self._get_content(url, headers, params, event))
+            except ConnectionError as err:
+                logger.debug("Debugging %s", str(err))
+                if event is not None:
+                    event['refreshes'] += 1
+                # refresh can fail
+                headers = self.construct_headers(dict(self._conn.generate_auth_header(True), **(extra_headers or {})),
+                                                annotations=self.annotations)
+                # content = self._get_content(url, headers, params)
+                content = extract_value(self._get_content(url, headers, params, event))
+                # if still fails let caller know
+        except Exception as err:
+            self._finish_event(event, err)
+            raise
+        if event is not None:
+            event['rows'] = len(content) if isinstance(content, list) else int(content not in (None, NOT_MODIFIED))
+            self._finish_event(event)
         return content
 
+    def get_entity(self, end_point, params={}):
+        """Get a single entity, revalidate a cached one by its ETag
+
+        An entity which has @odata.etag is cached. The next get_entity of
+        the same end point and params sends If-None-Match with the ETag,
+        the cached entity is returned when the server responds 304 Not
+        Modified without a body. The least recently used entities are
+        dropped when there are more than entity_cache_size.
+
+        An entity with $expand in params is neither cached nor revalidated:
+        its ETag only changes with the entity itself, not with the expanded
+        entities, so 304 would return stale expanded entities.
+        """
+        if '$expand' in params:
+            return self.get(end_point, params)
+        key = (end_point, tuple(sorted(params.items())))
+        with self._entities_lock:
+            cached = self._entities.get(key)
+        headers = {'If-None-Match': cached[ETAG]} if cached is not None else None
+        content = self.get(end_point, params, headers)
+        if content is NOT_MODIFIED:
+            logger.debug('%s has not been modified', end_point)
+            with self._entities_lock:
+                if key in self._entities:
+                    self._entities.move_to_end(key)
+            return copy.deepcopy(cached)
+        if self.entity_cache_size and isinstance(content, dict) and ETAG in content:
+            with self._entities_lock:
+                self._entities[key] = copy.deepcopy(content)
+                self._entities.move_to_end(key)
+                while len(self._entities) > self.entity_cache_size:
+                    self._entities.popitem(last=False)
+        return content
+
+    def _open_stream(self, url, params, page_size, event=None):
+        """Start a streamed request, refresh token once if access_token fails"""
+        for refresh in (False, True):
+            if refresh and event is not None:
+                event['refreshes'] += 1
+            headers = self.construct_headers(self._conn.generate_auth_header(refresh), page_size, self.annotations)
+            r = self._send(url, headers, params, stream=True, event=event)
+            if r.status_code == 200:
+                return r
+            try:
+                self._handle_error(r)
+            except ConnectionError as err:
+                if refresh:
+                    raise
+                logger.debug("Debugging %s", str(err))
+            else:
+                return None
+            finally:
+                if r.status_code != 200:
+                    r.close()
+
+    def iter_rows(self, end_point, params={}, page_size=None, prefetch=None):
+        """Get rows of a query page by page, decode them while bytes arrive
+
+        Pages are followed by @odata.nextLink or by FetchXML paging cookie
+        when params has fetchXml. When prefetch is 0, rows of the value array
+        are yielded as soon as they are decoded. Otherwise pages are fetched
+        and decoded by a background thread, up to prefetch pages ahead of
+        the caller, so waiting for the network overlaps processing of rows.
+
+        :param str end_point: end point of an entity set
+        :param dict params: query parameters
+        :param int page_size: maximum rows of a page (odata.maxpagesize), default None: server decides
+        :param int prefetch: pages to fetch ahead, default None: prefetch of the instance
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        if prefetch > 0:
+            return self._prefetched(end_point, params, page_size, prefetch)
+        return self._stream(end_point, params, page_size)
+
+    def _prefetched(self, end_point, params, page_size, depth):
+        """Rows of pages fetched by a background thread, at most depth pages wait for the caller"""
+        pipe = Pipe(depth)
+
+        def produce():
+            stream = self._stream(end_point, params, page_size, _PAGE_END)
+            rows = []
+            try:
+                for row in stream:
+                    if row is not _PAGE_END:
+                        rows.append(row)
+                    elif pipe.put(rows):
+                        rows = []
+                    else:
+                        # the caller has stopped iterating
+                        return
+                if rows:
+                    pipe.put(rows)
+                pipe.close()
+            except Exception as err:
+                pipe.put(err)
+            finally:
+                stream.close()
+
+        worker = threading.Thread(target=bind(produce), name='prefetch-' + end_point, daemon=True)
+        worker.start()
+        yield from pipe.rows()
+
+    def _stream(self, end_point, params, page_size, page_end=None):
+        """Rows of all pages in the calling thread, page_end is yielded after each page if it is given"""
+        def counted(chunks, event):
+            for chunk in chunks:
+                event['bytes'] += len(chunk)
+                yield chunk
+
+        url = self._get_url_of(end_point)
+        params = dict(params)
+        page = 0
+        while url:
+            page += 1
+            event = self._start_event(end_point, url, params)
+            if event is not None:
+                event['page'] = page
+            error = None
+            try:
+                r = self._open_stream(url, params, page_size, event)
+                if r is None:
+                    return
+                with r:
+                    chunks = timed(r.iter_content(CHUNK_SIZE), 'network')
+                    decoder = StreamingDecoder(chunks if event is None else counted(chunks, event))
+                    for row in timed(decoder, 'decode'):
+                        if event is not None:
+                            event['rows'] += 1
+                        yield row
+                if not decoder.has_value:
+                    logger.error("No value key!!!")
+                    raise ValueError('Unqualified query result: no value key.')
+            except Exception as err:
+                error = err
+                raise
+            finally:
+                self._finish_event(event, error)
+            if page_end is not None:
+                yield page_end
+
+            annotations = decoder.annotations
+            if NEXT_LINK in annotations:
+                url, params = annotations[NEXT_LINK], {}
+            elif 'fetchXml' in params and annotations.get(MORE_RECORDS):
+                params['fetchXml'] = FetchXML.next_page(params['fetchXml'], annotations.get(PAGING_COOKIE))
+            else:
+                url = None
+
     def get_accounts(self):
         try:
             accounts = self.get('accounts')
@@ -150,6 +525,8 @@ class Dynamics(object):
 
 
 if __name__ == "__main__":
+    from .connection import ADALConnection
+
     conf = 'conf.json'
     with open(conf, 'r') as jf:
         parameters = json.load(jf)
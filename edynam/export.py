@@ -0,0 +1,229 @@
+"""Stream rows to JSONL, CSV or Parquet files
+
+Rows are written as they come, e.g. from Handler.scan which streams pages,
+so memory use does not grow with the number of rows:
+
+    Contact(backend).export('contacts.jsonl.gz')
+    export_rows(Order(backend).get_product(product_id, roles=roles), 'orders.csv')
+
+A file is written to a temporary file next to it and renamed when all rows
+have been written, readers never see a half written file. A path ending
+with .gz is compressed by gzip, Parquet files are compressed by their own
+codecs.
+
+pyarrow is required by Parquet: pip install pyarrow. It is imported at the first
+Parquet export, it is slow to import.
+"""
+import os
+import csv
+import gzip
+import json
+import logging
+import tempfile
+
+from .files import created_mode
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+# rows of a Parquet row group, they are the rows kept in memory
+BATCH_SIZE = 10000
+# rows between two reports of progress
+PROGRESS_EVERY = 10000
+
+
+def format_of(path):
+    """Format of a file by its extension, compression extension .gz is ignored, jsonl if it is unknown"""
+    name = path[:-3] if path.endswith('.gz') else path
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    if extension == 'json':
+        return 'jsonl'
+    return extension if extension in FORMATS else 'jsonl'
+
+
+def _import_pyarrow():
+    """pyarrow with pyarrow.parquet, None if it is not installed"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def _as_dict(row):
+    """Rows of Handlers in records mode are converted to dicts"""
+    return row if isinstance(row, dict) else row.to_dict()
+
+
+def _log_progress(count, path):
+    logger.info('Exported %d rows to %s', count, path)
+
+
+class _Progress(object):
+    def __init__(self, path, callback, every):
+        self.path = path
+        self.callback = callback if callback else _log_progress
+        self.every = every
+        self.count = 0
+
+    def step(self):
+        self.count += 1
+        if self.every and self.count % self.every == 0:
+            self.callback(self.count, self.path)
+
+    def finish(self):
+        if not self.every or self.count % self.every:
+            self.callback(self.count, self.path)
+
+
+def _write_jsonl(rows, output, progress):
+    for row in rows:
+        output.write(json.dumps(_as_dict(row), default=str) + '\n')
+        progress.step()
+
+
+def _write_csv(rows, output, progress, fields):
+    writer = None
+    for row in rows:
+        row = _as_dict(row)
+        if writer is None:
+            # keys which are not fields are dropped, keys of later rows which are not in the first raise ValueError
+            writer = csv.DictWriter(output, fieldnames=list(fields) if fields else list(row.keys()),
+                                    extrasaction='ignore' if fields else 'raise')
+            writer.writeheader()
+        writer.writerow(row)
+        progress.step()
+
+
+def _columns_of(batch, columns):
+    """Columns of a batch: keys in the order they appear, or columns checked against its keys
+
+    Rows of a file share its columns. A key which is not one of them raises
+    ValueError instead of being dropped.
+    """
+    if columns is None:
+        return list(dict.fromkeys(key for row in batch for key in row))
+    known = set(columns)
+    unknown = sorted(set(key for row in batch for key in row if key not in known))
+    if unknown:
+        raise ValueError('Rows have keys %s which are not columns %s of the first rows, pass fields to export them'
+                         % (', '.join(unknown), ', '.join(columns)))
+    return columns
+
+
+def _rewrite_parquet(pyarrow, temp_path, schema, compression):
+    """Rewrite row groups written so far as schema, returns a writer which appends to the rewritten file"""
+    folder = os.path.dirname(temp_path)
+    fd, written_path = tempfile.mkstemp(dir=folder, prefix=os.path.basename(temp_path))
+    os.close(fd)
+    os.replace(temp_path, written_path)
+    try:
+        writer = pyarrow.parquet.ParquetWriter(temp_path, schema, compression=compression)
+        for batch in pyarrow.parquet.ParquetFile(written_path).iter_batches():
+            writer.write_table(pyarrow.Table.from_batches([batch]).cast(schema))
+    finally:
+        os.unlink(written_path)
+    return writer
+
+
+def _write_parquet(pyarrow, rows, temp_path, progress, fields, compression, batch_size):
+    """Write rows in row groups of batch_size rows
+
+    Types of columns are inferred from rows and promoted when a later batch
+    needs a wider type, e.g. int to float or a column which has only been
+    null to the type of its first value. Row groups written before are
+    rewritten once for every promotion. Types which cannot be promoted, e.g.
+    a number after a string, raise pyarrow.ArrowTypeError.
+    """
+    writer, schema, batch = None, None, []
+    columns = list(fields) if fields else None
+
+    def flush():
+        nonlocal writer, schema, columns
+        if fields:
+            names = columns
+        else:
+            names = columns = _columns_of(batch, columns)
+        table = pyarrow.Table.from_pydict({name: [row.get(name) for row in batch] for name in names})
+        if schema is None:
+            schema = table.schema
+            writer = pyarrow.parquet.ParquetWriter(temp_path, schema, compression=compression)
+        elif table.schema != schema:
+            wider = pyarrow.unify_schemas([schema, table.schema], promote_options='permissive')
+            if wider != schema:
+                logger.debug('Promote columns of %s from %s to %s', temp_path, schema, wider)
+                writer.close()
+                writer = None
+                writer = _rewrite_parquet(pyarrow, temp_path, wider, compression)
+                schema = wider
+            table = table.cast(schema)
+        writer.write_table(table)
+        batch.clear()
+
+    try:
+        for row in rows:
+            batch.append(_as_dict(row))
+            progress.step()
+            if len(batch) == batch_size:
+                flush()
+        if batch or writer is None:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def export_rows(rows, path, fmt=None, compress=None, fields=None, progress=None,
+                progress_every=PROGRESS_EVERY, batch_size=BATCH_SIZE):
+    """Write rows to a file atomically while they are iterated
+
+    :param iterable rows: dicts or records, e.g. a generator of Handler.scan
+    :param str path: path of the file, it is replaced only when all rows have been written
+    :param str fmt: one of jsonl, csv and parquet, default None: by extension of path, see format_of
+    :param bool compress: compress the file, default None: when path ends with .gz. For Parquet,
+                          True uses gzip codec instead of the default snappy
+    :param list fields: names of columns of csv and parquet, other keys are dropped. Default None:
+                        keys of the first row (of the first batch of Parquet), other keys raise ValueError
+    :param callable progress: called with number of rows written and path every progress_every rows
+                              and at the end, default None: logged at INFO level
+    :param int batch_size: rows of a Parquet row group
+    :return int: number of rows written
+    """
+    fmt = fmt if fmt else format_of(path)
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format %s, supported formats: %s' % (fmt, ', '.join(FORMATS)))
+    pyarrow = None
+    if fmt == 'parquet':
+        pyarrow = _import_pyarrow()
+        if pyarrow is None:
+            raise RuntimeError('pyarrow is required by Parquet export, install it by pip install pyarrow')
+    if compress is None:
+        compress = path.endswith('.gz')
+    counter = _Progress(path, progress, progress_every)
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path))
+    try:
+        if fmt == 'parquet':
+            os.close(fd)
+            _write_parquet(pyarrow, rows, temp_path, counter, fields, 'gzip' if compress else 'snappy', batch_size)
+        else:
+            if compress:
+                os.close(fd)
+                opened = gzip.open(temp_path, 'wt', newline='')
+            else:
+                opened = os.fdopen(fd, 'w', newline='')
+            with opened as output:
+                if fmt == 'jsonl':
+                    _write_jsonl(rows, output, counter)
+                else:
+                    _write_csv(rows, output, counter, fields)
+        # mkstemp creates the file readable only by its owner, give it the mode open() would
+        os.chmod(temp_path, created_mode())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    counter.finish()
+    return counter.count
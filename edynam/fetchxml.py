@@ -1,8 +1,13 @@
 import re
+import threading
+from urllib.parse import unquote
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 
 class FetchXML(object):
     palias = re.compile('^[A-Za-z_][a-zA-Z0-9_]{0,}$')
+    # Dynamics rejects a query which has more than 10 link-entity elements
+    MAX_LINK_ENTITIES = 10
 
     @staticmethod
     def create_fetch(distinct=False):
@@ -79,10 +84,137 @@ class FetchXML(object):
             attribs['value'] = value
         return FetchXML.create_sub_elm(elm, 'condition', attribs)
 
+    @staticmethod
+    def create_in_condition(elm, target, values):
+        """Create condition element of in operator in filter element
+
+        :param element elm: filter element
+        :param str target: name of attribute
+        :param list values: values the attribute can be
+        """
+        condition = FetchXML.create_sub_elm(elm, 'condition', {'attribute': target, 'operator': 'in'})
+        for value in values:
+            FetchXML.create_sub_elm(condition, 'value').text = value
+        return condition
+
     @staticmethod
     def to_string(elm):
         return ET.tostring(elm, 'unicode')
 
+    @staticmethod
+    def count_links(elm):
+        """Count link-entity elements in an element and its descendants"""
+        return sum(1 for _ in elm.iter('link-entity'))
+
+    @staticmethod
+    def split_links(sizes, fixed=0, limit=None):
+        """Pack groups of link-entities into as few queries as possible
+
+        Groups are packed in their original order by first fit, no group is broken.
+        Raises ValueError if a group cannot fit into a query.
+
+        :param list sizes: number of link-entities of each group
+        :param int fixed: number of link-entities every query has, default 0
+        :param int limit: maximum link-entities of a query, default MAX_LINK_ENTITIES
+        :return list: each item is a list of indexes of groups in a query
+        """
+        if limit is None:
+            limit = FetchXML.MAX_LINK_ENTITIES
+        budget = limit - fixed
+        queries, used = [], []
+        for i, size in enumerate(sizes):
+            if size > budget:
+                raise ValueError('A group of %d link-entities cannot fit in a query with %d fixed link-entities' % (size, fixed))
+            for j, query in enumerate(queries):
+                if used[j] + size <= budget:
+                    query.append(i)
+                    used[j] += size
+                    break
+            else:
+                queries.append([i])
+                used.append(size)
+        return queries or [[]]
+
+    @staticmethod
+    def next_page(fetch_xml, paging_cookie=None):
+        """Create the query of the next page of a FetchXML query
+
+        :param str fetch_xml: query of current page
+        :param str paging_cookie: value of @Microsoft.Dynamics.CRM.fetchxmlpagingcookie
+                                  of current page, default None
+        :return str: query of the next page
+        """
+        # paging cookie looks like:
+        # <cookie pagenumber="2" pagingcookie="%253ccookie%2520page%253d%25221%2522%253e...%253c%252fcookie%253e" istracking="False" />
+        fetch = ET.fromstring(fetch_xml)
+        page = int(fetch.get('page', '1')) + 1
+        if paging_cookie:
+            cookie = ET.fromstring(paging_cookie)
+            page = int(cookie.get('pagenumber', page))
+            if cookie.get('pagingcookie'):
+                fetch.set('paging-cookie', unquote(unquote(cookie.get('pagingcookie'))))
+        fetch.set('page', str(page))
+        return FetchXML.to_string(fetch)
+
+    @staticmethod
+    def param(name):
+        """Placeholder of a value to be substituted when a template is rendered
+
+        :param str name: name of the parameter, follows the same rule as alias
+        """
+        assert FetchXML.palias.match(name)
+        return '${%s}' % name
+
+
+class FetchXMLTemplate(object):
+    """A FetchXML query serialised once with named placeholders of values
+
+    Structure of a query (entity, link-entities, aliases, filters) is built
+    by FetchXML methods with FetchXML.param(name) as values of conditions.
+    Only values are substituted and escaped when it is rendered.
+    """
+    PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][a-zA-Z0-9_]*)\}')
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, fetch):
+        """
+        :param element fetch: the root element created by FetchXML.create_fetch
+        """
+        # odd items are names of parameters, even items are literal strings
+        self._parts = self.PLACEHOLDER.split(FetchXML.to_string(fetch))
+        self.params = frozenset(self._parts[1::2])
+
+    def render(self, **values):
+        """Substitute parameters with escaped values
+
+        Raises KeyError if any parameter has no value.
+        """
+        parts = list(self._parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = escape(str(values[parts[i]]), {'"': '&quot;'})
+        return ''.join(parts)
+
+    @classmethod
+    def get(cls, key, builder):
+        """Get a cached template of a query shape, build it if it has not been seen
+
+        :param hashable key: identity of the shape of a query
+        :param callable builder: returns the root element of the query with placeholders
+        """
+        template = cls._cache.get(key)
+        if template is None:
+            template = cls(builder())
+            with cls._lock:
+                template = cls._cache.setdefault(key, template)
+        return template
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cache.clear()
+
 if __name__ == '__main__':
     fetcher = FetchXML
     fetch = fetcher.create_fetch(True)
@@ -0,0 +1,20 @@
+"""Modes of files written to a temporary file and moved into place
+
+Exports and metrics files are written to a file created by tempfile.mkstemp,
+which only its owner can read, and replace the target when they are complete.
+Before the replace they are given the mode open() would give a new file:
+
+    os.chmod(temp_path, created_mode())
+
+umask can only be read by setting it, which changes it for all threads of the
+process for a moment. It is read once when this module is imported.
+"""
+import os
+
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def created_mode():
+    """Mode open() gives a new file under the umask of the process"""
+    return 0o666 & ~UMASK
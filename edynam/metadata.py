@@ -0,0 +1,310 @@
+"""Formatted values resolved locally from cached metadata
+
+By default every request asks for formatted values with the Prefer header
+odata.include-annotations, so every option, lookup and date field arrives
+twice. In lean mode the annotations are not asked for:
+
+    backend = Dynamics(conn, annotations=False)
+    Contact(backend).list()
+
+Handler then fills the xxx@OData.Community.Display.V1.FormattedValue keys
+itself, so MAPS works as before:
+  - labels of options, states, statuses and two options attributes come from
+    attribute metadata of the entity, loaded once per entity;
+  - names of lookups come from a cache of names of the referenced entities,
+    names not in the cache are queried in batches;
+  - dates are formatted in the local time zone as Dynamics formats them for
+    users, e.g. 20/10/2016 11:49 AM.
+
+Rows of FetchXML queries of Handler methods, e.g. Order.get_product, are
+annotated by the attributes their keys come from: an aliased attribute of
+the entity or a link-entity, or an attribute of the entity by its name.
+Attributes of link-entities which have no alias are not annotated.
+
+Other types of values, e.g. money, are not formatted.
+"""
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+
+from .dynamics import FORMATTED_VALUE_SUF
+
+logger = logging.getLogger(__name__)
+
+# types of attribute metadata whose values have labels
+OPTION_TYPES = ('PicklistAttributeMetadata', 'StateAttributeMetadata', 'StatusAttributeMetadata')
+# number of ids in a query of names of lookups
+NAME_BATCH = 50
+# number of rows of a stream annotated together
+CHUNK_SIZE = 500
+
+
+def _label(label):
+    """Label of user's language of a Label complex type, '' when it has none"""
+    user = label.get('UserLocalizedLabel') if label else None
+    return user.get('Label', '') if user else ''
+
+
+def format_datetime(value, tz=None):
+    """Format a date time in UTC as Dynamics does: 20/10/2016 11:49 AM
+
+    :param str value: ISO 8601 date time in UTC, or a date which is formatted as 20/10/2016
+    :param tzinfo tz: time zone to convert to, default None: local time zone
+    """
+    if 'T' not in value:
+        year, month, day = value.split('-')
+        return '%s/%s/%s' % (day, month, year)
+    moment = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).astimezone(tz)
+    return '%02d/%02d/%d %d:%02d %s' % (moment.day, moment.month, moment.year, moment.hour % 12 or 12,
+                                        moment.minute, 'AM' if moment.hour < 12 else 'PM')
+
+
+def fetch_columns(fetch_xml):
+    """Keys of rows of a FetchXML query and the attributes they come from
+
+    :param str fetch_xml: a FetchXML query
+    :return dict: key -> (logical name of entity, attribute, if key is an alias)
+    """
+    columns = {}
+
+    def walk(elm, top):
+        for attribute in elm.findall('attribute'):
+            alias = attribute.get('alias')
+            if alias:
+                columns[alias] = (elm.get('name'), attribute.get('name'), True)
+            elif top:
+                columns[attribute.get('name')] = (elm.get('name'), attribute.get('name'), False)
+        for link in elm.findall('link-entity'):
+            walk(link, False)
+
+    entity = ET.fromstring(fetch_xml).find('entity')
+    if entity is not None:
+        walk(entity, True)
+    return columns
+
+
+class EntityMetadata(object):
+    """What is needed to format values of attributes of an entity"""
+
+    def __init__(self, logical_name, entity_set=None, primary_id=None, primary_name=None):
+        self.logical_name = logical_name
+        self.entity_set = entity_set
+        self.primary_id = primary_id
+        self.primary_name = primary_name
+        # attribute -> {value: label}
+        self.options = {}
+        # attribute -> logical names of entities it can reference
+        self.lookups = {}
+        self.dates = set()
+
+    def target_of(self, navigation):
+        """Logical name of the entity of an expanded navigation property, None if it is unknown
+
+        A navigation property of a lookup which references only one entity has the
+        name of the lookup, otherwise it is suffixed by the entity, e.g. parentcustomerid_account.
+        """
+        targets = self.lookups.get(navigation)
+        if targets:
+            return targets[0] if len(targets) == 1 else None
+        attribute, _, target = navigation.rpartition('_')
+        return target if target in self.lookups.get(attribute, ()) else None
+
+
+class MetadataCache(object):
+    """Metadata of entities and names of referenced entities, loaded once"""
+
+    def __init__(self, backend, tz=None):
+        """
+        :param Dynamics backend: instance of Dynamics
+        :param tzinfo tz: time zone of formatted dates, default None: local time zone
+        """
+        self._backend = backend
+        self.tz = tz
+        self._lock = threading.RLock()
+        self._entities = {}
+        # logical name of entity -> {id: name}
+        self._names = {}
+
+    @classmethod
+    def of(cls, backend):
+        """The cache of a backend, created at the first call"""
+        if getattr(backend, 'metadata', None) is None:
+            backend.metadata = cls(backend)
+        return backend.metadata
+
+    def entity(self, logical_name):
+        """Metadata of an entity by its logical name, e.g. contact
+
+        An entity whose metadata cannot be retrieved has no attributes to format.
+        """
+        with self._lock:
+            if logical_name not in self._entities:
+                try:
+                    self._entities[logical_name] = self._load(logical_name)
+                except LookupError as err:
+                    logger.warning('No metadata of entity %s: %s', logical_name, err)
+                    self._entities[logical_name] = EntityMetadata(logical_name)
+            return self._entities[logical_name]
+
+    def _attributes(self, base, metadata_type, select, expand=None):
+        params = {'$select': select}
+        if expand:
+            params['$expand'] = expand
+        return self._backend.get('%s/Attributes/Microsoft.Dynamics.CRM.%s' % (base, metadata_type), params)
+
+    def _load(self, logical_name):
+        base = "EntityDefinitions(LogicalName='%s')" % logical_name
+        definition = self._backend.get(base, {'$select': 'LogicalName,EntitySetName,PrimaryIdAttribute,PrimaryNameAttribute'})
+        meta = EntityMetadata(logical_name, definition.get('EntitySetName'),
+                              definition.get('PrimaryIdAttribute'), definition.get('PrimaryNameAttribute'))
+        for metadata_type in OPTION_TYPES:
+            for attribute in self._attributes(base, metadata_type, 'LogicalName', 'OptionSet($select=Options)'):
+                meta.options[attribute['LogicalName']] = {option['Value']: _label(option['Label'])
+                                                          for option in attribute['OptionSet']['Options']}
+        for attribute in self._attributes(base, 'BooleanAttributeMetadata', 'LogicalName',
+                                          'OptionSet($select=TrueOption,FalseOption)'):
+            option_set = attribute['OptionSet']
+            meta.options[attribute['LogicalName']] = {True: _label(option_set['TrueOption']['Label']),
+                                                      False: _label(option_set['FalseOption']['Label'])}
+        for attribute in self._attributes(base, 'LookupAttributeMetadata', 'LogicalName,Targets'):
+            meta.lookups[attribute['LogicalName']] = attribute['Targets']
+        for attribute in self._attributes(base, 'DateTimeAttributeMetadata', 'LogicalName'):
+            meta.dates.add(attribute['LogicalName'])
+        logger.debug('Loaded metadata of %s: %d option and %d lookup attributes',
+                     logical_name, len(meta.options), len(meta.lookups))
+        return meta
+
+    def names(self, logical_name, ids):
+        """Names of entities by their ids, None for those not found
+
+        Names which have not been cached are queried in batches of NAME_BATCH.
+        """
+        meta = self.entity(logical_name)
+        ids = [entity_id.lower() for entity_id in ids]
+        with self._lock:
+            cache = self._names.setdefault(logical_name, {})
+            missing = sorted(set(ids).difference(cache))
+        if missing and meta.entity_set and meta.primary_name:
+            for i in range(0, len(missing), NAME_BATCH):
+                batch = missing[i:i + NAME_BATCH]
+                params = {'$select': '%s,%s' % (meta.primary_id, meta.primary_name),
+                          '$filter': ' or '.join('%s eq %s' % (meta.primary_id, entity_id) for entity_id in batch)}
+                try:
+                    rows = self._backend.get(meta.entity_set, params)
+                except LookupError as err:
+                    logger.warning('Failed to get names of %s: %s', logical_name, err)
+                    rows = []
+                with self._lock:
+                    for row in rows:
+                        cache[row[meta.primary_id].lower()] = row.get(meta.primary_name)
+                    for entity_id in batch:
+                        cache.setdefault(entity_id, None)
+        return {entity_id: cache.get(entity_id) for entity_id in ids}
+
+    def _resolve_lookups(self, meta, rows):
+        """Names of values of all lookups of rows: {(attribute, lowercase id): name}"""
+        wanted = {}
+        for row in rows:
+            for key, value in row.items():
+                if value and key.startswith('_') and key.endswith('_value') and key[1:-6] in meta.lookups:
+                    wanted.setdefault(key[1:-6], set()).add(value)
+        resolved = {}
+        for attribute, ids in wanted.items():
+            for target in meta.lookups[attribute]:
+                found = self.names(target, ids)
+                for entity_id, name in found.items():
+                    if name is not None:
+                        resolved.setdefault((attribute, entity_id), name)
+        return resolved
+
+    def annotate(self, logical_name, rows):
+        """Add formatted values to rows of an entity in place
+
+        :param str logical_name: logical name of the entity of rows
+        :param list rows: dicts of raw entities, expanded lookups are annotated too
+        :return list: rows
+        """
+        meta = self.entity(logical_name)
+        names = self._resolve_lookups(meta, rows)
+        expanded = {}
+        for row in rows:
+            formatted = {}
+            for key, value in row.items():
+                if value is None or '@' in key:
+                    continue
+                if isinstance(value, dict):
+                    target = meta.target_of(key)
+                    if target:
+                        expanded.setdefault(target, []).append(value)
+                    continue
+                if key.startswith('_') and key.endswith('_value') and key[1:-6] in meta.lookups:
+                    label = names.get((key[1:-6], str(value).lower()))
+                elif key in meta.options:
+                    label = meta.options[key].get(value)
+                elif key in meta.dates:
+                    label = format_datetime(value, self.tz)
+                else:
+                    continue
+                if label is not None:
+                    formatted[key + '@' + FORMATTED_VALUE_SUF] = label
+            row.update(formatted)
+        for target, nested in expanded.items():
+            self.annotate(target, nested)
+        return rows
+
+    def _lookup_labels(self, targets, values):
+        """Names of ids of a lookup which can reference targets: {lowercase id: name}"""
+        ids = set(str(value).lower() for value in values)
+        labels = {}
+        for target in targets:
+            for entity_id, name in self.names(target, ids).items():
+                if name is not None:
+                    labels.setdefault(entity_id, name)
+        return labels
+
+    def annotate_fetch(self, fetch_xml, rows):
+        """Add formatted values to rows of a FetchXML query in place, see fetch_columns
+
+        A lookup of the entity which is not aliased is in rows as _xxx_value,
+        aliased lookups are in rows by their aliases.
+
+        :param str fetch_xml: the query rows are results of
+        :param list rows: dicts of results
+        :return list: rows
+        """
+        for key, (logical_name, attribute, aliased) in fetch_columns(fetch_xml).items():
+            meta = self.entity(logical_name)
+            if attribute in meta.lookups:
+                key = key if aliased else '_%s_value' % attribute
+            elif attribute not in meta.options and attribute not in meta.dates:
+                continue
+            values = [row[key] for row in rows if row.get(key) is not None]
+            if not values:
+                continue
+            if attribute in meta.lookups:
+                labels = self._lookup_labels(meta.lookups[attribute], values)
+                label_of = lambda value: labels.get(str(value).lower())
+            elif attribute in meta.options:
+                label_of = meta.options[attribute].get
+            else:
+                label_of = lambda value: format_datetime(value, self.tz)
+            formatted_key = key + '@' + FORMATTED_VALUE_SUF
+            for row in rows:
+                value = row.get(key)
+                if value is not None:
+                    label = label_of(value)
+                    if label is not None:
+                        row[formatted_key] = label
+        return rows
+
+    def annotate_iter(self, logical_name, rows, chunk_size=CHUNK_SIZE):
+        """Annotate a stream of rows a chunk at a time, lookups of a chunk are resolved together"""
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from self.annotate(logical_name, chunk)
+                chunk = []
+        if chunk:
+            yield from self.annotate(logical_name, chunk)
@@ -0,0 +1,288 @@
+"""Instrumentation of requests to Dynamics and Handler calls
+
+Dynamics emits an event to its listeners for every page it requests:
+
+    {'type': 'request', 'end_point': 'salesorderdetails({id})', 'operation': 'OrderDetail.get_products_of',
+     'status': 200, 'latency': 0.21, 'elapsed': 0.35, 'bytes': 53211, 'rows': 120, 'pages': 1, 'page': 1,
+     'retries': 0, 'throttle_wait': 0.0, 'refreshes': 0, 'error': None, 'url': ..., 'params': ...}
+
+latency is the time until response headers arrive, elapsed includes reading
+and decoding the body. page is the number of the page of a query iter_rows
+follows. Handler methods decorated by measured emit
+
+    {'type': 'operation', 'operation': 'Order.get_product', 'elapsed': 2.1, 'rows': 300, 'error': None}
+
+A listener is any callable. MetricsRegistry is one which aggregates events
+and exports them in Prometheus text format or JSON:
+
+    registry = MetricsRegistry()
+    backend.add_listener(registry)
+    ... run reports ...
+    registry.to_prometheus('/var/lib/node_exporter/edynam.prom')
+"""
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+import functools
+
+from . import profiler
+from .files import created_mode
+
+_local = threading.local()
+_KEY = re.compile(r'\([^)]+\)')
+
+
+def end_point_shape(end_point):
+    """Replace keys in an end point by {id}, e.g. salesorders(abc) -> salesorders({id})"""
+    return _KEY.sub('({id})', end_point)
+
+
+def current_operation():
+    """Name of the outermost measured Handler call of current thread, None if there is none
+
+    Requests of Handler methods called by another, e.g. list called by
+    get_products_of, are counted to the method which was called first.
+    """
+    stack = getattr(_local, 'operations', None)
+    return stack[0] if stack else None
+
+
+def bind(func):
+    """Wrap func to label requests it makes in another thread with the operation of current thread
+
+    The profiled call of current thread is carried as profiler.bind does.
+    """
+    func = profiler.bind(func)
+    operation = current_operation()
+    if operation is None:
+        return func
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'operations', None)
+        _local.operations = [operation]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.operations = previous
+    return bound
+
+
+def measured(func):
+    """Decorator of Handler methods: label requests made inside and emit an operation event
+
+    Requests made during the call are labelled with ClassName.method in
+    their events. When the call ends, an operation event is emitted to
+    listeners of the backend of the Handler. Calls are profiled when
+    profiler.profile is active.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        name = '%s.%s' % (type(self).__name__, func.__name__)
+        stack = getattr(_local, 'operations', None)
+        if stack is None:
+            stack = _local.operations = []
+        stack.append(name)
+        start = time.perf_counter()
+        error = None
+        result = None
+        try:
+            with profiler.call(name):
+                result = func(self, *args, **kwargs)
+            return result
+        except Exception as err:
+            error = type(err).__name__
+            raise
+        finally:
+            stack.pop()
+            emit = getattr(self._backend, 'emit', None)
+            if emit is not None:
+                emit({'type': 'operation', 'operation': name, 'elapsed': time.perf_counter() - start,
+                      'rows': len(result) if isinstance(result, (list, dict)) else None, 'error': error})
+    return wrapper
+
+
+class Histogram(object):
+    """Cumulative histogram in the way of Prometheus, its memory does not grow with observations"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def percentile(self, p):
+        """Estimate of a percentile from bucket counts as histogram_quantile of Prometheus does
+
+        Values are assumed to spread evenly in a bucket, the percentile is
+        interpolated between its bounds. Above the highest bound it is the
+        highest bound.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        lower, below = 0.0, 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                if count == below:
+                    return bound
+                return lower + (bound - lower) * (rank - below) / (count - below)
+            lower, below = bound, count
+        return self.buckets[-1] if self.buckets else None
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip((str(bound) for bound in self.buckets), self.counts)),
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class MetricsRegistry(object):
+    """In-process aggregation of events of Dynamics and Handler calls
+
+    Requests are grouped by end point shape and operation, Handler calls by
+    operation. It is a listener: add it to Dynamics by add_listener.
+    """
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    # counters of request events: name in event -> name of metric
+    COUNTERS = (('bytes', 'response_bytes_total'),
+                ('rows', 'rows_total'),
+                ('pages', 'pages_total'),
+                ('retries', 'retries_total'),
+                ('refreshes', 'token_refreshes_total'),
+                ('throttle_wait', 'throttle_wait_seconds_total'))
+
+    def __init__(self, buckets=None, prefix='edynam'):
+        """
+        :param tuple buckets: upper bounds in seconds of latency histograms, default LATENCY_BUCKETS
+        :param str prefix: prefix of names of exported metrics
+        """
+        self.buckets = buckets if buckets else self.LATENCY_BUCKETS
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.operations = {}
+
+    def __call__(self, event):
+        with self._lock:
+            if event['type'] == 'request':
+                key = (event['end_point'], event.get('operation') or '')
+                if key not in self.requests:
+                    self.requests[key] = {'latency': Histogram(self.buckets), 'requests_total': 0, 'errors_total': 0}
+                    self.requests[key].update((name, 0) for _, name in self.COUNTERS)
+                metrics = self.requests[key]
+                metrics['latency'].observe(event['latency'])
+                metrics['requests_total'] += 1
+                if event.get('error'):
+                    metrics['errors_total'] += 1
+                for field, name in self.COUNTERS:
+                    metrics[name] += event.get(field) or 0
+            elif event['type'] == 'operation':
+                name = event['operation']
+                if name not in self.operations:
+                    self.operations[name] = {'duration': Histogram(self.buckets), 'calls_total': 0,
+                                             'rows_total': 0, 'errors_total': 0}
+                metrics = self.operations[name]
+                metrics['duration'].observe(event['elapsed'])
+                metrics['calls_total'] += 1
+                metrics['rows_total'] += event.get('rows') or 0
+                if event.get('error'):
+                    metrics['errors_total'] += 1
+
+    def snapshot(self):
+        """Current metrics as a dict which can be dumped as JSON"""
+        with self._lock:
+            requests = []
+            for (end_point, operation), metrics in sorted(self.requests.items()):
+                item = {'end_point': end_point, 'operation': operation}
+                for name, value in metrics.items():
+                    item[name] = value.to_dict() if isinstance(value, Histogram) else value
+                requests.append(item)
+            operations = []
+            for name, metrics in sorted(self.operations.items()):
+                item = {'operation': name}
+                for metric, value in metrics.items():
+                    item[metric] = value.to_dict() if isinstance(value, Histogram) else value
+                operations.append(item)
+        return {'requests': requests, 'operations': operations}
+
+    def to_json(self, path=None):
+        """Export metrics as JSON, write to path if it is given
+
+        :return str: JSON string
+        """
+        text = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        if path:
+            _write_atomic(path, text)
+        return text
+
+    @staticmethod
+    def _labels(**labels):
+        return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+    def _histogram_lines(self, name, histogram, **labels):
+        lines = []
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append('%s_bucket{%s} %d' % (name, self._labels(le=bound, **labels), count))
+        lines.append('%s_bucket{%s} %d' % (name, self._labels(le='+Inf', **labels), histogram.count))
+        lines.append('%s_sum{%s} %f' % (name, self._labels(**labels), histogram.sum))
+        lines.append('%s_count{%s} %d' % (name, self._labels(**labels), histogram.count))
+        return lines
+
+    def to_prometheus(self, path=None):
+        """Export metrics in Prometheus text format, write to path if it is given
+
+        The file is replaced atomically, it suits textfile collector of node_exporter.
+
+        :return str: metrics in text format
+        """
+        with self._lock:
+            lines = []
+            name = '%s_request_duration_seconds' % self.prefix
+            lines.extend(('# HELP %s Time until response headers arrive.' % name, '# TYPE %s histogram' % name))
+            for (end_point, operation), metrics in sorted(self.requests.items()):
+                lines.extend(self._histogram_lines(name, metrics['latency'], end_point=end_point, operation=operation))
+            for metric in ['requests_total', 'errors_total'] + [counter for _, counter in self.COUNTERS]:
+                name = '%s_%s' % (self.prefix, metric)
+                lines.append('# TYPE %s counter' % name)
+                for (end_point, operation), metrics in sorted(self.requests.items()):
+                    lines.append('%s{%s} %s' % (name, self._labels(end_point=end_point, operation=operation), metrics[metric]))
+
+            name = '%s_operation_duration_seconds' % self.prefix
+            lines.extend(('# HELP %s Wall time of Handler calls.' % name, '# TYPE %s histogram' % name))
+            for operation, metrics in sorted(self.operations.items()):
+                lines.extend(self._histogram_lines(name, metrics['duration'], operation=operation))
+            for metric in ('calls_total', 'rows_total', 'errors_total'):
+                name = '%s_operation_%s' % (self.prefix, metric)
+                lines.append('# TYPE %s counter' % name)
+                for operation, metrics in sorted(self.operations.items()):
+                    lines.append('%s{%s} %s' % (name, self._labels(operation=operation), metrics[metric]))
+        text = '\n'.join(lines) + '\n'
+        if path:
+            _write_atomic(path, text)
+        return text
+
+
+def _write_atomic(path, text):
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as tf:
+            tf.write(text)
+        # mkstemp creates the file readable only by its owner, node_exporter may run as another user
+        os.chmod(temp_path, created_mode())
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
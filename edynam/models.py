@@ -1,8 +1,16 @@
 import re
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from .fetchxml import FetchXML
+from .fetchxml import FetchXML, FetchXMLTemplate
 from .dynamics import FORMATTED_VALUE_SUF
+from .records import make_record_type
+from .metadata import MetadataCache
+from .export import export_rows, format_of
+from .partition import guid_bounds, date_bounds, range_filters, scan_partitions
+from .typed import convert_rows
+from .metrics import measured, bind
+from .profiler import phase, record_query
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +27,19 @@ class Handler(object):
     FIELDS = ()
     LOOKUPS = ()
     MAPS = {}
+    # types of output names converted when typed is True, see typed module. The primary key is a guid
+    TYPES = {}
+    # mapped entities converted together by scan when typed is True
+    TYPED_CHUNK = 500
 
-    def __init__(self, backend=None):
+    def __init__(self, backend=None, records=False, typed=False):
         """Refresh an expired access token
 
         :param Dynamics backend: Dynamics instance to handle requests. Default is None
+        :param bool records: return compact records of record_type() instead of dicts
+                             from list, scan and get. Default is False
+        :param bool typed: convert dates, money and ids declared in TYPES from list, scan
+                           and get. Default is False
         """
         if backend is None:
             from . import web_api_client
@@ -31,8 +47,86 @@ class Handler(object):
             self._backend = web_api_client
         else:
             self._backend = backend
+        self.records = records
+        self.typed = typed
         self.instance = None
 
+    @classmethod
+    def _logical_name(cls):
+        return cls.ENTITY if cls.ENTITY else cls.END_POINT[:-1]
+
+    @classmethod
+    def _output_keys(cls):
+        """Keys of a mapped entity derived from FIELDS, LOOKUPS and MAPS"""
+        plookups = re.compile(r'^(\S+)\(\$.+\=.+\)$')
+        lookups = [plookups.match(exp).group(1) for exp in cls.LOOKUPS if plookups.match(exp)]
+        keys = ['@odata.etag', cls._logical_name() + 'id']
+        for field in list(cls.FIELDS) + ['_%s_value' % lookup for lookup in lookups] + lookups:
+            if field not in cls.MAPS:
+                keys.extend((field, field + '@' + FORMATTED_VALUE_SUF))
+        for field, mapping in cls.MAPS.items():
+            if isinstance(mapping, dict):
+                keys.extend(mapping.values())
+                if not ('raw' in mapping or 'formatted' in mapping):
+                    # empty expanded value is kept as it is
+                    keys.append(field)
+            else:
+                keys.append(mapping)
+        return keys
+
+    @classmethod
+    def record_type(cls):
+        """A compact record class with a slot of every key this Handler maps entities to
+
+        It is generated once per Handler class.
+        """
+        if '_record_type' not in cls.__dict__:
+            cls._record_type = make_record_type(cls.__name__ + 'Record', cls._output_keys())
+        return cls._record_type
+
+    def _annotate(self, items):
+        """Add formatted values of items locally when backend is in lean mode, see metadata module"""
+        if getattr(self._backend, 'annotations', True):
+            return items
+        return MetadataCache.of(self._backend).annotate_iter(self._logical_name(), items)
+
+    @classmethod
+    def _types(cls):
+        types = {cls._logical_name() + 'id': 'guid'}
+        types.update(cls.TYPES)
+        return types
+
+    def _finish(self, items):
+        """Map raw entities, convert types column by column if typed, as list, scan and get return them"""
+        with phase('map'):
+            mapped = [self.map(item) for item in items]
+            if self.typed:
+                convert_rows(mapped, self._types())
+            return [self._output(row) for row in mapped]
+
+    def _finish_iter(self, items):
+        """Mapped entities of a stream of raw entities, TYPED_CHUNK at a time when typed"""
+        if not self.typed:
+            for item in items:
+                with phase('map'):
+                    mapped = self._output(self.map(item))
+                yield mapped
+            return
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == self.TYPED_CHUNK:
+                yield from self._finish(chunk)
+                chunk = []
+        if chunk:
+            yield from self._finish(chunk)
+
+    def _output(self, flatted):
+        """Convert a mapped entity to a record if records mode is on"""
+        if self.records:
+            return self.record_type()(flatted)
+        return flatted
+
     def _build_list(self, key, attr, extra):
         # construct a dictionary with
         fields = list(getattr(self, attr, []))
@@ -101,6 +195,44 @@ class Handler(object):
     def expand(self):
         return self._build_list('$expand', 'LOOKUPS', [])
 
+    @classmethod
+    def _sources_of(cls, name):
+        """Keys of raw entities in MAPS which are mapped to an output name"""
+        sources = []
+        for key, mapping in cls.MAPS.items():
+            targets = mapping.values() if isinstance(mapping, dict) else (mapping, )
+            if name in targets:
+                sources.append(key)
+        return sources
+
+    @classmethod
+    def projection(cls, fields):
+        """Minimal $select and $expand of a query whose mapped entities need fields
+
+        MAPS is inverted to find where each output name comes from: a field, the
+        _xxx_value of a lookup or an expanded lookup of LOOKUPS. Output names not
+        in MAPS are selected as they are. Lookups no field comes from are not expanded.
+
+        :param list fields: output names after MAPS
+        :return tuple: $select dict and $expand dict, an empty dict when there is nothing of it
+        """
+        plookups = re.compile(r'^(\S+)\(\$.+\=.+\)$')
+        lookups = {}
+        for exp in cls.LOOKUPS:
+            exp_match = plookups.match(exp)
+            if exp_match:
+                lookups[exp_match.group(1)] = exp
+        selects, expands = [], []
+        for name in fields:
+            for source in cls._sources_of(name) or [name]:
+                if source in lookups:
+                    if lookups[source] not in expands:
+                        expands.append(lookups[source])
+                elif source not in selects:
+                    selects.append(source)
+        return (cls.create_select(selects) if selects else {},
+                {'$expand': ','.join(expands)} if expands else {})
+
     @staticmethod
     def create_select(fields):
         assert isinstance(fields, tuple) or isinstance(fields, list)
@@ -160,8 +292,9 @@ class Handler(object):
 
     def map_list(self, items):
         mapped = []
-        for item in items:
-            mapped.append(self.map(item))
+        with phase('map'):
+            for item in items:
+                mapped.append(self.map(item))
         return mapped
 
     @staticmethod
@@ -181,41 +314,117 @@ class Handler(object):
                 excluded[k] = item[k]
         return excluded
 
-    def _build_params(self, selects, expands, extra):
+    def _build_params(self, selects, expands, extra, fields=None):
         params = {}
-        if selects is None:
-            selects = self.select()
-        if expands is None:
-            expands = self.expand()
-
-        if selects:
-            params.update(selects)
-        if expands:
-            params.update(expands)
-        if extra:
-            params.update(extra)
+        with phase('build'):
+            if fields is not None:
+                selects, expands = self.projection(fields)
+            if selects is None:
+                selects = self.select()
+            if expands is None:
+                expands = self.expand()
+
+            if selects:
+                params.update(selects)
+            if expands:
+                params.update(expands)
+            if extra:
+                params.update(extra)
         return params
 
-    def list(self, selects=None, expands=None, extra=None):
+    @measured
+    def list(self, selects=None, expands=None, extra=None, fields=None):
+        """List mapped entities
+
+        :param list fields: output names after MAPS, only what they need is selected and expanded,
+                            see projection. It overrides selects and expands. Default None: all in FIELDS and LOOKUPS
+        """
         try:
             data = self._backend.get(self.END_POINT,
-                                     self._build_params(selects, expands, extra))
+                                     self._build_params(selects, expands, extra, fields))
         except LookupError as err:
             logger.error("Query failed, %s", str(err))
             return []
         else:
             # logger.debug(data)
-            return [self.map(item) for item in data]
+            return self._finish(self._annotate(data))
+
+    def scan(self, selects=None, expands=None, extra=None, page_size=None, fields=None, prefetch=None):
+        """Iterate mapped entities of all pages of a query
+
+        Unlike list, rows are decoded and mapped while pages stream in,
+        memory use does not grow with the size of result.
+
+        :param int page_size: maximum rows of a page, default None: server decides
+        :param list fields: output names after MAPS, see list
+        :param int prefetch: pages fetched ahead while rows are mapped, default None: prefetch of backend
+        """
+        params = self._build_params(selects, expands, extra, fields)
+        if prefetch is None:
+            rows = self._backend.iter_rows(self.END_POINT, params, page_size)
+        else:
+            rows = self._backend.iter_rows(self.END_POINT, params, page_size, prefetch=prefetch)
+        yield from self._finish_iter(self._annotate(rows))
 
+    def scan_partitioned(self, partitions=8, workers=4, by=None, since=None, until=None,
+                         selects=None, expands=None, extra=None, page_size=None, fields=None):
+        """Iterate mapped entities of a query scanned in disjoint partitions concurrently
+
+        Partitions are ranges of the primary key or of a date time field, see
+        partition module. Entities come in the order partitions return them.
+
+        :param int partitions: number of partitions
+        :param int workers: number of partitions scanned at the same time
+        :param str by: date time field to partition by, e.g. createdon, default None: the primary key
+        :param since: start of ranges of by, datetime or ISO 8601 string in UTC, required with by
+        :param until: end of ranges of by, default None: now
+        """
+        key = self._logical_name() + 'id'
+        if by is None:
+            # ranges of the primary key are disjoint, entities need not be deduplicated
+            filters, dedupe = range_filters(key, guid_bounds(partitions)), None
+        elif since is None:
+            raise ValueError('since is required to partition by %s' % by)
+        else:
+            filters, dedupe = range_filters(by, date_bounds(since, until, partitions), nullable=True), key
+        params = self._build_params(selects, expands, extra, fields)
+        rows = scan_partitions(self._backend, self.END_POINT, params, filters, dedupe, page_size, workers)
+        yield from self._finish_iter(self._annotate(rows))
+
+    def export(self, path, fmt=None, compress=None, progress=None,
+               selects=None, expands=None, extra=None, page_size=None, fields=None):
+        """Write mapped entities of a query to a file while pages stream in, see export module
+
+        :param str path: path of the file, replaced atomically
+        :param str fmt: one of jsonl, csv and parquet, default None: by extension of path
+        :param bool compress: gzip the file, default None: when path ends with .gz
+        :param callable progress: called with number of rows written and path, default None: logged
+        :param list fields: output names after MAPS, they are also the columns of csv and parquet.
+                            Default None: all keys the Handler maps entities to
+        :return int: number of entities written
+        """
+        rows = self.scan(selects=selects, expands=expands, extra=extra, page_size=page_size, fields=fields)
+        columns = fields
+        if columns is None and (fmt or format_of(path)) != 'jsonl':
+            # mapped keys of formatted values and expanded lookups are only in entities which have them,
+            # annotations of fields which are not mapped are left out
+            columns = [key for key in dict.fromkeys(self._output_keys()) if '@' not in key]
+        return export_rows(rows, path, fmt, compress, fields=columns, progress=progress)
+
+    @measured
     def get(self, entity_id, selects=None, expands=None, extra=None):
-        """Get entity by its id"""
-        return self.map(self._backend.get('%s(%s)' % (self.END_POINT, entity_id),
-                                          self._build_params(selects, expands, extra)))
+        """Get entity by its id
+
+        An entity got before is revalidated by its ETag, it is not downloaded again if it has not changed.
+        """
+        item = self._backend.get_entity('%s(%s)' % (self.END_POINT, entity_id), self._build_params(selects, expands, extra))
+        return self._finish(self._annotate([item]))[0]
 
     def load(self, entity_id):
         """Load an entity instance by its id"""
         self.instance = self.get(entity_id)
 
+    @measured
     def get_id_of(self, name):
         """Get ID of an entity
 
@@ -231,6 +440,61 @@ class Handler(object):
         assert len(data) > 0 and len(data) < 2
         return data[0][entity_id]
 
+    def _fetch(self, end_point, shape, builder, paged=False, page_size=None, **values):
+        """Run a FetchXML query from a template of its shape
+
+        The query is built by builder and serialised only once for a shape,
+        only values are substituted for every call.
+
+        :param str end_point: end point of entity set the query runs against
+        :param tuple shape: identity of structure of the query
+        :param callable builder: returns the fetch element with placeholders of values
+        :param bool paged: follow paging cookies of results by iter_rows, default False: one request
+        :param int page_size: maximum rows of a page when paged, default None: server default
+        :param dict values: values of placeholders
+        """
+        with phase('build'):
+            template = FetchXMLTemplate.get((type(self).__name__, ) + shape, builder)
+            fetch_xml = template.render(**values)
+        logger.debug(fetch_xml)
+        record_query(fetch_xml)
+        if paged:
+            rows = list(self._backend.iter_rows(end_point, {'fetchXml': fetch_xml}, page_size))
+        else:
+            rows = self._backend.get(end_point, {'fetchXml': fetch_xml})
+        return self._annotate_fetch(fetch_xml, rows)
+
+    def _annotate_fetch(self, fetch_xml, rows):
+        """Add formatted values of rows of a FetchXML query locally when backend is in lean mode"""
+        if getattr(self._backend, 'annotations', True):
+            return rows
+        return MetadataCache.of(self._backend).annotate_fetch(fetch_xml, rows)
+
+    @staticmethod
+    def _hash_join(results, key):
+        """Inner join results of sub-queries of a split query on a key
+
+        Rows which share the same key are combined as a cross product, as the
+        server would have done for the link-entities spread over sub-queries.
+        Row order follows the first result.
+
+        :param list results: list of lists of rows, each row has key
+        :param str key: name of the join key in rows
+        """
+        joined = results[0]
+        for result in results[1:]:
+            index = {}
+            for row in result:
+                index.setdefault(row[key], []).append(row)
+            combined = []
+            for row in joined:
+                for other in index.get(row[key], ()):
+                    merged = dict(row)
+                    merged.update(other)
+                    combined.append(merged)
+            joined = combined
+        return joined
+
 
 class Project(Handler):
     # FIXME: Project probably is not needed for reporting
@@ -240,6 +504,7 @@ class Project(Handler):
               'msdyn_totalplannedcost', 'msdyn_plannedhours', 'msdyn_wbsduration')
     LOOKUPS = ('msdyn_customer($select=name)', )
     MAPS = {'msdyn_customer': {'name': 'billing_org'}}
+    TYPES = {'msdyn_scheduledstart': 'datetime', 'msdyn_scheduledend': 'datetime', 'msdyn_totalplannedcost': 'money'}
 
 
 class Product(Handler):
@@ -260,6 +525,8 @@ class Product(Handler):
             'producttypecode': {'raw': 'producttypecode', 'formatted': 'producttype'},
             'productstructure': {'raw': 'productstructurecode', 'formatted': 'productstructure'},
             '_parentproductid_value': {'raw': 'parentproductid', 'formatted': 'parentproduct'}}
+    TYPES = {'validfromdate': 'date', 'validtodate': 'date', 'price': 'money', 'defaultuomid': 'guid',
+             'defaultuomscheduleid': 'guid', 'parentproductid': 'guid'}
 
     @classmethod
     def _active_product_filter(cls):
@@ -268,7 +535,8 @@ class Product(Handler):
 
     def get_property_definitions(self, name, return_list=None):
         # :param tuple return_list: selected list of properties to be returned.
-        # Dynamics fetchXml only allows maximum of 10 link-entities
+        # Dynamics fetchXml only allows maximum of 10 link-entities, Order.get_product
+        # splits its query when there are too many, but fewer properties mean fewer requests
         prop_service = DynamicProperty(self._backend)
         if return_list:
             properties = prop_service.get_properties_of(name)
@@ -280,15 +548,16 @@ class Product(Handler):
         else:
             return prop_service.get_properties_of(name)
 
-    def list(self):
+    @measured
+    def list(self, fields=None):
         # Only list user defined product not imported samples
         filter_option = self._active_product_filter()
-        return super().list(extra=filter_option)
+        return super().list(extra=filter_option, fields=fields)
 
+    @measured
     def list_names(self):
-        selects = self.create_select(('name', ))
         filter_option = self._active_product_filter()
-        return super().list(selects=selects, extra=filter_option)
+        return super().list(extra=filter_option, fields=('name', ))
 
 
 class ProductPricelist(Handler):
@@ -307,9 +576,15 @@ class ProductPricelist(Handler):
                           'producttypecode@OData.Community.Display.V1.FormattedValue': 'producttype',
                           'productstructure@OData.Community.Display.V1.FormattedValue': 'productstructure'},
             '_uomid_value': {'raw': 'uomid', 'formatted': 'uom'}}
+    TYPES = {'amount': 'money', 'pricelevelid': 'guid', 'productid': 'guid', 'uomid': 'guid'}
 
+    @measured
     def get_prices(self, name):
-        """Get prices of a product represented by its name"""
+        """Get prices of a product represented by its name
+
+        To look prices up from memory, use PriceIndex.prices_of of pricing module,
+        which returns rows as list does.
+        """
         # fetchXml=<fetch mapping="logical">
         #     <entity name="productpricelevel">
         #         <attribute name="pricelevelid" />
@@ -325,18 +600,20 @@ class ProductPricelist(Handler):
         # </fetch>
 
         # Note: field names are not the same as in list method.
-        fetch = FetchXML.create_fetch()
-        entity = FetchXML.create_entity(fetch, self.ENTITY)
-        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'pricelevelid'})
-        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'amount'})
+        def build():
+            fetch = FetchXML.create_fetch()
+            entity = FetchXML.create_entity(fetch, self.ENTITY)
+            FetchXML.create_sub_elm(entity, 'attribute', {'name': 'pricelevelid'})
+            FetchXML.create_sub_elm(entity, 'attribute', {'name': 'amount'})
+
+            product_link = FetchXML.create_link(entity, 'product', 'productid', 'productid')
+            FetchXML.create_alias(product_link, 'producttypecode', 'productTypeCode')
+            FetchXML.create_alias(product_link, 'productstructure', 'productStructureCode')
+            filter_op = FetchXML.create_sub_elm(product_link, 'filter', {'type': 'and'})
+            FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'name', 'operator': 'eq', 'value': FetchXML.param('name')})
+            return fetch
 
-        product_link = FetchXML.create_link(entity, 'product', 'productid', 'productid')
-        FetchXML.create_alias(product_link, 'producttypecode', 'productTypeCode')
-        FetchXML.create_alias(product_link, 'productstructure', 'productStructureCode')
-        filter_op = FetchXML.create_sub_elm(product_link, 'filter', {'type': 'and'})
-        FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'name', 'operator': 'eq', 'value': name})
-        logger.debug(FetchXML.to_string(fetch))
-        return self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        return self._fetch(self.END_POINT, ('get_prices', ), build, name=name)
 
 
 class Account(Handler):
@@ -348,7 +625,9 @@ class Account(Handler):
     MAPS = {'parentaccountid': {'name': 'parent_account'},
             'primarycontactid': {'fullname': 'manager', 'emailaddress1': 'email'},
             '_parentaccountid_value': {'raw': 'parentaccountid', 'formatted': 'parent_account'}}
+    TYPES = {'parentaccountid': 'guid'}
 
+    @measured
     def get_top(self, unselective=False):
         """Get Accounts which do not have parent
 
@@ -367,19 +646,22 @@ class Account(Handler):
         if unselective:
             return self.get_child_of('null')
         else:
-            fetch = FetchXML.create_fetch(distinct=True)
-            entity = FetchXML.create_entity(fetch, 'salesorder')
-            FetchXML.create_alias(entity, 'customerid', 'id')
-            link = FetchXML.create_link(entity, 'account', 'accountid', 'customerid')
-            FetchXML.create_alias(link, 'name', 'name')
-            logger.debug(FetchXML.to_string(fetch))
-            return self._backend.get(Order.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+            def build():
+                fetch = FetchXML.create_fetch(distinct=True)
+                entity = FetchXML.create_entity(fetch, 'salesorder')
+                FetchXML.create_alias(entity, 'customerid', 'id')
+                link = FetchXML.create_link(entity, 'account', 'accountid', 'customerid')
+                FetchXML.create_alias(link, 'name', 'name')
+                return fetch
+
+            return self._fetch(Order.END_POINT, ('get_top', ), build)
 
     def get_child_of(self, parent_id):
         selects = self.create_select(('name', ))
         filter_option = self.create_filter('_parentaccountid_value eq %s' % parent_id)
         return super().list(selects=selects, extra=filter_option)
 
+    @measured
     def get_ancestors(self, account_id):
         """Get all ancestors of an account"""
         # <fetch distinct='false' mapping='logical'>
@@ -391,31 +673,45 @@ class Account(Handler):
         #         </filter>
         #     </entity>
         # </fetch>
-        fetch = FetchXML.create_fetch()
-        entity = FetchXML.create_entity(fetch, self.ENTITY)
-        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'name'})
-        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'parentaccountid'})
-        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'above', 'value': account_id})
-        logger.debug(FetchXML.to_string(fetch))
-        ancestors = self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        def build():
+            fetch = FetchXML.create_fetch()
+            entity = FetchXML.create_entity(fetch, self.ENTITY)
+            FetchXML.create_sub_elm(entity, 'attribute', {'name': 'name'})
+            FetchXML.create_sub_elm(entity, 'attribute', {'name': 'parentaccountid'})
+            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'above', 'value': FetchXML.param('account_id')})
+            return fetch
+
+        ancestors = self._fetch(self.END_POINT, ('get_ancestors', ), build, account_id=account_id)
         for item in self.map_list(ancestors):
             logger.debug(item)
 
-    def get_all_products(self):
-        """Get all products belong to this Account"""
+    @measured
+    def get_all_products(self, grouped=None):
+        """Get all products belong to this Account
+
+        :param dict grouped: products of all Accounts from Order.get_all_account_products
+                             to look up instead of querying, default None
+        """
         assert self.instance is not None
-        if hasattr(self.instance, 'accountid'):
+        if 'accountid' in self.instance:
+            if grouped is not None:
+                return grouped.get(self.instance['accountid'].lower(), [])
             order_service = Order(self._backend)
             return order_service.get_account_products(self.instance['accountid'])
         else:
             return []
 
-    def get_usernames(self, account_id):
+    @measured
+    def get_usernames(self, account_id, directory=None):
         """Get contacts which have username with essential information
 
         A shortcut for eRSA Account product.
+
+        :param ContactDirectory directory: a loaded directory to look up instead of querying, default None
         """
+        if directory is not None:
+            return directory.usernames_of(account_id)
         contact_service = Contact(self._backend)
         return contact_service.get_usernames_of(account_id)
 
@@ -443,6 +739,7 @@ class Contact(Handler):
         'parentcustomerid_account': {'name': 'parentcustomer'},
         'parentcustomerid_contact': {'fullname': 'parentcustomer'}
     }
+    TYPES = {'parentcustomerid': 'guid'}
 
     # def _select_expands(self, lookups=None):
     #     """Override super class' method"""
@@ -461,19 +758,26 @@ class Contact(Handler):
     #                 exp_selects.append('_' + exp_match.group(1) + '_value')
     #     return exp_selects
 
+    @measured
     def get_contacts_of(self, account_id):
         filter_option = self.create_filter('_accountid_value eq %s' % account_id)
         return self.list(extra=filter_option)
 
+    @classmethod
+    def _output_keys(cls):
+        return super()._output_keys() + ['parentcustomer_type']
+
     def map(self, item):
         """Override super method to identify what type of customer is"""
         flatted = super().map(item)
-        if flatted['parentcustomerid_contact'] is None:
+        # customer lookups are not in results when they have not been selected
+        if item.get('parentcustomerid_contact', False) is None:
             flatted['parentcustomer_type'] = 'Account'
-        elif item['parentcustomerid_account'] is None:
+        elif item.get('parentcustomerid_account', False) is None:
             flatted['parentcustomer_type'] = 'Contact'
         return flatted
 
+    @measured
     def get_usernames(self):
         """Get contacts which have username with essential information
 
@@ -496,23 +800,26 @@ class Contact(Handler):
         #         </link-entity>
         #     </entity>
         # </fetch>
-        fetch = FetchXML.create_fetch(False)
-        entity = FetchXML.create_entity(fetch, self.ENTITY)
-        FetchXML.create_alias(entity, 'new_username', 'username')
-        FetchXML.create_alias(entity, 'fullname', 'manager')
-        FetchXML.create_alias(entity, 'emailaddress1', 'email')
-
-        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        FetchXML.create_condition(filter_op, 'new_username', 'not-null')
-        FetchXML.create_condition(filter_op, 'new_username', 'ne', 'NULL')
-
-        unit_link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid')
-        FetchXML.create_alias(unit_link, 'name', 'unit')
-        account_link = FetchXML.create_link(unit_link, 'account', 'accountid', 'parentaccountid')
-        FetchXML.create_alias(account_link, 'name', 'biller')
-        logger.debug(FetchXML.to_string(fetch))
-        return self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        def build():
+            fetch = FetchXML.create_fetch(False)
+            entity = FetchXML.create_entity(fetch, self.ENTITY)
+            FetchXML.create_alias(entity, 'new_username', 'username')
+            FetchXML.create_alias(entity, 'fullname', 'manager')
+            FetchXML.create_alias(entity, 'emailaddress1', 'email')
 
+            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            FetchXML.create_condition(filter_op, 'new_username', 'not-null')
+            FetchXML.create_condition(filter_op, 'new_username', 'ne', 'NULL')
+
+            unit_link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid')
+            FetchXML.create_alias(unit_link, 'name', 'unit')
+            account_link = FetchXML.create_link(unit_link, 'account', 'accountid', 'parentaccountid')
+            FetchXML.create_alias(account_link, 'name', 'biller')
+            return fetch
+
+        return self._fetch(self.END_POINT, ('get_usernames', ), build)
+
+    @measured
     def get_usernames_of(self, account_id):
         """Get contacts which have username with essential information
 
@@ -538,28 +845,32 @@ class Contact(Handler):
         #         </link-entity>
         #     </entity>
         # </fetch>
-        fetch = FetchXML.create_fetch(False)
-        entity = FetchXML.create_entity(fetch, self.ENTITY)
-        FetchXML.create_alias(entity, 'new_username', 'username')
-        FetchXML.create_alias(entity, 'fullname', 'manager')
-        FetchXML.create_alias(entity, 'emailaddress1', 'email')
+        def build():
+            fetch = FetchXML.create_fetch(False)
+            entity = FetchXML.create_entity(fetch, self.ENTITY)
+            FetchXML.create_alias(entity, 'new_username', 'username')
+            FetchXML.create_alias(entity, 'fullname', 'manager')
+            FetchXML.create_alias(entity, 'emailaddress1', 'email')
 
-        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        FetchXML.create_condition(filter_op, 'new_username', 'not-null')
-        FetchXML.create_condition(filter_op, 'new_username', 'ne', 'NULL')
+            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            FetchXML.create_condition(filter_op, 'new_username', 'not-null')
+            FetchXML.create_condition(filter_op, 'new_username', 'ne', 'NULL')
+
+            link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid')
+            FetchXML.create_alias(link, 'name', 'unit')
+            ac_filter = FetchXML.create_sub_elm(FetchXML.create_sub_elm(link, 'filter', {'type': 'and'}), 'filter', {'type': 'or'})
+            FetchXML.create_condition(ac_filter, 'accountid', 'eq', FetchXML.param('account_id'))
+            FetchXML.create_condition(ac_filter, 'parentaccountid', 'eq', FetchXML.param('account_id'))
+            return fetch
 
-        link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid')
-        FetchXML.create_alias(link, 'name', 'unit')
-        ac_filter = FetchXML.create_sub_elm(FetchXML.create_sub_elm(link, 'filter', {'type': 'and'}), 'filter', {'type': 'or'})
-        FetchXML.create_condition(ac_filter, 'accountid', 'eq', account_id)
-        FetchXML.create_condition(ac_filter, 'parentaccountid', 'eq', account_id)
-        return self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        return self._fetch(self.END_POINT, ('get_usernames_of', ), build, account_id=account_id)
 
 
 class Opportunity(Handler):
     """Rich description of a sale or project"""
 
     END_POINT = 'opportunities'
+    ENTITY = 'opportunity'
     FIELDS = ('name', 'description', 'currentsituation', 'customerneed')
     LOOKUPS = ('parentcontactid($select=fullname)', 'parentaccountid($select=name)')
 
@@ -580,6 +891,7 @@ class Order(Handler):
     FIELDS = ('name', 'description', 'new_orderid', '_customerid_value')
     LOOKUPS = ('opportunityid($select=name)', )
     MAPS = {'_customerid_value': {'raw': 'customerid', 'formatted': 'customer'}}
+    TYPES = {'customerid': 'guid'}
     STATES = {'Active': '0',
               'Submitted': '1',
               'Canceled': '2',
@@ -595,6 +907,10 @@ class Order(Handler):
               'Invoiced': '100003'}
 
     OPTIONSET_PATTERN = re.compile("^(.+)optionsetpropertyid$")
+    # alias of salesorderdetailid used to join results of split queries
+    DETAIL_KEY = 'salesorderdetailid_key'
+    # number of Orders of a query of their connections: ids make the query long
+    ROLE_BATCH = 200
 
     @classmethod
     def _create_order_entity(cls, id_only=False, extra=None):
@@ -658,48 +974,88 @@ class Order(Handler):
         prod_filter = FetchXML.create_sub_elm(detail_link_elm, 'filter', {'type': 'and'})
         FetchXML.create_sub_elm(prod_filter, 'condition', {'attribute': 'productid', 'operator': 'eq', 'value': product_id})
 
-    @staticmethod
-    def _add_connection_role_link(order_node, role_id, display_name, extra_fields=None):
-        """Create node to get detail of a connection role
-
-        It retrieves fullname as display_name (provided by caller);
-                     emailaddress1 as email
-                     parentcustomerid.name as unit
-        If extra_field is given, either a list or tuple of tuples,
-        each of element of it has to have only two elements for mapping internal name to label:
-        [0]: internal name and [1] label, e.g. new_username --> display_name + 'username'.
-        Note: extra_field is intend to be used as a low level argument: caller has to know
-        the internal name required.
-        """
-        link_elm = FetchXML.create_link(order_node, 'connection', 'record1id', 'salesorderid', 'outer')
-        FetchXML.create_alias(link_elm, 'record2id', display_name + 'contactid')
-
-        filter_op = FetchXML.create_sub_elm(link_elm, 'filter', {'type': 'and'})
-        # hard coded for 1088: Order, 2: Contact
-        FetchXML.create_condition(filter_op, 'record1objecttypecode', 'eq', '1088')
-        FetchXML.create_condition(filter_op, 'record2objecttypecode', 'eq', '2')
-        FetchXML.create_condition(filter_op, 'record2roleid', 'eq', role_id)
-
-        contact_link_elm = FetchXML.create_link(link_elm, 'contact', 'contactid', 'record2id', 'outer')
-        FetchXML.create_alias(contact_link_elm, 'jobtitle', display_name + 'title')
-        FetchXML.create_alias(contact_link_elm, 'fullname', display_name)
-        FetchXML.create_alias(contact_link_elm, 'emailaddress1', display_name + 'email')
-        if extra_fields and type(extra_fields) in (list, tuple):
-            for extra in extra_fields:
-                assert len(extra) == 2
-                FetchXML.create_alias(contact_link_elm, extra[0], display_name + extra[1])
-
-        account_link_elm = FetchXML.create_link(contact_link_elm, 'account', 'accountid', 'parentcustomerid', 'outer')
-        FetchXML.create_alias(account_link_elm, 'name', display_name + 'unit')
+    def _get_connections(self, order_ids, roles):
+        """Get Contacts connected to Orders in roles by one paged query for a batch of Orders
 
-    @staticmethod
-    def _add_role_link(entity, roles):
+        It retrieves fullname, jobtitle as title, emailaddress1 as email,
+        parentcustomerid.name as unit and extra fields of roles prefixed by extra_.
+
+        :param list order_ids: ids of Orders
+        :param list roles: Connection Roles, see get_product
+        :return dict: keys are tuples of lower case Order id and role id, values are lists of connected Contacts
+        """
+        extra_fields = sorted(set(extra[0] for role in roles for extra in role.get('extra') or ()))
+        role_ids = sorted(set(role['id'] for role in roles))
+        connections = {}
+        for start in range(0, len(order_ids), self.ROLE_BATCH):
+            with phase('build'):
+                fetch = FetchXML.create_fetch()
+                entity = FetchXML.create_entity(fetch, 'connection')
+                FetchXML.create_alias(entity, 'record1id', 'orderid')
+                FetchXML.create_alias(entity, 'record2id', 'contactid')
+                FetchXML.create_alias(entity, 'record2roleid', 'roleid')
+
+                filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+                # hard coded for 1088: Order, 2: Contact
+                FetchXML.create_condition(filter_op, 'record1objecttypecode', 'eq', '1088')
+                FetchXML.create_condition(filter_op, 'record2objecttypecode', 'eq', '2')
+                FetchXML.create_in_condition(filter_op, 'record1id', order_ids[start:start + self.ROLE_BATCH])
+                FetchXML.create_in_condition(filter_op, 'record2roleid', role_ids)
+
+                contact_link_elm = FetchXML.create_link(entity, 'contact', 'contactid', 'record2id', 'outer')
+                FetchXML.create_alias(contact_link_elm, 'jobtitle', 'title')
+                FetchXML.create_alias(contact_link_elm, 'fullname', 'fullname')
+                FetchXML.create_alias(contact_link_elm, 'emailaddress1', 'email')
+                for field in extra_fields:
+                    FetchXML.create_alias(contact_link_elm, field, 'extra_' + field)
+                account_link_elm = FetchXML.create_link(contact_link_elm, 'account', 'accountid', 'parentcustomerid', 'outer')
+                FetchXML.create_alias(account_link_elm, 'name', 'unit')
+                fetch_xml = FetchXML.to_string(fetch)
+            logger.debug(fetch_xml)
+            record_query(fetch_xml)
+            for row in self._backend.iter_rows('connections', {'fetchXml': fetch_xml}):
+                connections.setdefault((row['orderid'].lower(), row['roleid'].lower()), []).append(row)
+        return connections
+
+    def _add_roles(self, rows, roles):
+        """Add Contacts of Connection Roles to rows of Orders
+
+        Connections of all Orders in rows are retrieved together and joined
+        to rows locally: a row is repeated for every Contact of a role of
+        its Order and kept as it is if its Order has none, as an outer
+        link-entity of connection would do.
+        Fields of a Contact are named after role['name']: name (fullname),
+        namecontactid, nametitle, nameemail, nameunit and name + label of extra.
+
+        :param list rows: rows of Orders which have salesorderid
+        :param list roles: Connection Roles, see get_product
+        """
+        if not roles or not rows:
+            return rows
         for role in roles:
             assert 'id' in role and 'name' in role
-            if 'extra' in role:
-                Order._add_connection_role_link(entity, role['id'], role['name'], role['extra'])
-            else:
-                Order._add_connection_role_link(entity, role['id'], role['name'])
+        order_ids = sorted(set(row['salesorderid'].lower() for row in rows))
+        connections = self._get_connections(order_ids, roles)
+        with phase('map'):
+            for role in roles:
+                name, role_id = role['name'], role['id'].lower()
+                fields = [('contactid', name + 'contactid'), ('title', name + 'title'), ('fullname', name),
+                          ('email', name + 'email'), ('unit', name + 'unit')]
+                fields.extend(('extra_' + extra[0], name + extra[1]) for extra in role.get('extra') or ())
+                joined = []
+                for row in rows:
+                    contacts = connections.get((row['salesorderid'].lower(), role_id))
+                    if not contacts:
+                        joined.append(row)
+                        continue
+                    for contact in contacts:
+                        merged = dict(row)
+                        for source, target in fields:
+                            if source in contact:
+                                merged[target] = contact[source]
+                        joined.append(merged)
+                rows = joined
+        return rows
 
     @staticmethod
     def _add_prod_prop_link(entity, props):
@@ -741,16 +1097,41 @@ class Order(Handler):
         FetchXML.create_alias(for_link_elm, 'new_code_name', 'label')
         return intersect_link_elm
 
-    def get_product(self, product_id, roles=None, prod_props=None, account_id=None, order_extra=None):
+    @staticmethod
+    def _parameterise(items, prefix):
+        """Replace ids of roles or product properties by placeholders of a template
+
+        :param list items: list of dicts which have id key
+        :param str prefix: prefix of names of placeholders
+        :return tuple: copies of items with placeholders as ids and values of placeholders
+        """
+        parameterised, values = [], {}
+        for i, item in enumerate(items):
+            name = '%s%d' % (prefix, i)
+            parameterised.append(dict(item, id=FetchXML.param(name)))
+            values[name] = item['id']
+        return parameterised, values
+
+    @staticmethod
+    def _prop_shape(prop):
+        return prop['type'], prop['alias'], prop.get('required', True)
+
+    @measured
+    def get_product(self, product_id, roles=None, prod_props=None, account_id=None, order_extra=None, discounts=False):
         """Get a list of a product in Fulfilled Orders
 
         Customer has to be an Account in Orders. Orders are in Fulfilled state.
+        If properties need more link-entities than a query can have, the query
+        is split into sub-queries which run concurrently and their results are
+        joined on order lines. Contacts of roles are retrieved by a separate
+        query of connections of the Orders and joined locally, see _add_roles.
 
         :param list of dict roles: Connection Roles of Order to be retrieved, default None
         :param list prod_props: list of dicts for retrieving product properties, default None.
                                 It has keys: id, type, e.g. valueinteger, alias, required, true/false
         :param str account_id: Account id of customer, default None
         :param list of dict order_extra:
+        :param bool discounts: also retrieve manualdiscountamount and volumediscountamount of lines, default False
         :returns list: each element is a dict with fields at least:
                        salesorderid
                        name: order name
@@ -760,31 +1141,68 @@ class Order(Handler):
                        biller: Account responses to cost
                        roles: Contacts of connected to order. Default None. Each role has fullname, email, unit and role's display name
         """
-        fetch, entity = self._create_order_entity(extra=order_extra)
-        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        # only return fulfilled orders, this is commonly used
-        # TODO: partially fulfilled to be included?
-        # FIXME: temporarily removed fulfilled condition check. Need to turn it back on once done tests.
-        # self._add_state_condition(filter_op)
-
-        if account_id:
-            FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'eq', 'value': account_id})
-        else:
-            account_link_elm = FetchXML.create_link(entity, 'account', 'accountid', 'accountid')
-            FetchXML.create_alias(account_link_elm, 'name', 'biller')
+        prod_props = prod_props or []
+        # every query has the line item link, and the account link if account is not given
+        fixed = 1 if account_id else 2
+        plan = FetchXML.split_links([self._link_size(prop) for prop in prod_props], fixed)
+        if len(plan) == 1:
+            return self._add_roles(self._get_product(product_id, prod_props, account_id, order_extra, discounts), roles)
+
+        # too many link-entities for one query: each sub-query carries the key of line item
+        logger.debug('Split query of product %s into %d sub-queries', product_id, len(plan))
+        sub_queries = [(product_id, [prod_props[i] for i in indexes], account_id, order_extra, discounts, True)
+                       for indexes in plan]
+        with ThreadPoolExecutor(max_workers=len(sub_queries)) as executor:
+            results = list(executor.map(bind(lambda args: self._get_product(*args)), sub_queries))
+        joined = self._hash_join(results, self.DETAIL_KEY)
+        for row in joined:
+            del row[self.DETAIL_KEY]
+        return self._add_roles(joined, roles)
+
+    @staticmethod
+    def _link_size(prop):
+        """Number of link-entities needed by a product property"""
+        return 2 if prop['type'] == 'optionset' else 1
+
+    def _get_product(self, product_id, prod_props, account_id, order_extra, discounts=False, keyed=False):
+        """Run one query of get_product
+
+        :param bool keyed: if True, add salesorderdetailid as DETAIL_KEY for joining sub-queries
+        """
+        shape = ('get_product', bool(account_id), keyed, discounts,
+                 tuple((attr['name'], 'alias' in attr) for attr in order_extra or ()),
+                 tuple(self._prop_shape(prop) for prop in prod_props))
+        param_props, values = self._parameterise(prod_props, 'prop')
 
-        detail_link_elm = self._add_detail_link(entity)
-        Order._add_product_filter(detail_link_elm, product_id)
+        def build():
+            fetch, entity = self._create_order_entity(extra=order_extra)
+            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            # only return fulfilled orders, this is commonly used
+            # TODO: partially fulfilled to be included?
+            # FIXME: temporarily removed fulfilled condition check. Need to turn it back on once done tests.
+            # self._add_state_condition(filter_op)
+
+            if account_id:
+                FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'eq', 'value': FetchXML.param('account_id')})
+            else:
+                account_link_elm = FetchXML.create_link(entity, 'account', 'accountid', 'accountid')
+                FetchXML.create_alias(account_link_elm, 'name', 'biller')
 
-        if prod_props:
-            self._add_prod_prop_link(detail_link_elm, prod_props)
+            detail_link_elm = self._add_detail_link(entity)
+            Order._add_product_filter(detail_link_elm, FetchXML.param('product_id'))
+            if keyed:
+                FetchXML.create_alias(detail_link_elm, 'salesorderdetailid', self.DETAIL_KEY)
+            if discounts:
+                for field in ('manualdiscountamount', 'volumediscountamount'):
+                    FetchXML.create_alias(detail_link_elm, field, field)
 
-        if roles:
-            self._add_role_link(entity, roles)
+            if param_props:
+                self._add_prod_prop_link(detail_link_elm, param_props)
+            return fetch
 
-        logger.debug(FetchXML.to_string(fetch))
-        return self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        return self._fetch(self.END_POINT, shape, build, product_id=product_id, account_id=account_id, **values)
 
+    @measured
     def get_account_products(self, account_id, role=None):
         """Get a list of Products sold to an Account
 
@@ -802,23 +1220,89 @@ class Order(Handler):
                        role: key-value pairs of role['name'] with fullname as value, email and unit
         """
         # Stop at salesorderdetail line: no dynamic properties because it returns mixed products
-        fetch, entity = self._create_order_entity()
-        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        # only return fulfilled orders, this is commonly used
-        self._add_state_condition(filter_op)
-        FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'eq', 'value': account_id})
-
-        detail_link_elm = self._add_detail_link(entity)
-        prod_link_elm = FetchXML.create_link(detail_link_elm, 'product', 'productid', 'productid')
-        FetchXML.create_alias(prod_link_elm, 'name', 'product')
-
-        if role:
-            assert 'id' in role and 'name' in role
-            self._add_connection_role_link(entity, role['id'], role['name'])
-
-        logger.debug(FetchXML.to_string(fetch))
-        return self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        shape = ('get_account_products', )
 
+        def build():
+            fetch, entity = self._create_order_entity()
+            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            # only return fulfilled orders, this is commonly used
+            self._add_state_condition(filter_op)
+            FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'eq', 'value': FetchXML.param('account_id')})
+
+            detail_link_elm = self._add_detail_link(entity)
+            prod_link_elm = FetchXML.create_link(detail_link_elm, 'product', 'productid', 'productid')
+            FetchXML.create_alias(prod_link_elm, 'name', 'product')
+            return fetch
+
+        rows = self._fetch(self.END_POINT, shape, build, account_id=account_id)
+        return self._add_roles(rows, [role] if role else None)
+
+    @measured
+    def get_all_account_products(self, role=None, page_size=None):
+        """Get Products sold to all Accounts, grouped by Account
+
+        One paged query of lines of fulfilled Orders of all customer Accounts
+        instead of get_account_products for every Account. Rows are grouped
+        locally by the Account which is the customer of their Order.
+
+        The query is rooted at Order Line (salesorderdetail) and links up to
+        its Order: a paging cookie marks the last row of a page by the primary
+        key of the root entity, which is unique for a line, so no line of an
+        Order split between pages is skipped or repeated.
+
+        :param dict role: a Connection Role of Order to be retrieved, default None, see get_account_products
+        :param int page_size: maximum rows of a page, default None: server default
+        :returns dict: keys are lower case accountid, values are lists of rows as get_account_products returns
+            with salesorderdetailid of their lines
+        """
+        shape = ('get_all_account_products', )
+
+        def build():
+            # <fetch mapping="logical">
+            #     <entity name="salesorderdetail">
+            #         <attribute name="quantity" alias="allocated" />
+            #         <attribute name="priceperunit" alias="unitPrice" />
+            #         <link-entity name="salesorder" from="salesorderid" to="salesorderid">
+            #             <attribute name="salesorderid" alias="salesorderid" />
+            #             ...
+            #             <filter type="and">
+            #                 <condition attribute="statecode" operator="eq" value="3" />
+            #                 <condition attribute="accountid" operator="not-null" />
+            #             </filter>
+            #         </link-entity>
+            #         <link-entity name="product" from="productid" to="productid">
+            #             <attribute name="name" alias="product" />
+            #         </link-entity>
+            #     </entity>
+            # </fetch>
+            fetch = FetchXML.create_fetch()
+            entity = FetchXML.create_entity(fetch, 'salesorderdetail')
+            FetchXML.create_alias(entity, 'quantity', 'allocated')
+            FetchXML.create_alias(entity, 'priceperunit', 'unitPrice')
+
+            order_link_elm = FetchXML.create_link(entity, self.ENTITY, 'salesorderid', 'salesorderid')
+            FetchXML.create_alias(order_link_elm, 'salesorderid', 'salesorderid')
+            FetchXML.create_alias(order_link_elm, 'name', 'name')
+            FetchXML.create_alias(order_link_elm, 'new_orderid', 'orderID')
+            FetchXML.create_alias(order_link_elm, 'pricelevelid', 'pricelevelID')
+            FetchXML.create_alias(order_link_elm, 'accountid', 'customerid')
+            filter_op = FetchXML.create_sub_elm(order_link_elm, 'filter', {'type': 'and'})
+            self._add_state_condition(filter_op)
+            FetchXML.create_sub_elm(filter_op, 'condition', {'attribute': 'accountid', 'operator': 'not-null'})
+
+            prod_link_elm = FetchXML.create_link(entity, 'product', 'productid', 'productid')
+            FetchXML.create_alias(prod_link_elm, 'name', 'product')
+            return fetch
+
+        rows = self._fetch(OrderDetail.END_POINT, shape, build, paged=True, page_size=page_size)
+        rows = self._add_roles(rows, [role] if role else None)
+        with phase('map'):
+            products = {}
+            for row in rows:
+                products.setdefault(row.pop('customerid').lower(), []).append(row)
+        return products
+
+    @measured
     def get_for_codes(self, product_id=None, account_id=None, order_id=None):
         """Get ANZSRC FOR codes and labels of an order or orders
 
@@ -847,23 +1331,26 @@ class Order(Handler):
         #         </link-entity>
         #     </entity>
         # </fetch>
-        fetch, entity = self._create_order_entity(id_only=True)
+        shape = ('get_for_codes', bool(order_id), bool(account_id), bool(product_id))
 
-        Order._add_for_link(entity)
+        def build():
+            fetch, entity = self._create_order_entity(id_only=True)
 
-        if order_id:
-            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-            FetchXML.create_condition(filter_op, 'salesorderid', 'eq', order_id)
-        elif account_id:
-            filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-            FetchXML.create_condition(filter_op, 'customerid', 'eq', account_id)
+            Order._add_for_link(entity)
+
+            if order_id:
+                filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+                FetchXML.create_condition(filter_op, 'salesorderid', 'eq', FetchXML.param('order_id'))
+            elif account_id:
+                filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+                FetchXML.create_condition(filter_op, 'customerid', 'eq', FetchXML.param('account_id'))
 
-        if product_id:
-            detail_link_elm = FetchXML.create_link(entity, 'salesorderdetail', 'salesorderid', 'salesorderid')
-            Order._add_product_filter(detail_link_elm, product_id)
+            if product_id:
+                detail_link_elm = FetchXML.create_link(entity, 'salesorderdetail', 'salesorderid', 'salesorderid')
+                Order._add_product_filter(detail_link_elm, FetchXML.param('product_id'))
+            return fetch
 
-        logger.debug(FetchXML.to_string(fetch))
-        code_list = self._backend.get(self.END_POINT, {'fetchXml': FetchXML.to_string(fetch)})
+        code_list = self._fetch(self.END_POINT, shape, build, product_id=product_id, account_id=account_id, order_id=order_id)
         codes = {}
         for code in code_list:
             if code['salesorderid'] not in codes:
@@ -878,6 +1365,8 @@ class OrderDetail(Handler):
     END_POINT = 'salesorderdetails'
     FIELDS = ('quantity', 'manualdiscountamount', 'volumediscountamount', 'priceperunit')
     LOOKUPS = ('salesorderid($select=name)', 'productid($select=name)', 'uomid($select=name)')
+    TYPES = {'priceperunit': 'money', 'manualdiscountamount': 'money', 'volumediscountamount': 'money',
+             '_salesorderid_value': 'guid', '_productid_value': 'guid', '_uomid_value': 'guid'}
 
     # VALUE_TYPES = {
     #     1: 'valuedecimal',
@@ -886,6 +1375,7 @@ class OrderDetail(Handler):
     #     4: 'valueinteger'
     # }
 
+    @measured
     def get_products_of(self, order_id):
         """Get order details, aka product items of an order
 
@@ -894,6 +1384,7 @@ class OrderDetail(Handler):
         filter_option = self.create_filter("_salesorderid_value eq %s" % order_id)
         return self.list(extra=filter_option)
 
+    @measured
     def get_property_definitions(self, orderdetail_id):
         definitions = self._backend.get('%s(%s)/Microsoft.Dynamics.CRM.RetrieveProductProperties()' % (self.END_POINT, orderdetail_id))
         # need to return a dict with dynamicpropertyid as key, at least datatype as value
@@ -904,6 +1395,7 @@ class OrderDetail(Handler):
                 'type': DynamicProperty.VALUE_TYPES[definition['datatype']]}
         return def_dict
 
+    @measured
     def get_property_values(self, orderdetail_id):
         # filter PropertyInstace through _regardingobjectid_value
         filter_option = self.create_filter("_regardingobjectid_value eq %s" % orderdetail_id)
@@ -957,6 +1449,7 @@ class DynamicProperty(Handler):
     # DynamicPropertyAssociation is more useful
     # seems does not need this:  Microsoft.Dynamics.CRM.RetrieveProductProperties() on orderdetail is a filtered version of this generic version
     END_POINT = 'dynamicproperties'
+    ENTITY = 'dynamicproperty'
     FIELDS = ('name', 'description', 'datatype')
     VALUE_TYPES = {
         0: 'optionset',
@@ -977,6 +1470,7 @@ class DynamicProperty(Handler):
         assert 'alias' in prop
         prop['alias'] = prop['alias'].replace(' ', '').replace('/', '')
 
+    @measured
     def get_properties_of(self, name):
         """Get product properties of a product
 
@@ -999,22 +1493,23 @@ class DynamicProperty(Handler):
         #         </link-entity>
         #     </entity>
         # </fetch>
-        fetch = FetchXML.create_fetch()
-        entity = FetchXML.create_entity(fetch, 'dynamicpropertyassociation')
-        FetchXML.create_alias(entity, 'dynamicpropertyid', 'id')
-        status_filter = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
-        FetchXML.create_sub_elm(status_filter, 'condition', {'attribute': 'associationstatus', 'operator': 'eq', 'value': '0'})
-
-        prop_link = FetchXML.create_link(entity, 'dynamicproperty', 'dynamicpropertyid', 'dynamicpropertyid')
-        FetchXML.create_alias(prop_link, 'name', 'alias')
-        FetchXML.create_alias(prop_link, 'datatype', 'ntype')
-
-        prod_link = FetchXML.create_link(entity, 'product', 'productid', 'regardingobjectid')
-        prod_filter = FetchXML.create_sub_elm(prod_link, 'filter', {'type': 'and'})
-        FetchXML.create_condition(prod_filter, 'name', 'eq', name)
-
-        logger.debug(FetchXML.to_string(fetch))
-        properties = self._backend.get('dynamicpropertyassociations', {'fetchXml': FetchXML.to_string(fetch)})
+        def build():
+            fetch = FetchXML.create_fetch()
+            entity = FetchXML.create_entity(fetch, 'dynamicpropertyassociation')
+            FetchXML.create_alias(entity, 'dynamicpropertyid', 'id')
+            status_filter = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+            FetchXML.create_sub_elm(status_filter, 'condition', {'attribute': 'associationstatus', 'operator': 'eq', 'value': '0'})
+
+            prop_link = FetchXML.create_link(entity, 'dynamicproperty', 'dynamicpropertyid', 'dynamicpropertyid')
+            FetchXML.create_alias(prop_link, 'name', 'alias')
+            FetchXML.create_alias(prop_link, 'datatype', 'ntype')
+
+            prod_link = FetchXML.create_link(entity, 'product', 'productid', 'regardingobjectid')
+            prod_filter = FetchXML.create_sub_elm(prod_link, 'filter', {'type': 'and'})
+            FetchXML.create_condition(prod_filter, 'name', 'eq', FetchXML.param('name'))
+            return fetch
+
+        properties = self._fetch('dynamicpropertyassociations', ('get_properties_of', ), build, name=name)
         for prop in properties:
             self._normalise(prop)
         return properties
@@ -1208,6 +1703,7 @@ class Substitute(Handler):
                                      'producttypecode@OData.Community.Display.V1.FormattedValue': 'substitutedproducttype',
                                      'productstructure@OData.Community.Display.V1.FormattedValue': 'substitutedproductstructure'},
             'salesrelationshiptype': {'raw': 'salesrelationshiptypecode', 'formatted': 'salesrelationshiptype'}}
+    TYPES = {'productid': 'guid', 'substitutedproductid': 'guid'}
 
     def get_linked_from(self, product_id):
         """Get a list of linked products defined for product_id"""
@@ -0,0 +1,139 @@
+"""Scan an entity set in disjoint partitions concurrently
+
+Following @odata.nextLink is sequential: one request at a time. A partitioned
+scan splits the key space into disjoint $filter ranges which together cover
+every entity, scans the partitions concurrently, each following its own
+pages, and merges their rows as they arrive:
+
+    PropertyInstance(backend).scan_partitioned(partitions=8, workers=4)
+    OrderDetail(backend).scan_partitioned(by='createdon', since='2016-01-01T00:00:00Z')
+
+Partitions by id are ranges of the last group of GUIDs, which SQL Server
+compares first when it orders uniqueidentifier. Partitions by a date time
+field are equal ranges between since and until, the first and the last
+ranges are open and one more partition has the entities whose field is null.
+Rows are merged in the order they arrive. Ranges of the primary key never
+share an entity, but a date time field which changes while scanning, e.g.
+modifiedon, can move an entity from one partition to another: when a key is
+given, rows seen before by their primary key are dropped, at the cost of a
+key kept for every row. A field can still move an entity into a partition
+which has been scanned.
+"""
+import logging
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .metrics import bind
+from .pipeline import Pipe
+
+logger = logging.getLogger(__name__)
+
+# rows passed from a partition to the caller at a time
+CHUNK_SIZE = 500
+_GUID_SPACE = 16 ** 8
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def guid_bounds(count):
+    """Inner bounds of count ranges of GUIDs, ordered as SQL Server orders uniqueidentifier"""
+    return ['00000000-0000-0000-0000-%08x0000' % (i * _GUID_SPACE // count) for i in range(1, count)]
+
+
+def _parse(moment):
+    if isinstance(moment, datetime):
+        return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    return datetime.strptime(moment[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+def date_bounds(since, until, count):
+    """Inner bounds of count equal ranges of time between since and until
+
+    :param since: datetime or ISO 8601 string in UTC
+    :param until: datetime or ISO 8601 string in UTC, default None: now
+    """
+    start = _parse(since)
+    end = _parse(until) if until else datetime.now(timezone.utc)
+    if end <= start:
+        raise ValueError('until %s is not after since %s' % (end, start))
+    step = (end - start) / count
+    return [(start + step * i).strftime(DATE_FORMAT) for i in range(1, count)]
+
+
+def range_filters(field, bounds, nullable=False):
+    """Disjoint $filter expressions of field which cover all values, split by ordered bounds"""
+    edges = [None] + list(bounds) + [None]
+    filters = []
+    for lower, upper in zip(edges, edges[1:]):
+        conditions = []
+        if lower is not None:
+            conditions.append('%s ge %s' % (field, lower))
+        if upper is not None:
+            conditions.append('%s lt %s' % (field, upper))
+        filters.append(' and '.join(conditions) if conditions else None)
+    if nullable:
+        filters.append('%s eq null' % field)
+    return filters
+
+
+def scan_partitions(backend, end_point, params, filters, key=None, page_size=None, workers=4):
+    """Rows of a query in partitions scanned concurrently, rows of the same key only once if key is given
+
+    :param Dynamics backend: instance of Dynamics
+    :param str end_point: end point of an entity set
+    :param dict params: query parameters, $filter of a partition is added to $filter of params
+    :param list filters: $filter expressions of partitions, None for no filter
+    :param str key: field of the primary key of rows to drop rows seen before, default None: keep all rows
+    :param int page_size: maximum rows of a page of a partition
+    :param int workers: number of partitions scanned at the same time
+    """
+    pipe = Pipe(workers * 2)
+
+    def scan(partition):
+        partition_params = dict(params)
+        if partition:
+            existing = partition_params.get('$filter')
+            partition_params['$filter'] = '(%s) and (%s)' % (existing, partition) if existing else partition
+        rows, chunk = None, []
+        try:
+            rows = backend.iter_rows(end_point, partition_params, page_size)
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == CHUNK_SIZE:
+                    if not pipe.put(chunk):
+                        # the caller has stopped iterating
+                        return
+                    chunk = []
+            if chunk:
+                pipe.put(chunk)
+        except Exception as err:
+            pipe.put(err)
+        finally:
+            close = getattr(rows, 'close', None)
+            if close:
+                close()
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='partition-' + end_point)
+    futures = [executor.submit(bind(scan), partition) for partition in filters]
+
+    def finish():
+        wait(futures)
+        pipe.close()
+
+    threading.Thread(target=finish, name='partitions-' + end_point, daemon=True).start()
+    seen = set()
+    count = 0
+    try:
+        for row in pipe.rows():
+            count += 1
+            row_key = row.get(key) if key else None
+            if row_key is not None:
+                row_key = row_key.lower()
+                if row_key in seen:
+                    continue
+                seen.add(row_key)
+            yield row
+    finally:
+        pipe.stop()
+        executor.shutdown(wait=False, cancel_futures=True)
+    logger.debug('Scanned %d rows of %s in %d partitions', count, end_point, len(filters))
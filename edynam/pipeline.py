@@ -0,0 +1,70 @@
+"""Hand chunks of rows from worker threads to the caller through a bounded queue
+
+Dynamics.iter_rows with prefetch and partition.scan_partitions fetch rows in
+worker threads while the caller processes the rows which have arrived. A Pipe
+bounds the chunks waiting for the caller, so memory does not grow when the
+caller is slower than the network, and tells workers when the caller has
+stopped iterating:
+
+    pipe = Pipe(maxsize)
+    # in a worker thread
+    for chunk in chunks:
+        if not pipe.put(chunk):
+            return  # the caller has stopped
+    pipe.close()
+    # in the caller
+    yield from pipe.rows()
+
+An exception put by a worker is raised to the caller.
+"""
+import queue
+import threading
+
+_DONE = object()
+# seconds a worker waits for room in a full queue before it checks whether the caller has stopped
+POLL_INTERVAL = 0.1
+
+
+class Pipe(object):
+    """A bounded queue of chunks of rows from workers to one caller"""
+
+    def __init__(self, maxsize):
+        """
+        :param int maxsize: number of chunks which can wait for the caller
+        """
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+
+    def put(self, item):
+        """Put a chunk or an exception, wait while the queue is full
+
+        :return bool: False if the caller has stopped iterating, the item is dropped
+        """
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """Mark the end of chunks"""
+        self.put(_DONE)
+
+    def stop(self):
+        """Tell workers the caller has stopped iterating"""
+        self._stopped.set()
+
+    def rows(self):
+        """Rows of chunks until close, an exception put by a worker is raised"""
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield from item
+        finally:
+            self.stop()
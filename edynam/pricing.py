@@ -0,0 +1,177 @@
+"""Index of prices of Products on price lists
+
+ProductPricelist.get_prices queries prices of one Product for every call.
+A PriceIndex loads all productpricelevels once into a Product x price level
+x unit matrix and looks prices up from memory:
+
+    index = PriceIndex(backend).load()
+    index.price(product_id, pricelevel_id, uom_id)
+    index.lookup_many([(product_id, pricelevel_id, uom_id), ...])
+    index.prices_of(name)
+
+prices_of returns rows as ProductPricelist.list maps them, not the fields of
+the query of get_prices.
+
+When prices change in Dynamics, invalidate(product_id) reloads prices of
+the Product at its next lookup, invalidate() reloads all.
+
+numpy is used for lookup_many(as_array=True) when it is installed.
+"""
+import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .models import ProductPricelist
+
+logger = logging.getLogger(__name__)
+
+
+def _key(entity_id):
+    return entity_id.lower() if entity_id else None
+
+
+class PriceIndex(object):
+    """Prices keyed by (productid, pricelevelid, uomid)"""
+
+    def __init__(self, backend, page_size=None):
+        """
+        :param Dynamics backend: instance of Dynamics
+        :param int page_size: maximum rows of a page, default None: server decides
+        """
+        self._backend = backend
+        self.page_size = page_size
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._stale = set()
+        self._rows = {}
+        self._prices = {}
+        self._by_name = {}
+        self._matrix = None
+
+    def _add(self, row):
+        product_id = _key(row.get('productid'))
+        key = (product_id, _key(row.get('pricelevelid')), _key(row.get('uomid')))
+        self._rows.setdefault(product_id, []).append(row)
+        self._prices[key] = row.get('amount')
+        if row.get('product'):
+            self._by_name[row['product']] = product_id
+
+    def _drop(self, product_id):
+        for row in self._rows.pop(product_id, ()):
+            self._prices.pop((product_id, _key(row.get('pricelevelid')), _key(row.get('uomid'))), None)
+
+    def load(self):
+        """Load prices of all Products on all price lists
+
+        :return PriceIndex: self
+        """
+        rows = list(ProductPricelist(self._backend).scan(page_size=self.page_size))
+        with self._lock:
+            self._rows, self._prices, self._by_name = {}, {}, {}
+            for row in rows:
+                self._add(row)
+            self._stale = set()
+            self._matrix = None
+            self._loaded = True
+        logger.debug('Loaded %d prices of %d products', len(self._prices), len(self._rows))
+        return self
+
+    def invalidate(self, product_id=None):
+        """Mark prices of a Product or all prices changed, they are reloaded when they are looked up
+
+        :param str product_id: id of the Product, default None: all Products
+        """
+        with self._lock:
+            if product_id is None:
+                self._loaded = False
+            else:
+                self._stale.add(_key(product_id))
+                self._matrix = None
+
+    def _reload(self, product_ids):
+        handler = ProductPricelist(self._backend)
+        for product_id in product_ids:
+            rows = handler.list(extra=handler.create_filter('_productid_value eq %s' % product_id))
+            with self._lock:
+                self._drop(product_id)
+                for row in rows:
+                    self._add(row)
+                self._stale.discard(product_id)
+                self._matrix = None
+
+    def _ensure(self, product_ids=()):
+        """Load all if not loaded, reload stale Products of product_ids"""
+        if not self._loaded:
+            self.load()
+        stale = self._stale.intersection(product_ids)
+        if stale:
+            self._reload(stale)
+
+    def price(self, product_id, pricelevel_id, uom_id=None):
+        """Price of a Product on a price list in a unit, None if it has no price
+
+        :param str uom_id: id of unit, default None: the only unit the Product has on the price list
+        """
+        product_id = _key(product_id)
+        self._ensure((product_id, ))
+        if uom_id is not None:
+            return self._prices.get((product_id, _key(pricelevel_id), _key(uom_id)))
+        pricelevel_id = _key(pricelevel_id)
+        amounts = [self._prices[key] for key in self._keys_of(product_id) if key[1] == pricelevel_id]
+        return amounts[0] if len(amounts) == 1 else None
+
+    def _keys_of(self, product_id):
+        return [(product_id, _key(row.get('pricelevelid')), _key(row.get('uomid'))) for row in self._rows.get(product_id, ())]
+
+    def prices_of(self, name):
+        """Prices of a Product on all price lists by name of Product, as rows of ProductPricelist"""
+        self._ensure()
+        product_id = self._by_name.get(name)
+        if product_id is None:
+            return []
+        self._ensure((product_id, ))
+        return list(self._rows.get(product_id, ()))
+
+    def _build_matrix(self):
+        """Dense matrix of prices and positions of ids, the last position of each axis is for unknown ids"""
+        axes = [{}, {}, {}]
+        for key in self._prices:
+            for axis, entity_id in zip(axes, key):
+                axis.setdefault(entity_id, len(axis))
+        matrix = numpy.full(tuple(len(axis) + 1 for axis in axes), numpy.nan)
+        for key, amount in self._prices.items():
+            if amount is not None:
+                matrix[tuple(axis[entity_id] for axis, entity_id in zip(axes, key))] = amount
+        return matrix, axes
+
+    def lookup_many(self, keys, as_array=False):
+        """Prices of a batch of (productid, pricelevelid, uomid) keys
+
+        Keys are normalised and stale Products reloaded once for the batch.
+
+        :param list keys: tuples of productid, pricelevelid and uomid
+        :param bool as_array: return a numpy array with NaN for missing prices, needs numpy
+        :return list: prices in the order of keys, None for missing prices
+        """
+        keys = [(_key(product_id), _key(pricelevel_id), _key(uom_id)) for product_id, pricelevel_id, uom_id in keys]
+        self._ensure(set(key[0] for key in keys))
+        if not as_array:
+            prices = self._prices
+            return [prices.get(key) for key in keys]
+
+        if numpy is None:
+            raise RuntimeError('numpy is required by lookup_many(as_array=True)')
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = self._build_matrix()
+            matrix, axes = self._matrix
+        positions = [numpy.fromiter((axis.get(key[i], len(axis)) for key in keys), dtype=numpy.intp, count=len(keys))
+                     for i, axis in enumerate(axes)]
+        return matrix[tuple(positions)]
+
+    def __len__(self):
+        return len(self._prices)
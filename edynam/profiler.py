@@ -0,0 +1,244 @@
+"""Break down time of Handler calls into phases
+
+Time of every measured Handler call (see metrics.measured) is attributed to
+phases:
+
+    build: building and rendering FetchXML and query parameters
+    network: waiting for response headers and body chunks
+    decode: decoding JSON
+    map: mapping rows by Handler.map
+    other: the rest, e.g. post-processing rows of a report
+
+Wall and CPU time of a phase exclude time of phases nested in it, e.g. body
+chunks arriving while a page is decoded count to network, not decode.
+FetchXML queries of a call are kept with it. When profiling ends, the
+slowest calls are logged.
+
+    with profile(top=5) as prof:
+        Order(backend).get_product(...)
+    print(prof.report())
+
+or as a decorator:
+
+    @profile()
+    def monthly_report(): ...
+
+Calls are profiled in the thread they are made. Work of a call which runs in
+other threads is attributed to it by running it through bind, then phase times
+add up over threads and can be more than wall time of the call.
+"""
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('build', 'network', 'decode', 'map')
+_local = threading.local()
+_active = []
+_lock = threading.Lock()
+_END = object()
+
+
+class CallProfile(object):
+    """Time of phases and FetchXML queries of a Handler call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.phases = {phase_name: [0.0, 0.0] for phase_name in PHASES}
+        self.queries = []
+        # phases of worker threads bound to the call are added concurrently
+        self._lock = threading.Lock()
+
+    def add(self, phase_name, wall, cpu):
+        with self._lock:
+            times = self.phases[phase_name]
+            times[0] += wall
+            times[1] += cpu
+
+    @property
+    def other(self):
+        """Wall time not in any phase"""
+        return max(0.0, self.wall - sum(times[0] for times in self.phases.values()))
+
+    def to_dict(self):
+        return {'name': self.name, 'wall': self.wall, 'cpu': self.cpu, 'other': self.other,
+                'phases': {phase_name: {'wall': wall, 'cpu': cpu} for phase_name, (wall, cpu) in self.phases.items()},
+                'queries': list(self.queries)}
+
+    def __repr__(self):
+        return '%s %.3fs (%s, other %.3fs)' % (
+            self.name, self.wall, ', '.join('%s %.3fs' % (phase_name, self.phases[phase_name][0]) for phase_name in PHASES),
+            self.other)
+
+
+class phase(object):
+    """Context manager attributing time of a block to a phase of current call
+
+    It costs a lookup of a thread local when nothing is profiled.
+    """
+    __slots__ = ('name', '_call', '_start', '_cpu')
+
+    def __init__(self, name):
+        self.name = name
+        self._call = None
+
+    def __enter__(self):
+        call = getattr(_local, 'call', None)
+        if call is None:
+            return self
+        self._call = call
+        stack = _local.phases
+        now, cpu = time.perf_counter(), time.thread_time()
+        if stack:
+            # pause the enclosing phase
+            outer = stack[-1]
+            call.add(outer.name, now - outer._start, cpu - outer._cpu)
+        self._start, self._cpu = now, cpu
+        stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        call = self._call
+        if call is None:
+            return
+        self._call = None
+        stack = _local.phases
+        now, cpu = time.perf_counter(), time.thread_time()
+        call.add(self.name, now - self._start, cpu - self._cpu)
+        stack.pop()
+        if stack:
+            outer = stack[-1]
+            outer._start, outer._cpu = now, cpu
+
+
+def timed(iterable, phase_name):
+    """Attribute time of getting every item of iterable to a phase
+
+    iterable is returned as it is when nothing is profiled, e.g. chunks of a
+    streamed response are timed as network only when they are profiled.
+    """
+    if getattr(_local, 'call', None) is None:
+        return iterable
+    return _timed(iterable, phase_name)
+
+
+def _timed(iterable, phase_name):
+    items = iter(iterable)
+    while True:
+        with phase(phase_name):
+            item = next(items, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def record_query(fetch_xml):
+    """Keep a FetchXML query with current call"""
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call.queries.append(fetch_xml)
+
+
+@contextlib.contextmanager
+def call(name):
+    """Profile a Handler call, used by metrics.measured
+
+    Only the outermost call of a thread is profiled, calls made inside it are
+    part of it.
+    """
+    if not _active or getattr(_local, 'call', None) is not None:
+        yield None
+        return
+    profile_call = CallProfile(name)
+    _local.call, _local.phases = profile_call, []
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield profile_call
+    finally:
+        profile_call.wall = time.perf_counter() - start
+        profile_call.cpu = time.thread_time() - cpu
+        _local.call = _local.phases = None
+        with _lock:
+            for profiler in _active:
+                profiler.calls.append(profile_call)
+
+
+def bind(func):
+    """Wrap func to attribute its phases to the call of current thread when it runs in another thread"""
+    profile_call = getattr(_local, 'call', None)
+    if profile_call is None:
+        return func
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'call', None), getattr(_local, 'phases', None)
+        _local.call, _local.phases = profile_call, []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.call, _local.phases = previous
+    return bound
+
+
+class profile(contextlib.ContextDecorator):
+    """Profile Handler calls made inside, log the slowest when it ends
+
+    :param int top: number of the slowest calls to keep in slow query log
+    :param float threshold: only log calls slower than this in seconds, default 0
+    :param int log_level: level to log the slow query log, default WARNING
+    """
+
+    def __init__(self, top=10, threshold=0.0, log_level=logging.WARNING):
+        self.top = top
+        self.threshold = threshold
+        self.log_level = log_level
+        self.calls = []
+
+    def __enter__(self):
+        self.calls = []
+        with _lock:
+            _active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        with _lock:
+            _active.remove(self)
+        for profile_call in self.slowest():
+            logger.log(self.log_level, 'Slow call %r', profile_call)
+            for fetch_xml in profile_call.queries:
+                logger.log(self.log_level, '  %s', fetch_xml)
+        return False
+
+    def slowest(self):
+        """The slowest top calls slower than threshold, the slowest first"""
+        ordered = sorted((c for c in self.calls if c.wall > self.threshold), key=lambda c: c.wall, reverse=True)
+        return ordered[:self.top]
+
+    def totals(self):
+        """Wall and CPU time of phases summed over calls by name of calls"""
+        totals = {}
+        for profile_call in self.calls:
+            total = totals.setdefault(profile_call.name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'other': 0.0,
+                                                          'phases': {name: [0.0, 0.0] for name in PHASES}})
+            total['calls'] += 1
+            total['wall'] += profile_call.wall
+            total['cpu'] += profile_call.cpu
+            total['other'] += profile_call.other
+            for name, (wall, cpu) in profile_call.phases.items():
+                total['phases'][name][0] += wall
+                total['phases'][name][1] += cpu
+        return totals
+
+    def report(self):
+        """A table of phase times (wall/CPU in seconds) of calls by name"""
+        lines = ['%-40s %6s %16s %s %16s' % ('call', 'calls', 'wall/cpu',
+                                             ' '.join('%16s' % name for name in PHASES), 'other')]
+        for name, total in sorted(self.totals().items(), key=lambda item: item[1]['wall'], reverse=True):
+            lines.append('%-40s %6d %7.3f/%-8.3f %s %16.3f' % (
+                name, total['calls'], total['wall'], total['cpu'],
+                ' '.join('%7.3f/%-8.3f' % tuple(total['phases'][phase_name]) for phase_name in PHASES),
+                total['other']))
+        return '\n'.join(lines)
@@ -0,0 +1,143 @@
+import re
+
+from .dynamics import FORMATTED_VALUE_SUF
+
+_NON_IDENTIFIER = re.compile(r'\W')
+
+
+class Record(object):
+    """Base of compact records of mapped entities
+
+    A record keeps values in slots instead of a dict per row. Slots are
+    generated from keys a Handler is known to return, values of any other
+    keys are kept in a small dict. Values can be read as attributes, e.g.
+    record.email, or by their mapped keys, e.g. record['email'] so code
+    written for dicts keeps working. to_dict() converts it back to a dict.
+    """
+    __slots__ = ('_extra', )
+    _KEYS = ()
+    _ATTRS = ()
+    _INDEX = {}
+    _SOURCE = ()
+
+    def __init__(self, values):
+        """
+        :param dict values: a mapped entity, the output of Handler.map
+        """
+        extra = None
+        for key, value in values.items():
+            attr = self._INDEX.get(key)
+            if attr is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            else:
+                setattr(self, attr, value)
+        self._extra = extra
+
+    def __getattr__(self, name):
+        # only called when name is not a set slot
+        extra = object.__getattribute__(self, '_extra')
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        attr = self._INDEX.get(key)
+        if attr is not None:
+            try:
+                return getattr(self, attr)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """Convert to a dict with mapped keys as it was returned by Handler.map"""
+        converted = {}
+        for key, attr in zip(self._KEYS, self._ATTRS):
+            try:
+                converted[key] = getattr(self, attr)
+            except AttributeError:
+                pass
+        if self._extra:
+            converted.update(self._extra)
+        return converted
+
+    def __reduce__(self):
+        return _rebuild, (type(self).__name__, self._SOURCE, self.to_dict())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+
+def to_attr(key):
+    """Convert a mapped key into a valid attribute name
+
+    Formatted value key xxx@FORMATTED_VALUE_SUF becomes xxx_formatted.
+    """
+    if key.endswith('@' + FORMATTED_VALUE_SUF):
+        key = key[:-len(FORMATTED_VALUE_SUF) - 1] + '_formatted'
+    attr = _NON_IDENTIFIER.sub('_', key).strip('_')
+    if not attr or attr[0].isdigit():
+        attr = 'f_' + attr
+    return attr
+
+
+_types = {}
+
+
+def _rebuild(name, keys, values):
+    return make_record_type(name, keys)(values)
+
+
+def make_record_type(name, keys):
+    """Create a Record class which has a slot of each key
+
+    Classes are cached by name and keys, records of them can be pickled.
+
+    :param str name: name of the class
+    :param iterable keys: mapped keys, duplicated keys are ignored
+    """
+    keys = tuple(keys)
+    if (name, keys) in _types:
+        return _types[(name, keys)]
+
+    index = {}
+    ordered = []
+    for key in keys:
+        if key in index:
+            continue
+        attr = to_attr(key)
+        if attr in index.values() or hasattr(Record, attr):
+            attr = attr + '_'
+        index[key] = attr
+        ordered.append(key)
+    attrs = tuple(index[key] for key in ordered)
+    record_type = type(name, (Record, ), {'__slots__': attrs,
+                                          '_KEYS': tuple(ordered),
+                                          '_ATTRS': attrs,
+                                          '_INDEX': index,
+                                          '_SOURCE': keys})
+    return _types.setdefault((name, keys), record_type)
@@ -0,0 +1,228 @@
+"""Run jobs of a report concurrently by their dependencies
+
+A report declares its queries as jobs and the jobs each of them depends
+on. Jobs whose dependencies are done run concurrently on the shared
+backend, so wall time of a run is set by its critical path, not by the sum
+of all queries. Results of dependencies are passed to a job as keyword
+arguments named after them:
+
+    runner = ReportRunner()
+    runner.add('product_id', Product(backend).get_id_of, 'TANGO Cloud VM')
+    runner.add('props', Product(backend).get_property_definitions, 'TANGO Cloud VM')
+    runner.add('usernames', Contact(backend).get_usernames)
+    runner.add('lines', lambda product_id, props: Order(backend).get_product(product_id, prod_props=props),
+               deps=('product_id', 'props'))
+    runner.add('report', join, deps=('lines', 'usernames'))
+    run = runner.run()
+    run['report'], run.critical_path()
+
+Jobs which call the same function with the same arguments run only once in
+a run, the others reuse its result.
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """A function to call with its arguments and names of jobs it depends on"""
+
+    def __init__(self, name, func, args=(), kwargs=None, deps=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.deps = tuple(deps)
+
+    def cache_key(self):
+        """Identity of the call of a job without dependencies, None if arguments are not hashable"""
+        if self.deps:
+            return None
+        key = (self.func, self.args, tuple(sorted(self.kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __repr__(self):
+        return 'Job(%s, deps=%s)' % (self.name, list(self.deps))
+
+
+class Run(object):
+    """Results and timings of a run of a ReportRunner"""
+
+    def __init__(self, jobs):
+        self._jobs = jobs
+        self.results = {}
+        # name of job -> (start, end) in seconds since the run started
+        self.timings = {}
+        self.wall = 0.0
+
+    def __getitem__(self, name):
+        return self.results[name]
+
+    def __contains__(self, name):
+        return name in self.results
+
+    def duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def critical_path(self):
+        """Names of jobs on the longest chain of dependencies by their durations and its total duration
+
+        :return tuple: list of names in the order they ran, seconds
+        """
+        longest = {}
+
+        def path(name):
+            if name not in longest:
+                chains = [path(dep) for dep in self._jobs[name].deps if dep in self.timings]
+                before = max(chains, key=lambda chain: chain[1]) if chains else ([], 0.0)
+                longest[name] = (before[0] + [name], before[1] + self.duration(name))
+            return longest[name]
+
+        chains = [path(name) for name in self.timings]
+        return max(chains, key=lambda chain: chain[1]) if chains else ([], 0.0)
+
+    def summary(self):
+        """Lines of timings of jobs and the critical path"""
+        names, total = self.critical_path()
+        lines = ['%-32s %9s %9s %s' % ('job', 'start', 'seconds', 'critical')]
+        for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            lines.append('%-32s %9.3f %9.3f %s' % (name, start, end - start, '*' if name in names else ''))
+        lines.append('wall %.3f seconds, critical path %.3f seconds: %s' % (self.wall, total, ' -> '.join(names)))
+        return '\n'.join(lines)
+
+
+class ReportRunner(object):
+    """Jobs of a report and their dependencies, run concurrently"""
+
+    def __init__(self, max_workers=8):
+        """
+        :param int max_workers: maximum number of jobs running at the same time, default 8
+        """
+        self.max_workers = max_workers
+        self._jobs = {}
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        """Add a job
+
+        :param str name: unique name of the job, dependent jobs receive its result as a keyword argument of this name
+        :param callable func: the function of the job
+        :param args: positional arguments of func
+        :param tuple deps: names of jobs this job depends on
+        :param kwargs: keyword arguments of func
+        :return ReportRunner: self
+        """
+        if name in self._jobs:
+            raise ValueError('Job %s has been added' % name)
+        self._jobs[name] = Job(name, func, args, kwargs, deps)
+        return self
+
+    def job(self, name=None, deps=()):
+        """Decorator to add a function as a job which only takes results of its dependencies"""
+        def decorator(func):
+            self.add(name or func.__name__, func, deps=deps)
+            return func
+        return decorator
+
+    def _required(self, targets):
+        """Names of jobs needed by targets, checks dependencies exist and have no cycle"""
+        required, visiting = set(), set()
+
+        def visit(name):
+            if name not in self._jobs:
+                raise ValueError('Unknown job %s' % name)
+            if name in required:
+                return
+            if name in visiting:
+                raise ValueError('Jobs depend on each other in a cycle: %s' % name)
+            visiting.add(name)
+            for dep in self._jobs[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            required.add(name)
+
+        for name in targets:
+            visit(name)
+        return required
+
+    def run(self, targets=None):
+        """Run jobs needed by targets, independent jobs run concurrently
+
+        The first error of a job is raised after running jobs finish, jobs
+        which have not started are cancelled.
+
+        :param list targets: names of jobs to run with their dependencies, default None: all jobs
+        :return Run: results and timings
+        """
+        required = self._required(targets if targets is not None else list(self._jobs))
+        run = Run(self._jobs)
+        pending = set(required)
+        cache = {}
+        start = time.perf_counter()
+
+        def call(job):
+            begin = time.perf_counter() - start
+            kwargs = dict(job.kwargs)
+            kwargs.update((dep, run.results[dep]) for dep in job.deps)
+            result = job.func(*job.args, **kwargs)
+            return result, begin, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running, futures, error = {}, {}, None
+
+            def schedule():
+                """Start jobs whose dependencies are done, return if any job is started or reused"""
+                progressed = False
+                for name in sorted(pending):
+                    job = self._jobs[name]
+                    if any(dep not in run.results for dep in job.deps):
+                        continue
+                    pending.discard(name)
+                    progressed = True
+                    key = job.cache_key()
+                    first = cache.get(key) if key is not None else None
+                    if first in run.results:
+                        run.results[name], run.timings[name] = run.results[first], run.timings[first]
+                    elif first is not None:
+                        # the same call is running: share its result
+                        running[futures[first]].append(name)
+                    else:
+                        futures[name] = executor.submit(call, job)
+                        running[futures[name]] = [name]
+                        if key is not None:
+                            cache[key] = name
+                return progressed
+
+            while pending or running:
+                if error is None:
+                    while schedule():
+                        pass
+                    if pending and not running:
+                        raise RuntimeError('Jobs cannot run: %s' % ', '.join(sorted(pending)))
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    names = running.pop(future)
+                    try:
+                        result, begin, end = future.result()
+                    except Exception as err:
+                        logger.error('Job %s failed: %s', names[0], err)
+                        if error is None:
+                            error = err
+                        continue
+                    for name in names:
+                        run.results[name] = result
+                        run.timings[name] = (begin, end)
+            if error is not None:
+                raise error
+        run.wall = time.perf_counter() - start
+        logger.info('Report run took %.3f seconds, critical path %.3f seconds', run.wall, run.critical_path()[1])
+        return run
@@ -0,0 +1,100 @@
+"""Convert values of mapped entities to Python types
+
+Dynamics returns dates, money and ids as JSON strings and floats. A Handler
+declares types of its output names in TYPES, e.g.
+
+    TYPES = {'validfromdate': 'date', 'price': 'money', 'productid': 'guid'}
+
+and a Handler created with typed=True converts them:
+
+    datetime  2016-10-20T02:19:54Z -> datetime in the local time zone
+    date      2016-10-20 -> date
+    money     10.5 -> Decimal('10.5')
+    cents     10.5 -> 1050, fixed-point int of hundredths
+    guid      C3724CBC-B183-E611-80E7-C4346BC4BEAC -> c3724cbc-b183-e611-80e7-c4346bc4beac
+
+Rows are converted a column at a time and every distinct value of a column
+is converted once, dates and ids repeat a lot in a page. None stays None.
+"""
+import uuid
+import logging
+from decimal import Decimal
+from datetime import datetime, date, timezone
+
+logger = logging.getLogger(__name__)
+
+_timezone = None
+
+
+def local_timezone():
+    """Time zone dates are converted to, the local time zone found once unless it is set"""
+    global _timezone
+    if _timezone is None:
+        _timezone = datetime.now(timezone.utc).astimezone().tzinfo
+    return _timezone
+
+
+def set_timezone(tz):
+    """Convert dates to tz instead of the local time zone, None resets to the local time zone"""
+    global _timezone
+    _timezone = tz
+
+
+def to_datetime(value):
+    moment = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    return moment.astimezone(local_timezone())
+
+
+def to_date(value):
+    return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def to_money(value):
+    # repr of a float is the shortest string which reads back to it: 0.1 -> Decimal('0.1')
+    return Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+
+
+def to_cents(value):
+    return int((to_money(value) * 100).to_integral_value())
+
+
+def to_guid(value):
+    return str(uuid.UUID(value))
+
+
+CONVERTERS = {
+    'datetime': to_datetime,
+    'date': to_date,
+    'money': to_money,
+    'cents': to_cents,
+    'guid': to_guid,
+}
+
+
+def convert_column(values, type_name):
+    """Convert a list of values of a type, each distinct value once"""
+    convert = CONVERTERS[type_name]
+    converted = {None: None}
+    for value in set(values):
+        if value not in converted:
+            converted[value] = convert(value)
+    return [converted[value] for value in values]
+
+
+def convert_rows(rows, types):
+    """Convert values of rows in place by types: {name: type name}, names rows do not have are skipped
+
+    :param list rows: dicts of mapped entities, e.g. rows of a page
+    :param dict types: names to keys of CONVERTERS
+    :return list: rows
+    """
+    for name, type_name in types.items():
+        if type_name not in CONVERTERS:
+            raise ValueError('Unknown type %s of %s, known types: %s' % (type_name, name, ', '.join(sorted(CONVERTERS))))
+        present = [row for row in rows if name in row]
+        if not present:
+            continue
+        column = convert_column([row[name] for row in present], type_name)
+        for row, value in zip(present, column):
+            row[name] = value
+    return rows
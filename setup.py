@@ -9,6 +9,9 @@ setup(name='ersa-Dynamics',
       author='eResearch SA',
       packages=['edynam'],
       install_requires=['cryptography', 'adal'],
+      entry_points={
+          'console_scripts': ['edynam=edynam.cli:main']
+      },
       classifiers=[
           'License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)',
           'Programming Language :: Python :: 3',
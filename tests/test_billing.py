@@ -0,0 +1,69 @@
+import unittest
+import xml.etree.ElementTree as ET
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import billing
+from edynam.dynamics import Dynamics
+from edynam.models import Order
+
+
+def line(biller, product, leader, allocated, price, manual=None, volume=None):
+    row = {'biller': biller, 'product': product, 'leader': leader, 'allocated': allocated, 'unitPrice': price}
+    if manual is not None:
+        row['manualdiscountamount'] = manual
+    if volume is not None:
+        row['volumediscountamount'] = volume
+    return row
+
+
+@unittest.skipIf(billing.numpy is None, 'numpy is not installed')
+class TestBillingEngine(unittest.TestCase):
+    def setUp(self):
+        self.rows = [line('Uni A', 'vm', 'Ann', 2, 10.0, manual=5.0),
+                     line('Uni A', 'vm', None, 1, 10.0, volume=1.0),
+                     line('Uni B', 'disk', 'Bob', 3, 100.0),
+                     line('Uni A', 'disk', 'Ann', 1, None)]
+        self.engine = billing.BillingEngine.from_rows(iter(self.rows), keys=('biller', 'product', 'leader'))
+
+    def test_columns(self):
+        columns = billing.to_columns(self.rows, keys=('leader', ))
+        self.assertEqual(columns['leader'].tolist(), ['Ann', '', 'Bob', 'Ann'])
+        self.assertEqual(columns['unitPrice'].tolist(), [10.0, 10.0, 100.0, 0.0])
+        self.assertEqual(columns['manualdiscountamount'].tolist(), [5.0, 0.0, 0.0, 0.0])
+
+    def test_charges(self):
+        self.assertEqual(self.engine.gross().tolist(), [20.0, 10.0, 300.0, 0.0])
+        self.assertEqual(self.engine.charges().tolist(), [15.0, 9.0, 300.0, 0.0])
+        self.assertEqual(self.engine.discounts().tolist(), [5.0, 1.0, 0.0, 0.0])
+
+    def test_totals(self):
+        totals = self.engine.totals(by=('biller', ))
+        self.assertEqual([total['biller'] for total in totals], ['Uni A', 'Uni B'])
+        self.assertEqual(totals[0], {'biller': 'Uni A', 'lines': 3, 'quantity': 4.0, 'gross': 30.0, 'discount': 6.0, 'charge': 24.0})
+        self.assertEqual(totals[1]['charge'], 300.0)
+
+        totals = self.engine.totals(by=('biller', 'product', 'leader'))
+        self.assertEqual([(total['biller'], total['product'], total['leader'], total['charge']) for total in totals],
+                         [('Uni A', 'disk', 'Ann', 0.0), ('Uni A', 'vm', '', 9.0), ('Uni A', 'vm', 'Ann', 15.0),
+                          ('Uni B', 'disk', 'Bob', 300.0)])
+        grand, = self.engine.totals()
+        self.assertEqual((grand['lines'], grand['charge']), (4, 324.0))
+
+    def test_empty(self):
+        engine = billing.BillingEngine.from_rows([], keys=('biller', ))
+        self.assertEqual(engine.charges().tolist(), [])
+        self.assertEqual(engine.totals(by=('biller', )), [])
+
+    def test_get_product_with_discounts(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        with patch.object(Dynamics, 'get', return_value=[]) as mocked_get:
+            Order(backend).get_product('product-1', discounts=True)
+        fetch = ET.fromstring(mocked_get.call_args[0][1]['fetchXml'])
+        aliases = [attr.get('alias') for attr in fetch.iter('attribute')]
+        self.assertIn('manualdiscountamount', aliases)
+        self.assertIn('volumediscountamount', aliases)
+
+
+if __name__ == '__main__':
+    unittest.main()
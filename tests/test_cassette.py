@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from .context import edynam
+from edynam.cassette import RecordingTransport, ReplayTransport, replay
+from edynam.dynamics import Dynamics
+from edynam.models import Contact
+
+
+def fake_response(body, status_code=200):
+    response = MagicMock(status_code=status_code, headers={'Content-Type': 'application/json', 'Authorization': 'secret'})
+    response.content = json.dumps(body).encode('utf-8')
+    return response
+
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'contacts.jsonl.gz')
+        self.pages = [
+            {'value': [{'contactid': 'c1', 'emailaddress1': 'a@b.c'}], '@odata.nextLink': 'https://mocked/api/data/v8.2/contacts?$skiptoken=1'},
+            {'value': [{'contactid': 'c2', 'emailaddress1': 'd@e.f'}]},
+        ]
+        live = MagicMock()
+        live.get.side_effect = [fake_response(page) for page in self.pages]
+        conn = MagicMock(resource='https://mocked')
+        conn.generate_auth_header.return_value = {'Authorization': 'Bearer secret'}
+        recorder = Dynamics(conn, transport=RecordingTransport(self.path, live))
+        self.recorded = list(Contact(recorder).scan(selects={'$select': 'emailaddress1'}))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_replay(self):
+        self.assertEqual([row['email'] for row in self.recorded], ['a@b.c', 'd@e.f'])
+        backend = replay(self.path)
+        self.assertEqual(list(Contact(backend).scan(selects={'$select': 'emailaddress1'})), self.recorded)
+        # the same request is repeated
+        self.assertEqual(list(Contact(backend).scan(selects={'$select': 'emailaddress1'})), self.recorded)
+        self.assertEqual(Contact(backend).list(selects={'$select': 'emailaddress1'}), self.recorded[:1])
+
+    def test_no_secrets(self):
+        import gzip
+        with gzip.open(self.path, 'rt') as cf:
+            self.assertNotIn('secret', cf.read())
+
+    def test_unknown_request(self):
+        with self.assertRaises(LookupError):
+            replay(self.path).get('accounts')
+
+    def test_latency(self):
+        backend = Dynamics(MagicMock(resource='https://mocked'), transport=ReplayTransport(self.path, latency=0.05))
+        start = time.perf_counter()
+        list(Contact(backend).scan(selects={'$select': 'emailaddress1'}))
+        # two pages
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam.catalogue import ProductCatalogue
+from edynam.dynamics import Dynamics
+
+FORMATTED = '@OData.Community.Display.V1.FormattedValue'
+
+
+def product(name, parent=None, product_type='Services'):
+    return {'productid': name.upper(), 'name': name, '_parentproductid_value': parent,
+            'producttypecode': 1, 'producttypecode' + FORMATTED: product_type}
+
+
+def link(source, target, relationship='Accessory', direction=0, state=0):
+    return {'productsubstituteid': source + target, '_productid_value': source.upper(),
+            '_substitutedproductid_value': target.upper(), 'statecode': state,
+            'salesrelationshiptype': 2, 'salesrelationshiptype' + FORMATTED: relationship,
+            'direction': direction}
+
+
+class TestProductCatalogue(unittest.TestCase):
+    def setUp(self):
+        products = [product('family'), product('vm', 'FAMILY'), product('disk', 'VM'), product('backup'),
+                    product('bundle', product_type='Miscellaneous Charges'), product('support'), product('loop')]
+        links = [link('vm', 'disk'), link('disk', 'backup'), link('bundle', 'vm'), link('bundle', 'support'),
+                 link('backup', 'vm'), link('vm', 'support', relationship='Substitute'),
+                 link('support', 'loop', direction=1), link('vm', 'loop', state=1)]
+
+        def iter_rows(end_point, params={}, page_size=None):
+            return iter(products if end_point == 'products' else links)
+
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        with patch.object(Dynamics, 'iter_rows', side_effect=iter_rows) as mocked_rows:
+            self.catalogue = ProductCatalogue(backend).load()
+        self.assertEqual(mocked_rows.call_count, 2)
+
+    @staticmethod
+    def names(products):
+        return [item['name'] for item in products]
+
+    def test_lookups(self):
+        self.assertEqual(len(self.catalogue), 7)
+        self.assertIn('vm', self.catalogue)
+        self.assertEqual(self.catalogue.get('vm')['name'], 'vm')
+        self.assertEqual(self.catalogue.find('disk')['productid'], 'DISK')
+        self.assertIsNone(self.catalogue.find('nothing'))
+
+    def test_accessory_closure(self):
+        self.assertEqual(self.names(self.catalogue.accessories('vm', transitive=False)), ['disk'])
+        # backup links back to vm: the cycle is cut
+        self.assertEqual(self.names(self.catalogue.accessories('vm')), ['disk', 'backup'])
+        # inactive and non-accessory relationships are ignored, bi-directional ones work both ways
+        self.assertEqual(self.names(self.catalogue.accessories('loop')), ['support'])
+        self.assertEqual(self.catalogue.accessories('family'), [])
+
+    def test_hierarchy(self):
+        self.assertEqual(self.names(self.catalogue.ancestors('disk')), ['vm', 'family'])
+        self.assertEqual(self.catalogue.parent('vm')['name'], 'family')
+        self.assertIsNone(self.catalogue.parent('family'))
+        self.assertEqual(self.catalogue.family('disk')['name'], 'family')
+        self.assertEqual(self.catalogue.family('family')['name'], 'family')
+        self.assertEqual(self.names(self.catalogue.children('family')), ['vm'])
+        self.assertEqual(self.names(self.catalogue.descendants('family')), ['vm', 'disk'])
+
+    def test_prices_as(self):
+        self.assertEqual(self.names(self.catalogue.prices_as('vm')), ['vm', 'disk', 'backup'])
+        # a pseudo product is priced by its accessories only
+        self.assertEqual(self.names(self.catalogue.prices_as('bundle')), ['vm', 'disk', 'backup', 'support', 'loop'])
+        self.assertEqual(self.names(self.catalogue.prices_as('family')), ['family'])
+        self.assertEqual(self.catalogue.prices_as('unknown'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import cli
+from edynam.models import Contact, Order
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_parse_role(self):
+        args = cli.build_parser().parse_args(['report', 'product', 'TANGO Cloud VM', '--role', 'id-1:leader', '--role', 'id-2:admin'])
+        self.assertEqual(args.role, [{'id': 'id-1', 'name': 'leader'}, {'id': 'id-2', 'name': 'admin'}])
+        with self.assertRaises(SystemExit):
+            with patch('sys.stderr', io.StringIO()):
+                cli.build_parser().parse_args(['report', 'account', 'id', '--role', 'no-name'])
+
+    def test_find_handler(self):
+        self.assertIs(cli.find_handler('contact'), Contact)
+        self.assertIs(cli.find_handler('Contacts'), Contact)
+        self.assertIs(cli.find_handler('salesorder'), Order)
+        with self.assertRaises(KeyError):
+            cli.find_handler('unknown')
+
+    def test_no_heavy_imports(self):
+        code = 'import sys, edynam.cli; print(any(m in sys.modules for m in ("requests", "adal", "edynam.models")))'
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=path)
+        self.assertEqual(output.strip(), b'False')
+
+    def test_public_names_imported_lazily(self):
+        code = ('import sys, edynam; before = "edynam.dynamics" in sys.modules; '
+                'from edynam import ADALConnection, Dynamics; print(before, Dynamics.__module__, ADALConnection.__module__)')
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=path)
+        self.assertEqual(output.split(), [b'False', b'edynam.dynamics', b'edynam.connection'])
+        with self.assertRaises(AttributeError):
+            edynam.unknown_name
+
+    def test_list(self):
+        backend = MagicMock()
+        backend.iter_rows.return_value = iter([{'fullname': 'A', 'emailaddress1': 'a@b.c'}])
+        out = io.StringIO()
+        with patch('edynam.connect', return_value=backend):
+            args = cli.build_parser().parse_args(['list', 'contact', '--select', 'fullname,emailaddress1', '--top', '5'])
+            self.assertEqual(cli.run(args, out), 0)
+        self.assertEqual(json.loads(out.getvalue()), [{'fullname': 'A', 'email': 'a@b.c'}])
+        params = backend.iter_rows.call_args[0][1]
+        self.assertEqual(params['$select'], 'fullname,emailaddress1')
+        self.assertEqual(params['$top'], '5')
+
+    def test_report_output_keys_of_all_rows(self):
+        rows = [{'name': 'first'}, {'name': 'second', 'leader': 'Ann'}]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'account.csv')
+            with patch('edynam.connect', return_value=MagicMock()), patch('sys.stderr', io.StringIO()), \
+                    patch.object(Order, 'get_account_products', return_value=rows):
+                args = cli.build_parser().parse_args(['report', 'account', 'id', '--output', path])
+                self.assertEqual(cli.run(args, io.StringIO()), 0)
+            with open(path) as exported:
+                self.assertEqual(exported.read().splitlines(), ['name,leader', 'first,', 'second,Ann'])
+
+    def test_for_codes_output_a_row_of_each_code(self):
+        codes = {'order-1': ['0801: Artificial Intelligence', '0806: Information Systems'], 'order-2': []}
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'codes.csv')
+            with patch('edynam.connect', return_value=MagicMock()), patch('sys.stderr', io.StringIO()), \
+                    patch.object(Order, 'get_for_codes', return_value=codes):
+                args = cli.build_parser().parse_args(['report', 'for-codes', '--order', 'order-1', '--output', path])
+                self.assertEqual(cli.run(args, io.StringIO()), 0)
+            with open(path) as exported:
+                self.assertEqual(exported.read().splitlines(), [
+                    'salesorderid,code', 'order-1,0801: Artificial Intelligence', 'order-1,0806: Information Systems'])
+
+    def test_export_csv(self):
+        backend = MagicMock()
+        backend.iter_rows.return_value = iter([{'name': 'A', 'websiteurl': None}, {'name': 'B', 'websiteurl': 'b'}])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'accounts.csv')
+            with patch('edynam.connect', return_value=backend), patch('sys.stderr', io.StringIO()):
+                args = cli.build_parser().parse_args(['export', 'account', path, '--format', 'csv'])
+                self.assertEqual(cli.run(args, io.StringIO()), 0)
+            with open(path) as exported:
+                # columns are all keys Account maps entities to
+                self.assertEqual(exported.read().splitlines(), [
+                    'accountid,name,websiteurl,_primarycontactid_value,parent_account,parentaccountid,manager,email,primarycontactid',
+                    ',A,,,,,,,', ',B,b,,,,,,'])
@@ -0,0 +1,54 @@
+import json
+import random
+import unittest
+
+from .context import edynam
+from edynam.decoding import StreamingDecoder, default_loads
+
+
+def chunked(body, size):
+    data = body.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestStreamingDecoder(unittest.TestCase):
+    def setUp(self):
+        self.rows = [{'name': 'Ünïcode %d' % i, 'amount': 1234.5 + i, 'count': 10 ** i,
+                      'flag': i % 2 == 0, 'none': None, 'nested': {'x': [1, 2, 'a,]}']}}
+                     for i in range(20)]
+        self.page = {'@odata.context': 'https://mocked/$metadata#salesorders',
+                     'value': self.rows,
+                     '@odata.count': 12345,
+                     '@odata.nextLink': 'https://mocked/next'}
+
+    def test_rows_and_annotations(self):
+        body = json.dumps(self.page, ensure_ascii=False)
+        for size in (1, 2, 3, 7, 64, len(body) * 2):
+            decoder = StreamingDecoder(chunked(body, size))
+            self.assertEqual(list(decoder), self.rows)
+            self.assertTrue(decoder.has_value)
+            self.assertEqual(decoder.annotations['@odata.count'], 12345)
+            self.assertEqual(decoder.annotations['@odata.nextLink'], 'https://mocked/next')
+
+    def test_whitespace(self):
+        body = json.dumps(self.page, indent=4)
+        decoder = StreamingDecoder(chunked(body, random.randint(1, 50)))
+        self.assertEqual(list(decoder), self.rows)
+
+    def test_empty_value(self):
+        decoder = StreamingDecoder([b'{"@odata.context": "x", "value": [ ]}'])
+        self.assertEqual(list(decoder), [])
+        self.assertTrue(decoder.has_value)
+
+    def test_no_value(self):
+        decoder = StreamingDecoder([b'{"@odata.context": "x", "name": "single"}'])
+        self.assertEqual(list(decoder), [])
+        self.assertFalse(decoder.has_value)
+        self.assertEqual(decoder.annotations['name'], 'single')
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(StreamingDecoder([b'{"value": [{"a": 1}, {"b"']))
+
+    def test_default_loads(self):
+        self.assertEqual(default_loads()(b'{"value": [1]}'), {'value': [1]})
@@ -0,0 +1,75 @@
+import json
+import unittest
+import warnings
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam.diagnostics import RepeatedQueryWarning, RequestBudgetExceeded, RequestTrace
+from edynam.dynamics import Dynamics
+from edynam.models import Contact, DynamicPropertyOptionsetItem
+
+
+def fake_response(body, status_code=200):
+    response = MagicMock(status_code=status_code, headers={'Retry-After': '0'})
+    response.content = json.dumps(body).encode('utf-8')
+    response.iter_content.return_value = [response.content]
+    return response
+
+
+class TestDiagnostics(unittest.TestCase):
+    def setUp(self):
+        self.backend = Dynamics(MagicMock(resource='http://mocked'), coalesce=False)
+
+    def test_repeated_query_warned_once(self):
+        with patch('requests.get', side_effect=lambda *args, **kwargs: fake_response({'value': [{'dynamicpropertyoptionname': 'One'}]})):
+            with self.assertWarns(RepeatedQueryWarning) as caught:
+                with self.backend.diagnose(threshold=3) as trace:
+                    handler = DynamicPropertyOptionsetItem(self.backend)
+                    for i in range(5):
+                        handler.get_option_value('property-%d' % i, 1)
+        self.assertIn('dynamicpropertyoptionsetitems repeated 3 times', str(caught.warning))
+        self.assertEqual(trace.requests, 5)
+        self.assertEqual(trace.warned, [('dynamicpropertyoptionsetitems', 'DynamicPropertyOptionsetItem.list')])
+        self.assertEqual(trace.repeated(), [(trace.warned[0], 5)])
+        self.assertNotIn(trace, self.backend._listeners)
+
+    def test_pages_of_a_query_not_repeated(self):
+        pages = [fake_response({'value': [{'contactid': i}], '@odata.nextLink': 'http://mocked/next'}) for i in range(3)]
+        pages.append(fake_response({'value': [{'contactid': 3}]}))
+        with patch('requests.get', side_effect=pages):
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', RepeatedQueryWarning)
+                with self.backend.diagnose(threshold=2) as trace:
+                    self.assertEqual(len(list(Contact(self.backend).scan())), 4)
+        self.assertEqual(trace.requests, 4)
+        self.assertEqual(trace.queries, {('contacts', ''): 1})
+
+    def test_request_budget(self):
+        with patch('requests.get', side_effect=lambda *args, **kwargs: fake_response({'value': []})):
+            with self.backend.request_budget(2):
+                self.backend.get('contacts')
+                self.backend.get('accounts')
+            with self.assertRaises(RequestBudgetExceeded) as raised:
+                with self.backend.request_budget(2):
+                    for _ in range(3):
+                        self.backend.get('contacts')
+        self.assertIsInstance(raised.exception, AssertionError)
+        self.assertIn('3 requests exceed the budget of 2', str(raised.exception))
+        # errors of the scope are not replaced by the budget
+        with self.assertRaises(KeyError):
+            with self.backend.request_budget(0):
+                with patch('requests.get', return_value=fake_response({'value': []})):
+                    self.backend.get('contacts')
+                raise KeyError('failed')
+
+    def test_report(self):
+        trace = RequestTrace(threshold=None)
+        for end_point in ('contacts', 'accounts({id})', 'accounts({id})'):
+            trace({'type': 'request', 'end_point': end_point, 'operation': None, 'page': 1})
+        trace({'type': 'operation', 'operation': 'Account.get'})
+        self.assertEqual(trace.report().splitlines(), ['3 requests, 3 queries', '     2  accounts({id})  ',
+                                                       '     1  contacts  '])
+
+
+if __name__ == '__main__':
+    unittest.main()
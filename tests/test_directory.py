@@ -0,0 +1,70 @@
+import unittest
+import xml.etree.ElementTree as ET
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam.directory import ContactDirectory
+from edynam.dynamics import Dynamics
+from edynam.models import Account
+
+
+def contact(i, unit='unit-1', biller='biller-1', **extra):
+    row = {'contactid': 'CONTACT-%d' % i, 'username': 'user%d' % i, 'manager': 'Name %d' % i,
+           'email': 'User%d@Mocked' % i, 'modifiedon': '2017-10-0%dT00:00:00Z' % i}
+    if unit:
+        row.update({'unitid': unit, 'unit': unit.title()})
+    if biller:
+        row.update({'billerid': biller, 'biller': biller.title()})
+    row.update(extra)
+    return row
+
+
+class TestContactDirectory(unittest.TestCase):
+    def setUp(self):
+        self.backend = Dynamics(MagicMock(resource='http://mocked'))
+        self.rows = [contact(1), contact(2, unit='unit-2', biller=None), contact(3, unit='unit-3')]
+        with patch.object(Dynamics, 'iter_rows', return_value=iter(self.rows)) as mocked_rows:
+            self.directory = ContactDirectory(self.backend).load()
+        fetch = ET.fromstring(mocked_rows.call_args[0][1]['fetchXml'])
+        self.assertIn('new_username', [cond.get('attribute') for cond in fetch.iter('condition')])
+
+    def test_lookups(self):
+        self.assertEqual(len(self.directory), 3)
+        self.assertEqual(self.directory.get_by_username('user2')['unit'], 'Unit-2')
+        self.assertEqual(self.directory.get_by_email('user1@mocked')['contactid'], 'CONTACT-1')
+        self.assertEqual(self.directory.get('contact-3')['biller'], 'Biller-1')
+        self.assertIsNone(self.directory.get_by_username('nobody'))
+
+    def test_usernames_of_unit_and_biller(self):
+        self.assertEqual([row['username'] for row in self.directory.usernames_of('unit-2')], ['user2'])
+        self.assertEqual([row['username'] for row in self.directory.usernames_of('BILLER-1')], ['user1', 'user3'])
+        self.assertEqual(set(self.directory.usernames_of('unit-1')[0]), {'contactid', 'username', 'manager', 'email', 'unit'})
+        self.assertEqual(self.directory.usernames_of('unknown'), [])
+        # contacts without biller are not in usernames, as in Contact.get_usernames
+        self.assertEqual(sorted(row['username'] for row in self.directory.usernames()), ['user1', 'user3'])
+
+    def test_incremental_refresh(self):
+        changed = [contact(1, unit='unit-2', modifiedon='2017-11-01T00:00:00Z'),
+                   contact(3, username=None, modifiedon='2017-11-02T00:00:00Z'),
+                   contact(4, modifiedon='2017-11-03T00:00:00Z')]
+        with patch.object(Dynamics, 'iter_rows', return_value=iter(changed)) as mocked_rows:
+            self.assertEqual(self.directory.refresh(), 3)
+        fetch = ET.fromstring(mocked_rows.call_args[0][1]['fetchXml'])
+        since, = [cond.get('value') for cond in fetch.iter('condition') if cond.get('attribute') == 'modifiedon']
+        self.assertEqual(since, '2017-10-03T00:00:00Z')
+        self.assertEqual(self.directory.modified_since, '2017-11-03T00:00:00Z')
+
+        self.assertEqual([row['username'] for row in self.directory.usernames_of('unit-2')], ['user1', 'user2'])
+        self.assertEqual([row['username'] for row in self.directory.usernames_of('unit-1')], ['user4'])
+        self.assertIsNone(self.directory.get_by_username('user3'))
+        self.assertIsNone(self.directory.get('contact-3'))
+
+    def test_account_usernames_from_directory(self):
+        with patch.object(Dynamics, 'get') as mocked_get:
+            rows = Account(self.backend).get_usernames('unit-3', directory=self.directory)
+        self.assertFalse(mocked_get.called)
+        self.assertEqual([row['username'] for row in rows], ['user3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
+import json
+import time
 import unittest
-from unittest.mock import patch
+import threading
+import xml.etree.ElementTree as ET
+from unittest.mock import MagicMock, patch
 
 from .context import edynam
 from edynam.connection import ADALConnection
@@ -35,3 +39,237 @@ class TestDynamicsMethods(unittest.TestCase):
                     dynamics.get('some_end_point')
         self.assertTrue(mocked_content.called)
         self.assertEqual(mocked_content.call_count, 2)
+
+    def test_iter_rows_follows_pages(self):
+        pages = [
+            {'value': [{'id': 1}, {'id': 2}], '@odata.nextLink': 'mocked/next'},
+            {'value': [{'id': 3}], '@Microsoft.Dynamics.CRM.morerecords': True},
+        ]
+        responses = []
+        for page in pages:
+            response = MagicMock(status_code=200)
+            response.iter_content.return_value = [json.dumps(page).encode()]
+            responses.append(response)
+        dynamics = Dynamics(self.conn)
+        with patch('requests.get', side_effect=responses) as mocked_get:
+            rows = list(dynamics.iter_rows('salesorders', {'fetchXml': '<fetch />'}, page_size=2))
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3])
+        self.assertEqual(mocked_get.call_count, 2)
+        self.assertEqual(mocked_get.call_args_list[1][0][0], 'mocked/next')
+        self.assertIn('odata.maxpagesize=2', mocked_get.call_args_list[0][1]['headers']['Prefer'])
+
+    def test_iter_rows_follows_paging_cookie(self):
+        cookie = ('<cookie pagenumber="2" pagingcookie="%253ccookie%2520page%253d%25221%2522%253e'
+                  '%253csalesorderid%2520last%253d%2522%257bORDER-2%257d%2522%2520%252f%253e%253c%252fcookie%253e" '
+                  'istracking="False" />')
+        pages = [{'value': [{'id': 1}, {'id': 2}], '@Microsoft.Dynamics.CRM.morerecords': True,
+                  '@Microsoft.Dynamics.CRM.fetchxmlpagingcookie': cookie},
+                 {'value': [{'id': 3}], '@Microsoft.Dynamics.CRM.morerecords': False}]
+        queries = []
+
+        def fake_get(url, params=None, **kwargs):
+            # params of a query are updated for its next page
+            queries.append(params['fetchXml'])
+            response = MagicMock(status_code=200)
+            response.iter_content.return_value = [json.dumps(pages[len(queries) - 1]).encode()]
+            return response
+
+        dynamics = Dynamics(self.conn)
+        fetch_xml = '<fetch mapping="logical"><entity name="salesorder" /></fetch>'
+        with patch('requests.get', side_effect=fake_get):
+            rows = list(dynamics.iter_rows('salesorders', {'fetchXml': fetch_xml}))
+        self.assertEqual([row['id'] for row in rows], [1, 2, 3])
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries[0], fetch_xml)
+        second = ET.fromstring(queries[1])
+        self.assertEqual(second.get('page'), '2')
+        self.assertEqual(second.get('paging-cookie'), '<cookie page="1"><salesorderid last="{ORDER-2}" /></cookie>')
+        self.assertEqual(second.find('entity').get('name'), 'salesorder')
+
+    def _pages(self, count):
+        responses = []
+        for i in range(count):
+            page = {'value': [{'id': i * 2}, {'id': i * 2 + 1}]}
+            if i < count - 1:
+                page['@odata.nextLink'] = 'mocked/next-%d' % i
+            response = MagicMock(status_code=200)
+            response.iter_content.return_value = [json.dumps(page).encode()]
+            responses.append(response)
+        return responses
+
+    def test_iter_rows_prefetches_next_page(self):
+        dynamics = Dynamics(self.conn, prefetch=2)
+        with patch('requests.get', side_effect=self._pages(3)) as mocked_get:
+            rows = dynamics.iter_rows('salesorders')
+            self.assertEqual(next(rows)['id'], 0)
+            deadline = time.time() + 5
+            while mocked_get.call_count < 3 and time.time() < deadline:
+                time.sleep(0.001)
+            # the other pages are fetched while the caller holds the first row
+            self.assertEqual(mocked_get.call_count, 3)
+            self.assertEqual([row['id'] for row in rows], [1, 2, 3, 4, 5])
+
+    def test_iter_rows_prefetch_error_raised(self):
+        responses = self._pages(2)[:1] + [MagicMock(status_code=500)]
+        threads = []
+
+        def fake_get(url, **kwargs):
+            threads.append(threading.current_thread().name)
+            return responses[len(threads) - 1]
+
+        dynamics = Dynamics(self.conn, prefetch=1)
+        with patch('requests.get', side_effect=fake_get):
+            rows = dynamics.iter_rows('salesorders')
+            self.assertEqual([next(rows)['id'], next(rows)['id']], [0, 1])
+            with self.assertRaises(LookupError):
+                next(rows)
+        # pages are fetched by the worker, its error is raised to the consumer
+        self.assertEqual(threads, ['prefetch-salesorders'] * 2)
+
+    def test_iter_rows_prefetch_stops_when_abandoned(self):
+        dynamics = Dynamics(self.conn, prefetch=1)
+        with patch('requests.get', side_effect=self._pages(5)) as mocked_get:
+            rows = dynamics.iter_rows('abandoned')
+            next(rows)
+            rows.close()
+            for thread in threading.enumerate():
+                if thread.name == 'prefetch-abandoned':
+                    thread.join(5)
+                    self.assertFalse(thread.is_alive())
+        self.assertLess(mocked_get.call_count, 5)
+
+    def test_iter_rows_without_prefetch(self):
+        dynamics = Dynamics(self.conn, prefetch=0)
+        with patch('requests.get', side_effect=self._pages(2)) as mocked_get:
+            rows = dynamics.iter_rows('salesorders')
+            next(rows)
+            self.assertEqual(mocked_get.call_count, 1)
+            self.assertEqual(len(list(rows)), 3)
+
+    def test_throttled_request_retried(self):
+        throttled = MagicMock(status_code=429, headers={'Retry-After': '0'})
+        ok = MagicMock(status_code=200, content=b'{"value": [{"id": 1}]}')
+        dynamics = Dynamics(self.conn, retries=3)
+        with patch('requests.get', side_effect=[throttled, throttled, ok]) as mocked_get:
+            self.assertEqual(dynamics.get('salesorders'), [{'id': 1}])
+        self.assertEqual(mocked_get.call_count, 3)
+
+    def test_throttled_request_not_retried_by_default(self):
+        throttled = MagicMock(status_code=429, headers={'Retry-After': '0'})
+        with patch('requests.get', return_value=throttled) as mocked_get:
+            with self.assertRaises(LookupError):
+                Dynamics(self.conn).get('salesorders')
+        self.assertEqual(mocked_get.call_count, 1)
+
+    def test_throttled_request_gives_up_after_retries(self):
+        throttled = MagicMock(status_code=429, headers={'Retry-After': '0'})
+        with patch('requests.get', return_value=throttled) as mocked_get:
+            with self.assertRaises(LookupError):
+                Dynamics(self.conn, retries=2).get('salesorders')
+        self.assertEqual(mocked_get.call_count, 3)
+
+    def test_throttled_request_wait_capped(self):
+        throttled = MagicMock(status_code=429, headers={'Retry-After': '300'})
+        with patch('requests.get', return_value=throttled) as mocked_get, patch('time.sleep') as mocked_sleep:
+            with self.assertRaises(LookupError):
+                Dynamics(self.conn, retries=3, max_retry_wait=60).get('salesorders')
+        self.assertEqual(mocked_get.call_count, 1)
+        mocked_sleep.assert_not_called()
+
+    def test_unavailable_retried_only_with_retry_after(self):
+        unavailable = MagicMock(status_code=503, headers={})
+        with patch('requests.get', return_value=unavailable) as mocked_get:
+            with self.assertRaises(LookupError):
+                Dynamics(self.conn, retries=3).get('salesorders')
+        self.assertEqual(mocked_get.call_count, 1)
+        unavailable = MagicMock(status_code=503, headers={'Retry-After': '0'})
+        ok = MagicMock(status_code=200, content=b'{"value": []}')
+        with patch('requests.get', side_effect=[unavailable, ok]) as mocked_get:
+            self.assertEqual(Dynamics(self.conn, retries=3).get('salesorders'), [])
+        self.assertEqual(mocked_get.call_count, 2)
+
+    def _run_concurrently(self, dynamics, get, callers=4):
+        """Run get calls in threads while the first one is in flight"""
+        started, release = threading.Event(), threading.Event()
+
+        def in_flight(end_point, params={}, headers=None):
+            started.set()
+            release.wait(5)
+            return get(end_point, params)
+
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(dynamics.get('optionsets', {'$filter': "Name eq 'x'"}))
+            except Exception as err:
+                errors.append(err)
+
+        with patch.object(dynamics, '_get', side_effect=in_flight) as mocked_get:
+            threads = [threading.Thread(target=call) for _ in range(callers)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            key = ('optionsets', (('$filter', "Name eq 'x'"), ))
+            while dynamics._flights[key].followers < callers - 1:
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+        return mocked_get.call_count, results, errors
+
+    def test_concurrent_gets_coalesced(self):
+        dynamics = Dynamics(self.conn)
+        count, results, errors = self._run_concurrently(dynamics, lambda *args: [{'id': 1}])
+        self.assertEqual(count, 1)
+        self.assertEqual(results, [[{'id': 1}]] * 4)
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+        self.assertFalse(errors)
+        self.assertFalse(dynamics._flights)
+
+    def test_coalesced_error_raised_to_all(self):
+        def failed(*args):
+            raise LookupError(404)
+        count, results, errors = self._run_concurrently(Dynamics(self.conn), failed, 3)
+        self.assertEqual(count, 1)
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(err, LookupError) for err in errors))
+
+    def test_get_entity_revalidated_by_etag(self):
+        entity = {'@odata.context': 'contacts/$entity', '@odata.etag': 'W/"1915264"', 'contactid': 'c1', 'fullname': 'Ann'}
+        ok = MagicMock(status_code=200, content=json.dumps(entity).encode('utf-8'))
+        not_modified = MagicMock(status_code=304, content=b'')
+        dynamics = Dynamics(self.conn)
+        with patch('requests.get', side_effect=[ok, not_modified]) as mocked_get:
+            self.assertEqual(dynamics.get_entity('contacts(c1)'), entity)
+            cached = dynamics.get_entity('contacts(c1)')
+        self.assertEqual(cached, entity)
+        self.assertNotIn('If-None-Match', mocked_get.call_args_list[0][1]['headers'])
+        self.assertEqual(mocked_get.call_args_list[1][1]['headers']['If-None-Match'], 'W/"1915264"')
+
+    def test_get_entity_with_expand_not_cached(self):
+        entity = {'@odata.context': 'contacts/$entity', '@odata.etag': 'W/"1915264"', 'contactid': 'c1',
+                  'parentcustomerid_account': {'name': 'Old'}}
+        ok = MagicMock(status_code=200, content=json.dumps(entity).encode('utf-8'))
+        dynamics = Dynamics(self.conn)
+        params = {'$expand': 'parentcustomerid_account($select=name)'}
+        with patch('requests.get', return_value=ok) as mocked_get:
+            dynamics.get_entity('contacts(c1)', params)
+            dynamics.get_entity('contacts(c1)', params)
+        self.assertEqual(len(dynamics._entities), 0)
+        self.assertNotIn('If-None-Match', mocked_get.call_args_list[1][1]['headers'])
+
+    def test_get_entity_cache_bounded(self):
+        dynamics = Dynamics(self.conn, entity_cache_size=2)
+        with patch.object(dynamics, '_get', side_effect=lambda end_point, *args: {'@odata.etag': end_point}):
+            for end_point in ('contacts(a)', 'contacts(b)', 'contacts(a)', 'contacts(c)'):
+                dynamics.get_entity(end_point)
+        self.assertEqual([key[0] for key in dynamics._entities], ['contacts(a)', 'contacts(c)'])
+
+    def test_sequential_gets_not_coalesced(self):
+        dynamics = Dynamics(self.conn)
+        with patch.object(dynamics, '_get', return_value=[]) as mocked_get:
+            dynamics.get('optionsets')
+            dynamics.get('optionsets')
+        self.assertEqual(mocked_get.call_count, 2)
@@ -0,0 +1,122 @@
+import os
+import csv
+import sys
+import subprocess
+import gzip
+import json
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .context import edynam
+from edynam import export
+from edynam.dynamics import Dynamics
+from edynam.models import Contact
+
+
+def rows(count):
+    for i in range(count):
+        yield {'name': 'Name %d' % i, 'size': i, 'note': None}
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name)
+
+    def test_format_of(self):
+        self.assertEqual(export.format_of('a.csv.gz'), 'csv')
+        self.assertEqual(export.format_of('a.parquet'), 'parquet')
+        self.assertEqual(export.format_of('a.json'), 'jsonl')
+        self.assertEqual(export.format_of('a.out'), 'jsonl')
+
+    def test_pyarrow_imported_by_parquet_export_only(self):
+        code = 'import sys, edynam.models; print("pyarrow" in sys.modules)'
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', code], cwd=path).strip(), b'False')
+
+    def test_jsonl_compressed(self):
+        path = self.path('rows.jsonl.gz')
+        self.assertEqual(export.export_rows(rows(3), path), 3)
+        with gzip.open(path, 'rt') as exported:
+            self.assertEqual([json.loads(line)['size'] for line in exported], [0, 1, 2])
+
+    def test_csv_fields_and_progress(self):
+        path = self.path('rows.csv')
+        progress = MagicMock()
+        export.export_rows(rows(5), path, fields=('size', 'name'), progress=progress, progress_every=2)
+        with open(path, newline='') as exported:
+            lines = list(csv.reader(exported))
+        self.assertEqual(lines[0], ['size', 'name'])
+        self.assertEqual(lines[-1], ['4', 'Name 4'])
+        self.assertEqual([call[0][0] for call in progress.call_args_list], [2, 4, 5])
+
+    def test_mode_as_open_creates(self):
+        with patch('edynam.files.UMASK', 0o027):
+            export.export_rows(rows(1), self.path('rows.jsonl'))
+        self.assertEqual(os.stat(self.path('rows.jsonl')).st_mode & 0o777, 0o640)
+
+    def test_failed_export_keeps_old_file(self):
+        path = self.path('rows.jsonl')
+        with open(path, 'w') as old:
+            old.write('old\n')
+
+        def broken():
+            yield {'name': 'A'}
+            raise LookupError(500)
+
+        with self.assertRaises(LookupError):
+            export.export_rows(broken(), path)
+        with open(path) as kept:
+            self.assertEqual(kept.read(), 'old\n')
+        self.assertEqual(os.listdir(self.folder.name), ['rows.jsonl'])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_batches(self):
+        path = self.path('rows.parquet')
+        self.assertEqual(export.export_rows(rows(5), path, batch_size=2), 5)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column('size').to_pylist(), [0, 1, 2, 3, 4])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_promotes_types_of_later_batches(self):
+        path = self.path('rows.parquet')
+        mixed = [{'a': 1, 'b': None}, {'a': 2, 'b': None}, {'a': 2.5, 'b': None}, {'a': 3, 'b': 3.5}, {'a': 4, 'b': None}]
+        self.assertEqual(export.export_rows(mixed, path, batch_size=2), 5)
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column('a').to_pylist(), [1.0, 2.0, 2.5, 3.0, 4.0])
+        self.assertEqual(table.column('b').to_pylist(), [None, None, None, 3.5, None])
+        self.assertTrue(pyarrow.types.is_floating(table.schema.field('a').type))
+        self.assertEqual(os.listdir(self.folder.name), ['rows.parquet'])
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_unknown_key_raised(self):
+        path = self.path('rows.parquet')
+        with self.assertRaises(ValueError):
+            export.export_rows([{'a': 1}, {'a': 2}, {'a': 3, 'c': 'new'}], path, batch_size=2)
+        self.assertEqual(os.listdir(self.folder.name), [])
+        export.export_rows([{'a': 1}, {'a': 2}, {'a': 3, 'c': 'new'}], path, fields=('a', ), batch_size=2)
+        self.assertEqual(pyarrow.parquet.read_table(path).column_names, ['a'])
+
+    def test_csv_unknown_key_raised(self):
+        with self.assertRaises(ValueError):
+            export.export_rows([{'a': 1}, {'a': 2, 'c': 'new'}], self.path('rows.csv'))
+
+    def test_handler_export_streams_scan(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        scanned = [{'fullname': 'Ann', 'emailaddress1': 'ann@mocked'}, {'fullname': 'Bob', 'emailaddress1': None}]
+        path = self.path('contacts.csv')
+        with patch.object(Dynamics, 'iter_rows', return_value=iter(scanned)) as mocked_rows:
+            self.assertEqual(Contact(backend).export(path, fields=['fullname', 'email']), 2)
+        self.assertEqual(mocked_rows.call_args[0][1], {'$select': 'fullname,emailaddress1'})
+        with open(path) as exported:
+            self.assertEqual(exported.read().splitlines(), ['fullname,email', 'Ann,ann@mocked', 'Bob,'])
@@ -2,7 +2,7 @@ import unittest
 import xml.etree.ElementTree as ET
 
 from .context import edynam
-from edynam.fetchxml import FetchXML
+from edynam.fetchxml import FetchXML, FetchXMLTemplate
 
 
 class TestFetchXML(unittest.TestCase):
@@ -78,3 +78,71 @@ class TestFetchXML(unittest.TestCase):
             FetchXML.create_alias(entity, 'quantity', '9 start')
         with self.assertRaises(AssertionError):
             FetchXML.create_alias(entity, 'quantity', '_ start')
+
+
+class TestFetchXMLTemplate(unittest.TestCase):
+    def _build(self):
+        fetch = FetchXML.create_fetch()
+        entity = FetchXML.create_entity(fetch, 'salesorder')
+        filter_op = FetchXML.create_sub_elm(entity, 'filter', {'type': 'and'})
+        FetchXML.create_condition(filter_op, 'customerid', 'eq', FetchXML.param('account_id'))
+        FetchXML.create_condition(filter_op, 'name', 'eq', FetchXML.param('name'))
+        return fetch
+
+    def test_params(self):
+        template = FetchXMLTemplate(self._build())
+        self.assertEqual(template.params, frozenset(('account_id', 'name')))
+
+    def test_render_escapes_values(self):
+        template = FetchXMLTemplate(self._build())
+        rendered = ET.fromstring(template.render(account_id='a-b', name='<R&D "VM">'))
+        conditions = rendered.findall('.//condition')
+        self.assertEqual(conditions[0].get('value'), 'a-b')
+        self.assertEqual(conditions[1].get('value'), '<R&D "VM">')
+
+    def test_render_missing_value(self):
+        template = FetchXMLTemplate(self._build())
+        with self.assertRaises(KeyError):
+            template.render(account_id='a')
+
+    def test_built_once_per_shape(self):
+        FetchXMLTemplate.clear()
+        built = []
+
+        def builder():
+            built.append(1)
+            return self._build()
+
+        first = FetchXMLTemplate.get(('test', ), builder)
+        second = FetchXMLTemplate.get(('test', ), builder)
+        self.assertIs(first, second)
+        self.assertEqual(len(built), 1)
+
+    def test_param_check(self):
+        with self.assertRaises(AssertionError):
+            FetchXML.param('with space')
+
+    def test_count_links(self):
+        entity = FetchXML.create_entity(FetchXML.create_fetch(), 'salesorder')
+        link = FetchXML.create_link(entity, 'salesorderdetail', 'salesorderid', 'salesorderid')
+        FetchXML.create_link(link, 'product', 'productid', 'productid')
+        self.assertEqual(FetchXML.count_links(entity), 2)
+
+    def test_split_links(self):
+        self.assertEqual(FetchXML.split_links([]), [[]])
+        self.assertEqual(FetchXML.split_links([3, 3], fixed=2), [[0, 1]])
+        self.assertEqual(FetchXML.split_links([3, 3, 3, 1, 2], fixed=2), [[0, 1, 3], [2, 4]])
+        for query in FetchXML.split_links([2, 1, 3, 3, 3, 2, 1], fixed=2):
+            self.assertLessEqual(sum([2, 1, 3, 3, 3, 2, 1][i] for i in query) + 2, FetchXML.MAX_LINK_ENTITIES)
+        with self.assertRaises(ValueError):
+            FetchXML.split_links([9], fixed=2)
+
+    def test_next_page(self):
+        fetch_xml = FetchXML.to_string(FetchXML.create_fetch())
+        second = ET.fromstring(FetchXML.next_page(fetch_xml))
+        self.assertEqual(second.get('page'), '2')
+        cookie = ('<cookie pagenumber="3" pagingcookie="%253ccookie%2520page%253d%25222%2522%253e'
+                  '%253csalesorderid%2520last%253d%2522%257bAB%257d%2522%2520%252f%253e%253c%252fcookie%253e" istracking="False" />')
+        third = ET.fromstring(FetchXML.next_page(FetchXML.to_string(second), cookie))
+        self.assertEqual(third.get('page'), '3')
+        self.assertEqual(third.get('paging-cookie'), '<cookie page="2"><salesorderid last="{AB}" /></cookie>')
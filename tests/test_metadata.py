@@ -0,0 +1,129 @@
+import unittest
+from datetime import timezone, timedelta
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam.dynamics import Dynamics, FORMATTED_VALUE_SUF
+from edynam.metadata import MetadataCache, fetch_columns, format_datetime
+from edynam.fetchxml import FetchXML
+from edynam.models import Contact
+
+
+def label(text):
+    return {'LocalizedLabels': [{'Label': text}], 'UserLocalizedLabel': {'Label': text}}
+
+
+METADATA = {
+    "EntityDefinitions(LogicalName='contact')": {
+        '@odata.context': 'EntityDefinitions/$entity', 'LogicalName': 'contact', 'EntitySetName': 'contacts',
+        'PrimaryIdAttribute': 'contactid', 'PrimaryNameAttribute': 'fullname'},
+    "EntityDefinitions(LogicalName='account')": {
+        '@odata.context': 'EntityDefinitions/$entity', 'LogicalName': 'account', 'EntitySetName': 'accounts',
+        'PrimaryIdAttribute': 'accountid', 'PrimaryNameAttribute': 'name'},
+    "EntityDefinitions(LogicalName='contact')/Attributes/Microsoft.Dynamics.CRM.StateAttributeMetadata": [
+        {'LogicalName': 'statecode', 'OptionSet': {'Options': [{'Value': 0, 'Label': label('Active')},
+                                                              {'Value': 1, 'Label': label('Inactive')}]}}],
+    "EntityDefinitions(LogicalName='contact')/Attributes/Microsoft.Dynamics.CRM.LookupAttributeMetadata": [
+        {'LogicalName': 'parentcustomerid', 'Targets': ['account', 'contact']}],
+    "EntityDefinitions(LogicalName='account')/Attributes/Microsoft.Dynamics.CRM.LookupAttributeMetadata": [
+        {'LogicalName': 'parentaccountid', 'Targets': ['account']}],
+    "EntityDefinitions(LogicalName='contact')/Attributes/Microsoft.Dynamics.CRM.DateTimeAttributeMetadata": [
+        {'LogicalName': 'createdon'}],
+}
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self.backend = Dynamics(MagicMock(resource='http://mocked'), annotations=False)
+        self.queried = []
+
+    def fake_get(self, end_point, params={}, headers=None):
+        self.queried.append(end_point)
+        if end_point in METADATA:
+            return METADATA[end_point]
+        if end_point == 'accounts':
+            return [{'accountid': 'ACCOUNT-1', 'name': 'Unit A'}]
+        if end_point == 'contacts' and '$filter' in params:
+            return []
+        if end_point == 'contacts':
+            return [{'contactid': 'c1', 'fullname': 'Ann', 'statecode': 0, 'createdon': '2016-10-20T02:19:54Z',
+                     '_parentcustomerid_value': 'account-1', 'parentcustomerid_account': {'name': 'Unit A'},
+                     'parentcustomerid_contact': None}]
+        return []
+
+    def test_headers_without_annotations(self):
+        self.assertNotIn('Prefer', Dynamics.construct_headers(annotations=False))
+        self.assertEqual(Dynamics.construct_headers(page_size=10, annotations=False)['Prefer'], 'odata.maxpagesize=10')
+        self.assertIn(FORMATTED_VALUE_SUF, Dynamics.construct_headers()['Prefer'])
+
+    def test_format_datetime(self):
+        adelaide = timezone(timedelta(hours=9, minutes=30))
+        self.assertEqual(format_datetime('2016-10-20T02:19:54Z', adelaide), '20/10/2016 11:49 AM')
+        self.assertEqual(format_datetime('2016-10-20T04:00:00Z', adelaide), '20/10/2016 1:30 PM')
+        self.assertEqual(format_datetime('2016-10-20'), '20/10/2016')
+
+    def test_lean_list_formatted_locally(self):
+        with patch.object(Dynamics, 'get', side_effect=self.fake_get):
+            contacts = Contact(self.backend).list()
+            self.assertEqual(contacts[0]['status'], 'Active')
+            self.assertEqual(contacts[0]['parentcustomer'], 'Unit A')
+            self.assertEqual(self.queried.count('accounts'), 1)
+
+            queried = len(self.queried)
+            Contact(self.backend).list()
+        # metadata and names are cached: only the list itself is queried again
+        self.assertEqual(self.queried[queried:], ['contacts'])
+        cache = MetadataCache.of(self.backend)
+        self.assertEqual(cache.names('account', ['ACCOUNT-1']), {'account-1': 'Unit A'})
+
+    def test_annotate_rows(self):
+        cache = MetadataCache(self.backend, tz=timezone.utc)
+        with patch.object(Dynamics, 'get', side_effect=self.fake_get):
+            row, = cache.annotate('contact', [{'statecode': 1, 'createdon': '2016-10-20T02:19:54Z', 'fullname': 'Ann',
+                                               '_parentcustomerid_value': 'unknown'}])
+        self.assertEqual(row['statecode@' + FORMATTED_VALUE_SUF], 'Inactive')
+        self.assertEqual(row['createdon@' + FORMATTED_VALUE_SUF], '20/10/2016 2:19 AM')
+        self.assertNotIn('fullname@' + FORMATTED_VALUE_SUF, row)
+        self.assertNotIn('_parentcustomerid_value@' + FORMATTED_VALUE_SUF, row)
+
+    def fetch_of_contacts(self):
+        fetch = FetchXML.create_fetch()
+        entity = FetchXML.create_entity(fetch, 'contact')
+        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'statecode'})
+        FetchXML.create_sub_elm(entity, 'attribute', {'name': 'parentcustomerid'})
+        FetchXML.create_alias(entity, 'createdon', 'created')
+        unit_link = FetchXML.create_link(entity, 'account', 'accountid', 'parentcustomerid')
+        FetchXML.create_alias(unit_link, 'parentaccountid', 'billerid')
+        FetchXML.create_sub_elm(unit_link, 'attribute', {'name': 'name'})
+        return FetchXML.to_string(fetch)
+
+    def test_fetch_columns(self):
+        self.assertEqual(fetch_columns(self.fetch_of_contacts()), {
+            'statecode': ('contact', 'statecode', False), 'parentcustomerid': ('contact', 'parentcustomerid', False),
+            'created': ('contact', 'createdon', True), 'billerid': ('account', 'parentaccountid', True)})
+
+    def test_annotate_rows_of_fetch(self):
+        cache = MetadataCache(self.backend, tz=timezone.utc)
+        rows = [{'statecode': 1, '_parentcustomerid_value': 'ACCOUNT-1', 'created': '2016-10-20T02:19:54Z',
+                 'billerid': 'account-1', 'name': 'Unit A'},
+                {'statecode': 0, '_parentcustomerid_value': None, 'created': None, 'billerid': None}]
+        with patch.object(Dynamics, 'get', side_effect=self.fake_get):
+            first, second = cache.annotate_fetch(self.fetch_of_contacts(), rows)
+        self.assertEqual(first['statecode@' + FORMATTED_VALUE_SUF], 'Inactive')
+        self.assertEqual(first['_parentcustomerid_value@' + FORMATTED_VALUE_SUF], 'Unit A')
+        self.assertEqual(first['created@' + FORMATTED_VALUE_SUF], '20/10/2016 2:19 AM')
+        self.assertEqual(first['billerid@' + FORMATTED_VALUE_SUF], 'Unit A')
+        self.assertNotIn('name@' + FORMATTED_VALUE_SUF, first)
+        self.assertEqual(second, {'statecode': 0, '_parentcustomerid_value': None, 'created': None, 'billerid': None,
+                                  'statecode@' + FORMATTED_VALUE_SUF: 'Active'})
+        self.assertEqual(self.queried.count('accounts'), 1)
+
+    def test_lean_fetch_of_handler_annotated(self):
+        rows = [{'username': 'ann', 'unit': 'Unit A'}]
+        with patch.object(Dynamics, 'get', return_value=rows) as mocked_get, \
+                patch.object(MetadataCache, 'annotate_fetch', side_effect=lambda fetch_xml, rows: rows) as mocked_annotate:
+            self.assertEqual(Contact(self.backend).get_usernames(), rows)
+        self.assertEqual(mocked_annotate.call_args[0][0], mocked_get.call_args[0][1]['fetchXml'])
+        with patch.object(Dynamics, 'get', return_value=rows), patch.object(MetadataCache, 'annotate_fetch') as mocked_annotate:
+            Contact(Dynamics(MagicMock(resource='http://mocked'))).get_usernames()
+        self.assertFalse(mocked_annotate.called)
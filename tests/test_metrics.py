@@ -0,0 +1,138 @@
+import os
+import json
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam.dynamics import Dynamics
+from edynam.files import created_mode
+from edynam.metrics import Histogram, MetricsRegistry, bind, current_operation, end_point_shape, measured
+from edynam.models import Contact, OrderDetail
+
+
+def fake_response(body, status_code=200):
+    response = MagicMock(status_code=status_code, headers={'Retry-After': '0'})
+    response.content = json.dumps(body).encode('utf-8')
+    response.iter_content.return_value = [response.content]
+    return response
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.conn = MagicMock(resource='http://mocked')
+        self.backend = Dynamics(self.conn)
+        self.events = []
+        self.backend.add_listener(self.events.append)
+
+    def test_end_point_shape(self):
+        self.assertEqual(end_point_shape('salesorders(abc-123)/Microsoft.Dynamics.CRM.RetrieveProductProperties()'),
+                         'salesorders({id})/Microsoft.Dynamics.CRM.RetrieveProductProperties()')
+        self.assertEqual(end_point_shape('contacts'), 'contacts')
+
+    def test_request_event_of_get(self):
+        responses = [fake_response({}, 429), fake_response({}, 401), fake_response({'value': [{'id': 1}, {'id': 2}]})]
+        with patch('requests.get', side_effect=responses):
+            self.backend.retries = 1
+            self.backend.get('salesorderdetails')
+        self.assertEqual(len(self.events), 1)
+        event = self.events[0]
+        self.assertEqual(event['type'], 'request')
+        self.assertEqual(event['rows'], 2)
+        self.assertEqual(event['retries'], 1)
+        self.assertEqual(event['refreshes'], 1)
+        self.assertEqual(event['status'], 200)
+        self.assertEqual(event['bytes'], len(responses[-1].content))
+        self.assertIsNone(event['error'])
+
+    def test_events_of_measured_handler_method(self):
+        with patch('requests.get', return_value=fake_response({'value': [{'salesorderdetailid': 'a'}]})):
+            OrderDetail(self.backend).get_products_of('an-order')
+        # list is called by get_products_of, the request is counted to the outer call
+        request, inner, outer = self.events
+        self.assertEqual(request['operation'], 'OrderDetail.get_products_of')
+        self.assertEqual(inner['operation'], 'OrderDetail.list')
+        self.assertEqual(outer['type'], 'operation')
+        self.assertEqual(outer['operation'], 'OrderDetail.get_products_of')
+        self.assertEqual(outer['rows'], 1)
+
+    def test_operation_carried_to_worker_threads(self):
+        class Worker(object):
+            _backend = None
+
+            @measured
+            def run(self):
+                seen = []
+                thread = threading.Thread(target=bind(lambda: seen.append(current_operation())))
+                thread.start()
+                thread.join()
+                return seen
+
+        self.assertEqual(Worker().run(), ['Worker.run'])
+        seen = []
+        thread = threading.Thread(target=bind(lambda: seen.append(current_operation())))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+
+    def test_event_per_page_of_scan(self):
+        pages = [fake_response({'value': [{'contactid': 1}], '@odata.nextLink': 'http://mocked/next'}),
+                 fake_response({'value': [{'contactid': 2}, {'contactid': 3}]})]
+        with patch('requests.get', side_effect=pages):
+            list(Contact(self.backend).scan())
+        self.assertEqual([event['rows'] for event in self.events], [1, 2])
+
+    def test_failed_request_emits_error(self):
+        with patch('requests.get', return_value=fake_response({'error': {'message': 'Bad'}}, 400)):
+            with self.assertRaises(LookupError):
+                self.backend.get('contacts')
+        self.assertEqual(self.events[0]['error'], 'LookupError')
+
+    def test_listener_error_not_raised(self):
+        self.backend.add_listener(MagicMock(side_effect=RuntimeError('broken')))
+        with patch('requests.get', return_value=fake_response({'value': []})):
+            self.assertEqual(self.backend.get('contacts'), [])
+
+    def test_histogram_percentiles_from_buckets(self):
+        histogram = Histogram((0.1, 1.0))
+        self.assertIsNone(histogram.percentile(50))
+        for value in (0.05, 0.05, 0.5, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 4])
+        self.assertAlmostEqual(histogram.percentile(50), 0.325)
+        self.assertAlmostEqual(histogram.percentile(20), 0.05)
+        # above the highest bound
+        self.assertEqual(histogram.percentile(99), 1.0)
+        self.assertFalse(hasattr(histogram, '_values'))
+
+    def test_registry_exports(self):
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        self.backend.add_listener(registry)
+        with patch('requests.get', return_value=fake_response({'value': [{'salesorderdetailid': 'a'}]})):
+            OrderDetail(self.backend).get_products_of('first')
+            OrderDetail(self.backend).get_products_of('second')
+        snapshot = registry.snapshot()
+        self.assertEqual(len(snapshot['requests']), 1)
+        self.assertEqual(snapshot['requests'][0]['requests_total'], 2)
+        self.assertEqual(snapshot['requests'][0]['rows_total'], 2)
+        self.assertEqual([item['calls_total'] for item in snapshot['operations']], [2, 2])
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'edynam.prom')
+            registry.to_prometheus(path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, created_mode())
+            with open(path) as pf:
+                text = pf.read()
+            json_path = os.path.join(folder, 'edynam.json')
+            registry.to_json(json_path)
+            with open(json_path) as jf:
+                self.assertEqual(json.load(jf), json.loads(json.dumps(snapshot)))
+        self.assertIn('edynam_requests_total{end_point="salesorderdetails",operation="OrderDetail.get_products_of"} 2', text)
+        self.assertIn('edynam_request_duration_seconds_bucket{end_point="salesorderdetails",le="+Inf",'
+                      'operation="OrderDetail.get_products_of"} 2', text)
+        self.assertIn('edynam_operation_calls_total{operation="OrderDetail.get_products_of"} 2', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
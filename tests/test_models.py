@@ -1,12 +1,16 @@
 import re
 import logging
 import unittest
-from unittest.mock import patch
+import json
+import xml.etree.ElementTree as ET
+from unittest.mock import MagicMock, patch
 
 from .context import edynam
 from edynam.connection import ADALConnection
 from edynam.dynamics import Dynamics
-from edynam.models import (Handler, Project, Product, Order, DynamicPropertyOptionsetItem)
+from edynam.fetchxml import FetchXML
+from edynam.models import (Handler, Project, Product, Account, Contact, Substitute, Order, DynamicPropertyOptionsetItem,
+                           Opportunity)
 
 
 logging.basicConfig(level=logging.DEBUG,
@@ -44,6 +48,10 @@ class TestModelHandler(unittest.TestCase):
         for tbm in to_be_matched:
             self.assertIsNotNone(customer_id_pat.match(tbm))
 
+    def test_logical_name_of_irregular_plural(self):
+        self.assertEqual(Opportunity._logical_name(), 'opportunity')
+        self.assertIn('opportunityid', Opportunity._output_keys())
+
     def test_build_query_fields(self):
         handler = Project(self.dynamics)
         select = handler.select()['$select']
@@ -53,6 +61,26 @@ class TestModelHandler(unittest.TestCase):
         self.assertEqual(len(items), len(handler.LOOKUPS))
         self.assertEqual(len(select.split(',')), len(items) + len(handler.FIELDS))
 
+    def test_projection_of_fields(self):
+        selects, expands = Contact.projection(['email', 'status'])
+        self.assertEqual(selects, {'$select': 'emailaddress1,statecode'})
+        self.assertEqual(expands, {})
+
+        # parentcustomer comes from either of the expanded customers
+        selects, expands = Contact.projection(['username', 'parentcustomer'])
+        self.assertEqual(selects, {'$select': 'new_username'})
+        self.assertEqual(expands['$expand'], ','.join(Contact.LOOKUPS))
+
+        selects, expands = Substitute.projection(['product', 'substitutedproducttype', 'createdon'])
+        self.assertEqual(selects['$select'].split(','), ['_productid_value', 'createdon'])
+        self.assertEqual(expands['$expand'], Substitute.LOOKUPS[1])
+
+    def test_list_selects_projection(self):
+        with patch.object(Dynamics, 'get', return_value=[{'fullname': 'Ann', 'emailaddress1': 'ann@mocked'}]) as mocked_get:
+            rows = Contact(self.dynamics).list(fields=['fullname', 'email'])
+        self.assertEqual(mocked_get.call_args[0][1], {'$select': 'fullname,emailaddress1'})
+        self.assertEqual(rows, [{'fullname': 'Ann', 'email': 'ann@mocked'}])
+
     def test_mapping(self):
         handler = Handler(self.dynamics)
         handler.MAPS = {
@@ -130,6 +158,152 @@ class TestModelHandler(unittest.TestCase):
         self.assertIsNotNone(fetchXml.find('entity'))
         self.assertEqual(len(entity.findall('attribute')), 3)
 
+    def test_get_product_from_template(self):
+        order_handler = Order(self.dynamics)
+        role = {'id': 'role-1', 'name': 'leader'}
+        prop = {'id': 'prop-1', 'type': 'valueinteger', 'alias': 'size'}
+        with patch.object(Dynamics, 'get', return_value=[]) as mocked_get:
+            order_handler.get_product('product-1', roles=[role], prod_props=[prop])
+            order_handler.get_product('product-2', roles=[dict(role, id='role-2')], prod_props=[dict(prop, id='prop-2')])
+        self.assertEqual(mocked_get.call_count, 2)
+        first = mocked_get.call_args_list[0][0][1]['fetchXml']
+        second = mocked_get.call_args_list[1][0][1]['fetchXml']
+        self.assertEqual(first.replace('-1', '-2'), second)
+        fetch = ET.fromstring(second)
+        values = [cond.get('value') for cond in fetch.iter('condition')]
+        self.assertIn('product-2', values)
+        self.assertIn('prop-2', values)
+        # roles are not part of the order query
+        self.assertNotIn('role-2', values)
+
+    def test_get_product_split_over_link_limit(self):
+        order_handler = Order(self.dynamics)
+        props = [{'id': 'prop-%d' % i, 'type': 'optionset', 'alias': 'os%d' % i} for i in range(5)]
+
+        def fake_get(end_point, params):
+            fetch = ET.fromstring(params['fetchXml'])
+            self.assertLessEqual(FetchXML.count_links(fetch), FetchXML.MAX_LINK_ENTITIES)
+            aliases = [attr.get('alias') for attr in fetch.iter('attribute') if attr.get('alias')]
+            rows = []
+            # line-2 has no required property os4
+            for line in ('line-1', 'line-2'):
+                if line == 'line-2' and 'os4' in aliases:
+                    continue
+                row = {'salesorderid': 'order-' + line, Order.DETAIL_KEY: line}
+                for alias in aliases:
+                    if alias != Order.DETAIL_KEY:
+                        row[alias] = '%s-%s' % (alias, line)
+                rows.append(row)
+            return rows
+
+        with patch.object(Dynamics, 'get', side_effect=fake_get) as mocked_get:
+            rows = order_handler.get_product('product-1', prod_props=props)
+        self.assertEqual(mocked_get.call_count, 2)
+        self.assertEqual(len(rows), 1)
+        self.assertNotIn(Order.DETAIL_KEY, rows[0])
+        self.assertEqual(rows[0]['os0'], 'os0-line-1')
+        self.assertEqual(rows[0]['os4'], 'os4-line-1')
+
+    def test_get_product_roles_joined_locally(self):
+        order_handler = Order(self.dynamics)
+        roles = [{'id': 'ROLE-0', 'name': 'leader', 'extra': [('new_username', 'username')]},
+                 {'id': 'role-1', 'name': 'admin'}]
+        orders = [{'salesorderid': 'order-1', 'name': 'first'}, {'salesorderid': 'order-2', 'name': 'second'}]
+        # order-1 has two leaders and an admin, order-2 has none
+        connections = [{'orderid': 'order-1', 'roleid': 'role-0', 'contactid': 'contact-1', 'fullname': 'Ann',
+                        'email': 'ann@mocked', 'unit': 'Unit A', 'extra_new_username': 'ann'},
+                       {'orderid': 'order-1', 'roleid': 'role-0', 'contactid': 'contact-2', 'fullname': 'Bob'},
+                       {'orderid': 'order-1', 'roleid': 'role-1', 'contactid': 'contact-3', 'fullname': 'Cat'}]
+        with patch.object(Dynamics, 'get', return_value=orders) as mocked_get:
+            with patch.object(Dynamics, 'iter_rows', return_value=iter(connections)) as mocked_rows:
+                rows = order_handler.get_product('product-1', roles=roles)
+        main = ET.fromstring(mocked_get.call_args[0][1]['fetchXml'])
+        self.assertNotIn('connection', [link.get('name') for link in main.iter('link-entity')])
+        end_point, params = mocked_rows.call_args[0]
+        self.assertEqual(end_point, 'connections')
+        fetch = ET.fromstring(params['fetchXml'])
+        in_values = {cond.get('attribute'): [value.text for value in cond.iter('value')]
+                     for cond in fetch.iter('condition') if cond.get('operator') == 'in'}
+        self.assertEqual(in_values, {'record1id': ['order-1', 'order-2'], 'record2roleid': ['ROLE-0', 'role-1']})
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual([row.get('leader') for row in rows], ['Ann', 'Bob', None])
+        self.assertEqual(rows[0]['leaderusername'], 'ann')
+        self.assertEqual(rows[0]['leaderunit'], 'Unit A')
+        self.assertEqual(rows[0]['admin'], 'Cat')
+        self.assertNotIn('leaderemail', rows[1])
+        self.assertEqual(rows[2], orders[1])
+
+    def test_get_all_account_products_grouped(self):
+        order_handler = Order(self.dynamics)
+        orders = [{'salesorderid': 'order-1', 'customerid': 'ACCOUNT-A', 'product': 'Compute'},
+                  {'salesorderid': 'order-2', 'customerid': 'account-b', 'product': 'Storage'},
+                  {'salesorderid': 'order-3', 'customerid': 'account-a', 'product': 'Storage'}]
+        connections = [{'orderid': 'order-2', 'roleid': 'role-0', 'contactid': 'contact-1', 'fullname': 'Ann'}]
+        role = {'id': 'role-0', 'name': 'manager'}
+
+        def iter_rows(end_point, params={}, page_size=None):
+            return iter(connections if end_point == 'connections' else [dict(order) for order in orders])
+
+        with patch.object(Dynamics, 'iter_rows', side_effect=iter_rows) as mocked_rows:
+            grouped = order_handler.get_all_account_products(role=role)
+        self.assertEqual(mocked_rows.call_count, 2)
+        self.assertEqual(mocked_rows.call_args_list[0][0][0], 'salesorderdetails')
+        fetch = ET.fromstring(mocked_rows.call_args_list[0][0][1]['fetchXml'])
+        # rows are lines, linked up to their Orders
+        self.assertEqual(fetch.find('entity').get('name'), 'salesorderdetail')
+        self.assertEqual(fetch.find('entity/link-entity').get('name'), 'salesorder')
+        self.assertNotIn('eq', [cond.get('operator') for cond in fetch.iter('condition') if cond.get('attribute') == 'accountid'])
+        self.assertEqual(sorted(grouped), ['account-a', 'account-b'])
+        self.assertEqual([row['salesorderid'] for row in grouped['account-a']], ['order-1', 'order-3'])
+        self.assertNotIn('customerid', grouped['account-a'][0])
+        self.assertEqual(grouped['account-b'][0]['manager'], 'Ann')
+
+    def test_get_all_account_products_follows_paging_cookie(self):
+        # lines of order-2 are split over the two pages
+        pages = [{'value': [{'salesorderdetailid': 'line-1', 'salesorderid': 'order-1', 'customerid': 'account-a',
+                             'product': 'Compute'},
+                            {'salesorderdetailid': 'line-2', 'salesorderid': 'order-2', 'customerid': 'account-b',
+                             'product': 'Compute'}],
+                  '@Microsoft.Dynamics.CRM.morerecords': True,
+                  '@Microsoft.Dynamics.CRM.fetchxmlpagingcookie':
+                      '<cookie pagenumber="2" pagingcookie="%253ccookie%2520page%253d%25221%2522%253e%253c%252fcookie%253e" istracking="False" />'},
+                 {'value': [{'salesorderdetailid': 'line-3', 'salesorderid': 'order-2', 'customerid': 'account-b',
+                             'product': 'Storage'}]}]
+        responses = []
+        for page in pages:
+            response = MagicMock(status_code=200)
+            response.iter_content.return_value = [json.dumps(page).encode()]
+            responses.append(response)
+        queries = []
+
+        def fake_get(url, params=None, **kwargs):
+            # params of a query are updated for its next page
+            queries.append(params['fetchXml'])
+            return responses[len(queries) - 1]
+
+        with patch('requests.get', side_effect=fake_get):
+            grouped = Order(self.dynamics).get_all_account_products(page_size=2)
+        self.assertEqual(len(queries), 2)
+        first, second = [ET.fromstring(query) for query in queries]
+        self.assertIsNone(first.get('page'))
+        self.assertEqual(second.get('page'), '2')
+        self.assertEqual(second.get('paging-cookie'), '<cookie page="1"></cookie>')
+        self.assertEqual([row['product'] for row in grouped['account-b']], ['Compute', 'Storage'])
+        self.assertEqual([row['salesorderdetailid'] for row in grouped['account-b']], ['line-2', 'line-3'])
+        self.assertEqual(len(grouped['account-a']), 1)
+
+    def test_account_products_looked_up_in_grouped(self):
+        account = Account(self.dynamics)
+        account.instance = {'accountid': 'ABC', 'name': 'An Account'}
+        with patch.object(Dynamics, 'get') as mocked_get, patch.object(Dynamics, 'iter_rows') as mocked_rows:
+            self.assertEqual(account.get_all_products(grouped={'abc': [{'product': 'Compute'}]}), [{'product': 'Compute'}])
+            self.assertEqual(account.get_all_products(grouped={'other': []}), [])
+        self.assertFalse(mocked_get.called or mocked_rows.called)
+        with patch.object(Order, 'get_account_products', return_value=[{'product': 'Storage'}]) as mocked_products:
+            self.assertEqual(account.get_all_products(), [{'product': 'Storage'}])
+        mocked_products.assert_called_once_with('ABC')
+
     def test_dynamicpropertyoptionsetitem_entity(self):
         # no option_value or is not an integer, returns empty string
         optionitems_handler = DynamicPropertyOptionsetItem(self.dynamics)
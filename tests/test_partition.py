@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import partition
+from edynam.dynamics import Dynamics
+from edynam.models import OrderDetail
+
+
+class TestPartition(unittest.TestCase):
+    def test_guid_bounds(self):
+        bounds = partition.guid_bounds(4)
+        self.assertEqual(bounds, ['00000000-0000-0000-0000-400000000000', '00000000-0000-0000-0000-800000000000',
+                                  '00000000-0000-0000-0000-c00000000000'])
+        filters = partition.range_filters('id', bounds)
+        self.assertEqual(len(filters), 4)
+        self.assertEqual(filters[0], 'id lt 00000000-0000-0000-0000-400000000000')
+        self.assertEqual(filters[1], 'id ge 00000000-0000-0000-0000-400000000000 and id lt 00000000-0000-0000-0000-800000000000')
+        self.assertEqual(filters[-1], 'id ge 00000000-0000-0000-0000-c00000000000')
+        self.assertEqual(partition.range_filters('id', []), [None])
+
+    def test_date_bounds(self):
+        bounds = partition.date_bounds('2017-01-01T00:00:00Z', '2017-01-05T00:00:00Z', 4)
+        self.assertEqual(bounds, ['2017-01-02T00:00:00Z', '2017-01-03T00:00:00Z', '2017-01-04T00:00:00Z'])
+        filters = partition.range_filters('createdon', bounds, nullable=True)
+        self.assertEqual(filters[-1], 'createdon eq null')
+        with self.assertRaises(ValueError):
+            partition.date_bounds('2017-01-05T00:00:00Z', '2017-01-01T00:00:00Z', 2)
+
+    def test_partitions_merged_without_duplicates(self):
+        data = {'a': [{'id': 'A1'}, {'id': 'A2'}], 'b': [{'id': 'B1'}, {'id': 'a2'}], None: [{'id': 'N1'}]}
+        backend = MagicMock()
+        backend.iter_rows.side_effect = lambda end_point, params, page_size: iter(data[params.get('$filter', '').split(' and ')[-1].strip('()') or None])
+        with patch.object(partition, 'CHUNK_SIZE', 1):
+            rows = list(partition.scan_partitions(backend, 'things', {'$filter': 'statecode eq 0'}, ['a', 'b'], 'id', workers=2))
+        self.assertEqual(sorted(row['id'].lower() for row in rows), ['a1', 'a2', 'b1'])
+        filters = sorted(call[0][1]['$filter'] for call in backend.iter_rows.call_args_list)
+        self.assertEqual(filters, ['(statecode eq 0) and (a)', '(statecode eq 0) and (b)'])
+
+    def test_rows_kept_without_key(self):
+        data = {'a': [{'id': 'A1'}, {'id': 'A2'}], 'b': [{'id': 'a2'}]}
+        backend = MagicMock()
+        backend.iter_rows.side_effect = lambda end_point, params, page_size: iter(data[params['$filter']])
+        rows = list(partition.scan_partitions(backend, 'things', {}, ['a', 'b'], workers=2))
+        self.assertEqual(sorted(row['id'] for row in rows), ['A1', 'A2', 'a2'])
+
+    def test_handler_deduplicates_only_partitions_by_date(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        with patch('edynam.models.scan_partitions', return_value=iter([])) as mocked_scan:
+            list(OrderDetail(backend).scan_partitioned(partitions=2))
+            list(OrderDetail(backend).scan_partitioned(partitions=2, by='modifiedon', since='2017-01-01T00:00:00Z'))
+        self.assertEqual([call[0][4] for call in mocked_scan.call_args_list], [None, 'salesorderdetailid'])
+
+    def test_partition_error_raised(self):
+        def iter_rows(end_point, params, page_size):
+            if params.get('$filter') == 'b':
+                raise LookupError(500)
+            return iter([{'id': 'A1'}])
+
+        backend = MagicMock()
+        backend.iter_rows.side_effect = iter_rows
+        with self.assertRaises(LookupError):
+            list(partition.scan_partitions(backend, 'things', {}, ['a', 'b'], 'id'))
+
+    def test_handler_scan_partitioned(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+
+        def iter_rows(end_point, params={}, page_size=None):
+            return iter([{'salesorderdetailid': params['$filter'], 'quantity': 1}])
+
+        with patch.object(Dynamics, 'iter_rows', side_effect=iter_rows) as mocked_rows:
+            rows = list(OrderDetail(backend).scan_partitioned(partitions=3, by='createdon',
+                                                              since='2017-01-01T00:00:00Z', until='2017-01-04T00:00:00Z'))
+        self.assertEqual(mocked_rows.call_count, 4)
+        self.assertEqual(sorted(row['salesorderdetailid'] for row in rows), [
+            'createdon eq null', 'createdon ge 2017-01-02T00:00:00Z and createdon lt 2017-01-03T00:00:00Z',
+            'createdon ge 2017-01-03T00:00:00Z', 'createdon lt 2017-01-02T00:00:00Z'])
+        with self.assertRaises(ValueError):
+            next(OrderDetail(backend).scan_partitioned(by='createdon'))
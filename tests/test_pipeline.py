@@ -0,0 +1,42 @@
+import unittest
+import threading
+
+from .context import edynam
+from edynam.pipeline import Pipe
+
+
+class TestPipe(unittest.TestCase):
+    def test_rows_of_chunks(self):
+        pipe = Pipe(1)
+
+        def produce():
+            for chunk in ([1, 2], [3]):
+                pipe.put(chunk)
+            pipe.close()
+
+        threading.Thread(target=produce).start()
+        self.assertEqual(list(pipe.rows()), [1, 2, 3])
+
+    def test_error_raised(self):
+        pipe = Pipe(2)
+        pipe.put([1])
+        pipe.put(LookupError(500))
+        rows = pipe.rows()
+        self.assertEqual(next(rows), 1)
+        with self.assertRaises(LookupError):
+            next(rows)
+
+    def test_put_fails_when_stopped(self):
+        pipe = Pipe(1)
+        self.assertTrue(pipe.put([1]))
+        results = []
+        worker = threading.Thread(target=lambda: results.append(pipe.put([2])))
+        worker.start()
+        rows = pipe.rows()
+        self.assertEqual(next(rows), 1)
+        rows.close()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        # [2] may have been queued before the caller stopped
+        self.assertEqual(len(results), 1)
+        self.assertFalse(pipe.put([3]))
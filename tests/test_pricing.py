@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import pricing
+from edynam.dynamics import Dynamics
+from edynam.pricing import PriceIndex
+
+
+def price(product, level, uom, amount):
+    return {'productpricelevelid': '%s-%s-%s' % (product, level, uom), 'amount': amount,
+            '_productid_value': product.upper(), '_productid_value@OData.Community.Display.V1.FormattedValue': 'name ' + product,
+            '_pricelevelid_value': level, '_uomid_value': uom}
+
+
+class TestPriceIndex(unittest.TestCase):
+    def setUp(self):
+        self.backend = Dynamics(MagicMock(resource='http://mocked'))
+        rows = [price('vm', 'retail', 'core', 10.0), price('vm', 'retail', 'hour', 0.5),
+                price('vm', 'member', 'core', 8.0), price('disk', 'retail', 'tb', 100.0)]
+        with patch.object(Dynamics, 'iter_rows', return_value=iter(rows)):
+            self.index = PriceIndex(self.backend).load()
+
+    def test_price(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.price('VM', 'retail', 'core'), 10.0)
+        self.assertEqual(self.index.price('vm', 'member'), 8.0)
+        # more than one unit on the price list
+        self.assertIsNone(self.index.price('vm', 'retail'))
+        self.assertIsNone(self.index.price('vm', 'unknown', 'core'))
+
+    def test_prices_of_name(self):
+        with patch.object(Dynamics, 'get') as mocked_get:
+            rows = self.index.prices_of('name disk')
+        self.assertFalse(mocked_get.called)
+        self.assertEqual([row['amount'] for row in rows], [100.0])
+        self.assertEqual(self.index.prices_of('nothing'), [])
+
+    def test_lookup_many(self):
+        keys = [('vm', 'retail', 'hour'), ('disk', 'retail', 'tb'), ('disk', 'member', 'tb')]
+        self.assertEqual(self.index.lookup_many(keys), [0.5, 100.0, None])
+
+    @unittest.skipIf(pricing.numpy is None, 'numpy is not installed')
+    def test_lookup_many_as_array(self):
+        keys = [('vm', 'retail', 'hour'), ('disk', 'retail', 'tb'), ('disk', 'member', 'tb'), ('x', 'y', 'z')]
+        prices = self.index.lookup_many(keys, as_array=True)
+        self.assertEqual(list(prices[:2]), [0.5, 100.0])
+        self.assertTrue(pricing.numpy.isnan(prices[2:]).all())
+
+    def test_invalidate_product(self):
+        with patch.object(Dynamics, 'get', return_value=[price('vm', 'retail', 'core', 12.0)]) as mocked_get:
+            self.index.invalidate('VM')
+            # other products are not reloaded
+            self.assertEqual(self.index.price('disk', 'retail', 'tb'), 100.0)
+            self.assertFalse(mocked_get.called)
+            self.assertEqual(self.index.lookup_many([('vm', 'retail', 'core'), ('vm', 'retail', 'hour')]), [12.0, None])
+            self.assertEqual(self.index.price('vm', 'retail', 'core'), 12.0)
+        self.assertEqual(mocked_get.call_count, 1)
+        self.assertIn('_productid_value eq vm', mocked_get.call_args[0][1]['$filter'])
+
+    def test_invalidate_all(self):
+        self.index.invalidate()
+        with patch.object(Dynamics, 'iter_rows', return_value=iter([price('vm', 'retail', 'core', 11.0)])) as mocked_rows:
+            self.assertEqual(self.index.price('vm', 'retail', 'core'), 11.0)
+            self.assertIsNone(self.index.price('disk', 'retail', 'tb'))
+        self.assertEqual(mocked_rows.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
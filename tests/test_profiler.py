@@ -0,0 +1,99 @@
+import json
+import time
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import profiler
+from edynam.dynamics import Dynamics
+from edynam.models import Account, Contact
+
+
+def slow_response(body, delay=0.02):
+    response = MagicMock(status_code=200)
+    response.content = json.dumps(body).encode('utf-8')
+    response.iter_content.return_value = [response.content]
+
+    def get(*args, **kwargs):
+        time.sleep(delay)
+        return response
+    return get
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.backend = Dynamics(MagicMock(resource='http://mocked'))
+
+    def test_phases_of_fetch_query(self):
+        with patch('requests.get', side_effect=slow_response({'value': [{'name': 'top', 'accountid': 'a'}]})):
+            with self.assertLogs('edynam.profiler', 'WARNING') as logs:
+                with profiler.profile(top=1) as prof:
+                    Account(self.backend).get_top()
+        call, = prof.calls
+        self.assertEqual(call.name, 'Account.get_top')
+        self.assertGreaterEqual(call.phases['network'][0], 0.02)
+        self.assertGreater(call.phases['build'][0], 0)
+        self.assertLessEqual(sum(times[0] for times in call.phases.values()), call.wall)
+        self.assertEqual(len(call.queries), 1)
+        self.assertIn('<fetch', call.queries[0])
+        self.assertIn('Slow call Account.get_top', logs.output[0])
+        self.assertIn('<fetch', logs.output[1])
+        self.assertIn('Account.get_top', prof.report())
+
+    def test_network_not_counted_as_decode(self):
+        with patch('requests.get', side_effect=slow_response({'value': [{'contactid': 'a'}]})):
+            with profiler.profile(log_level=0) as prof:
+                Contact(self.backend).list()
+                rows = list(Contact(self.backend).scan())
+        self.assertEqual(len(rows), 1)
+        # scan is not measured: only list is profiled
+        call, = prof.calls
+        self.assertGreater(call.phases['map'][0], 0)
+        self.assertLess(call.phases['decode'][0], 0.02)
+
+    def test_nested_phases(self):
+        with profiler.profile(threshold=60) as prof:
+            with profiler.call('outer'):
+                with profiler.phase('decode'):
+                    with profiler.phase('network'):
+                        time.sleep(0.02)
+        decode, network = prof.calls[0].phases['decode'][0], prof.calls[0].phases['network'][0]
+        self.assertGreaterEqual(network, 0.02)
+        self.assertLess(decode, 0.02)
+
+    def test_nothing_recorded_without_profile(self):
+        with profiler.call('outer') as call:
+            self.assertIsNone(call)
+            with profiler.phase('map'):
+                pass
+
+    def test_phases_added_by_threads(self):
+        profile_call = profiler.CallProfile('Handler.scan')
+
+        def add():
+            for _ in range(1000):
+                profile_call.add('network', 1.0, 0.5)
+
+        workers = [threading.Thread(target=add) for _ in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(profile_call.phases['network'], [8000.0, 4000.0])
+
+    def test_decorator(self):
+        prof = profiler.profile()
+
+        @prof
+        def report():
+            with profiler.call('Account.get_top'):
+                pass
+        with self.assertLogs('edynam.profiler', 'WARNING'):
+            report()
+        self.assertEqual(len(prof.calls), 1)
+        self.assertEqual(prof.slowest()[0].name, 'Account.get_top')
+
+
+if __name__ == '__main__':
+    unittest.main()
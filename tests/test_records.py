@@ -0,0 +1,74 @@
+import pickle
+import unittest
+from unittest.mock import patch
+
+from .context import edynam
+from edynam.connection import ADALConnection
+from edynam.dynamics import Dynamics, FORMATTED_VALUE_SUF
+from edynam.models import Contact, OrderDetail
+from edynam.records import Record, make_record_type, to_attr
+
+
+class TestRecords(unittest.TestCase):
+    def setUp(self):
+        with patch.object(ADALConnection, '_validate_parameters', return_value=None):
+            conn = ADALConnection({})
+            conn.parameters['resource'] = 'mocked'
+        self.dynamics = Dynamics(conn)
+
+    def test_to_attr(self):
+        self.assertEqual(to_attr('email'), 'email')
+        self.assertEqual(to_attr('statecode@' + FORMATTED_VALUE_SUF), 'statecode_formatted')
+        self.assertEqual(to_attr('@odata.etag'), 'odata_etag')
+
+    def test_round_trip(self):
+        record_type = make_record_type('TestRecord', ('email', 'status', 'email'))
+        values = {'email': 'a@b.c', 'status': 'Active', 'unknown': 1}
+        record = record_type(values)
+        self.assertIsInstance(record, Record)
+        self.assertEqual(record.email, 'a@b.c')
+        self.assertEqual(record['status'], 'Active')
+        self.assertEqual(record.unknown, 1)
+        self.assertEqual(record.to_dict(), values)
+        self.assertEqual(record, values)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), values)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_missing_value(self):
+        record = make_record_type('TestRecord', ('email', 'status'))({'email': None})
+        self.assertIsNone(record.email)
+        self.assertNotIn('status', record)
+        self.assertIsNone(record.get('status'))
+        with self.assertRaises(AttributeError):
+            record.status
+        with self.assertRaises(KeyError):
+            record['status']
+        self.assertEqual(record.to_dict(), {'email': None})
+
+    def test_record_type_of_handler(self):
+        record_type = Contact.record_type()
+        self.assertIs(record_type, Contact.record_type())
+        for key in ('contactid', 'fullname', 'email', 'username', 'status', 'parentcustomer', 'parentcustomerid'):
+            self.assertIn(key, record_type._KEYS)
+        self.assertIsNot(OrderDetail.record_type(), record_type)
+
+    def test_list_records(self):
+        item = {
+            '@odata.etag': 'W/"1915264"',
+            'contactid': '0a870511-b362-e611-80e3-c4346bc43f98',
+            'fullname': 'Adam Schwartzkopff',
+            'emailaddress1': 'adam@example.com',
+            'new_username': 'aschwartzkopff',
+            'statecode': 0,
+            'statecode@' + FORMATTED_VALUE_SUF: 'Active',
+            '_parentcustomerid_value': '9ecc87f3-ad62-e611-80e3-c4346bc516e8',
+            'parentcustomerid_account': {'name': 'School of Engineering'},
+            'parentcustomerid_contact': None
+        }
+        with patch.object(Dynamics, 'get', return_value=[item]):
+            records = Contact(self.dynamics, records=True).list()
+            dicts = Contact(self.dynamics).list()
+        self.assertEqual(records[0].username, 'aschwartzkopff')
+        self.assertEqual(records[0].parentcustomer_type, 'Account')
+        self.assertEqual(records[0].to_dict(), dicts[0])
+        self.assertIsNone(records[0]._extra)
@@ -0,0 +1,83 @@
+import time
+import threading
+import unittest
+
+from .context import edynam
+from edynam.runner import ReportRunner
+
+
+class TestReportRunner(unittest.TestCase):
+    def test_independent_jobs_run_concurrently(self):
+        def query(value, delay=0.1):
+            time.sleep(delay)
+            return value
+
+        runner = ReportRunner()
+        runner.add('product_id', query, 'p')
+        runner.add('props', query, 'props')
+        runner.add('usernames', query, 'u', delay=0.2)
+        runner.add('lines', lambda product_id, props: [product_id, props], deps=('product_id', 'props'))
+        runner.add('report', lambda lines, usernames: lines + [usernames], deps=('lines', 'usernames'))
+        run = runner.run()
+        self.assertEqual(run['report'], ['p', 'props', 'u'])
+        # sequentially the queries take 0.4 seconds
+        self.assertLess(run.wall, 0.35)
+        names, total = run.critical_path()
+        self.assertEqual(names, ['usernames', 'report'])
+        self.assertGreaterEqual(total, 0.2)
+        self.assertIn('critical path', run.summary())
+
+    def test_targets_and_cached_calls(self):
+        calls = []
+        lock = threading.Lock()
+
+        def query(value):
+            with lock:
+                calls.append(value)
+            time.sleep(0.02)
+            return value
+
+        runner = ReportRunner()
+        runner.add('first', query, 'x')
+        runner.add('second', query, 'x')
+        runner.add('other', query, 'y')
+        runner.add('both', lambda first, second: first + second, deps=('first', 'second'))
+        run = runner.run(['both'])
+        self.assertEqual(run['both'], 'xx')
+        self.assertEqual(calls, ['x'])
+        self.assertNotIn('other', run)
+
+    def test_decorator(self):
+        runner = ReportRunner()
+
+        @runner.job()
+        def numbers():
+            return [1, 2]
+
+        @runner.job(deps=('numbers', ))
+        def total(numbers):
+            return sum(numbers)
+
+        self.assertEqual(runner.run()['total'], 3)
+
+    def test_errors(self):
+        runner = ReportRunner()
+        runner.add('a', lambda b: b, deps=('b', ))
+        runner.add('b', lambda a: a, deps=('a', ))
+        with self.assertRaises(ValueError):
+            runner.run()
+        with self.assertRaises(ValueError):
+            ReportRunner().add('a', len, deps=('missing', )).run()
+        with self.assertRaises(ValueError):
+            ReportRunner().add('a', len, 'x').add('a', len, 'y')
+
+        def failed():
+            raise LookupError(404)
+        runner = ReportRunner().add('failed', failed).add('after', lambda failed: failed, deps=('failed', ))
+        with self.assertLogs('edynam.runner', 'ERROR'):
+            with self.assertRaises(LookupError):
+                runner.run()
+
+
+if __name__ == '__main__':
+    unittest.main()
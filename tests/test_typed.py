@@ -0,0 +1,61 @@
+import unittest
+from decimal import Decimal
+from datetime import datetime, date, timezone, timedelta
+from unittest.mock import MagicMock, patch
+
+from .context import edynam
+from edynam import typed
+from edynam.dynamics import Dynamics
+from edynam.models import Project, ProductPricelist
+
+
+class TestTyped(unittest.TestCase):
+    def setUp(self):
+        typed.set_timezone(timezone(timedelta(hours=9, minutes=30)))
+        self.addCleanup(typed.set_timezone, None)
+
+    def test_converters(self):
+        moment = typed.to_datetime('2016-10-20T02:19:54Z')
+        self.assertEqual((moment.day, moment.hour, moment.minute), (20, 11, 49))
+        self.assertEqual(moment.utcoffset(), timedelta(hours=9, minutes=30))
+        self.assertEqual(typed.to_date('2016-10-20'), date(2016, 10, 20))
+        self.assertEqual(typed.to_money(0.1), Decimal('0.1'))
+        self.assertEqual(typed.to_cents(10.005), 1000)
+        self.assertEqual(typed.to_cents('10.50'), 1050)
+        self.assertEqual(typed.to_guid('C3724CBC-B183-E611-80E7-C4346BC4BEAC'), 'c3724cbc-b183-e611-80e7-c4346bc4beac')
+
+    def test_distinct_values_converted_once(self):
+        with patch.dict(typed.CONVERTERS, {'guid': MagicMock(side_effect=str.lower)}):
+            column = typed.convert_column(['A', None, 'A', 'B'], 'guid')
+            self.assertEqual(typed.CONVERTERS['guid'].call_count, 2)
+        self.assertEqual(column, ['a', None, 'a', 'b'])
+
+    def test_convert_rows(self):
+        rows = [{'amount': 10.5, 'uomid': None}, {'amount': 2.0}, {'name': 'no typed field'}]
+        typed.convert_rows(rows, {'amount': 'money', 'uomid': 'guid', 'missing': 'date'})
+        self.assertEqual(rows, [{'amount': Decimal('10.5'), 'uomid': None}, {'amount': Decimal('2.0')},
+                                {'name': 'no typed field'}])
+        with self.assertRaises(ValueError):
+            typed.convert_rows(rows, {'amount': 'float'})
+
+    def test_typed_handler(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        prices = [{'productpricelevelid': '0A870511-B362-E611-80E3-C4346BC43F98', 'amount': 10.0,
+                   '_uomid_value': '9ECC87F3-AD62-E611-80E3-C4346BC516E8'}]
+        with patch.object(Dynamics, 'get', return_value=prices):
+            row, = ProductPricelist(backend, typed=True).list()
+        self.assertEqual(row['amount'], Decimal('10.0'))
+        self.assertEqual(row['uomid'], '9ecc87f3-ad62-e611-80e3-c4346bc516e8')
+        self.assertEqual(row['productpricelevelid'], '0a870511-b362-e611-80e3-c4346bc43f98')
+        with patch.object(Dynamics, 'get', return_value=prices):
+            self.assertEqual(ProductPricelist(backend).list()[0]['amount'], 10.0)
+
+    def test_typed_scan_in_chunks(self):
+        backend = Dynamics(MagicMock(resource='http://mocked'))
+        projects = [{'msdyn_scheduledstart': '2017-01-0%dT00:00:00Z' % (i + 1)} for i in range(5)]
+        handler = Project(backend, typed=True)
+        handler.TYPED_CHUNK = 2
+        with patch.object(Dynamics, 'iter_rows', return_value=iter(projects)):
+            rows = list(handler.scan())
+        self.assertTrue(all(isinstance(row['msdyn_scheduledstart'], datetime) for row in rows))
+        self.assertEqual([row['msdyn_scheduledstart'].day for row in rows], [1, 2, 3, 4, 5])